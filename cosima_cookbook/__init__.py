@@ -1,23 +1,51 @@
 # -*- coding: utf-8 -*-
 """
 Common tools for working with COSIMA model output
+
+The submodules, and the functions exported from them, are imported on
+first use, so that batch jobs and workers needing only the catalog do
+not load matplotlib, dask.distributed, IPython and the like.
 """
 
-__all__ = []
+import importlib
+
+__all__ = ['build_index', 'get_nc_variable',
+           'get_experiments', 'get_configurations',
+           'get_variables', 'get_ncfiles', 'search_variables']
+
+# the names exported by each submodule, where a name appears in more
+# than one the last is the one exported
+_exports = [
+    ('diagnostics', ['mean_tau_x', 'psi_sum', 'overturning_metrics']),
+    ('plots', ['aabw', 'amoc', 'amoc_south', 'annual_scalar', 'bering_strait',
+               'drake_passage', 'wind_stress', 'psi_avg', 'zonal_mean',
+               'sea_surface_temperature', 'sea_surface_salinity',
+               'mixed_layer_depth', 'lineplots', 'maps', 'overturning']),
+    ('netcdf_index', __all__),
+    ('summary', ['nmldict', 'nmldiff', 'rmcommonprefix', 'rmcommonsuffix',
+                 'strnmldict', 'superset', 'nmldiff_md', 'summary_md',
+                 'nml_diff', 'nml_summary']),
+    ('distributed', ['start_cluster', 'compute_by_block']),
+]
 
-from . import diagnostics
-from . diagnostics import *
+_origins = {name: module for module, names in _exports for name in names}
 
-from . import plots
-from . plots import *
+_submodules = {'benchmarks', 'catalog', 'chunking', 'diagnostics',
+               'distributed', 'handles', 'memory', 'netcdf_index', 'plots',
+               'streaming', 'summary', 'timing', 'virtual'}
 
-from . import netcdf_index
-from . netcdf_index import *
 
-from . import summary
-from . summary import *
+def __getattr__(name):
+    if name in _origins:
+        value = getattr(importlib.import_module('.' + _origins[name], __name__), name)
+    elif name in _submodules:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
-from . distributed import start_cluster, compute_by_block
+    globals()[name] = value
+    return value
 
-__all__.extend(netcdf_index.__all__)
 
+def __dir__():
+    return sorted(set(globals()) | set(_origins) | _submodules)
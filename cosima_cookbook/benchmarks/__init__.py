@@ -0,0 +1,214 @@
+"""
+Benchmarks of indexing, catalog queries, loading and diagnostics.
+
+run_benchmarks generates a synthetic experiment (see synthetic) at the
+given scale, points the index at it and times each benchmark, returning
+(and optionally writing as JSON) the timings along with the machine and
+package versions, so results can be compared between commits.  From the
+command line:
+
+    python -m cosima_cookbook.benchmarks --scale small --output results.json
+"""
+
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from . import synthetic
+
+logger = logging.getLogger(__name__)
+
+configuration = 'access-om2'
+experiment = 'synthetic'
+
+
+class Benchmark(object):
+    """
+    A timed function, with a setup run (untimed) before each repeat.
+    """
+
+    def __init__(self, name, func, setup=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+    def run(self, repeat):
+        """
+        Returns a dictionary of the times taken by each of repeat calls,
+        their minimum and median, or the error raised.
+        """
+        times = []
+        try:
+            for i in range(repeat):
+                if self.setup is not None:
+                    self.setup(i)
+                start = time.perf_counter()
+                self.func()
+                times.append(time.perf_counter() - start)
+        except Exception as e:
+            return {'times': times, 'error': '{}: {}'.format(type(e).__name__, e),
+                    'traceback': traceback.format_exc()}
+        return {'times': times, 'min': min(times),
+                'median': statistics.median(times), 'error': None}
+
+
+def _forget_open_files(i=None):
+    from .. import handles, netcdf_index
+    handles.handle_cache.clear()
+    netcdf_index.clear_result_cache(disk=False)
+
+
+def _import(module):
+    """
+    Returns a function importing module in a new interpreter, the time
+    taken including the start of the interpreter itself.
+    """
+    def run():
+        subprocess.run([sys.executable, '-c', 'import {}'.format(module)],
+                       check=True, stdout=subprocess.DEVNULL)
+    return run
+
+
+def benchmarks(root, parameters):
+    """
+    Returns the list of Benchmarks of an experiment generated under root
+    with the given parameters, with the index in root.
+    """
+    from .. import netcdf_index
+    from ..diagnostics import overturning, simple
+
+    def fresh_index(i):
+        # a new database for each repeat, as the catalog keeps its
+        # connections to the last, removed if left by an earlier run
+        database = os.path.join(root, 'index-{}.db'.format(i))
+        for path in (database, database + '-wal', database + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        netcdf_index.database_url = 'sqlite:///{}'.format(database)
+
+    def indexed(i):
+        netcdf_index.database_url = 'sqlite:///{}'.format(os.path.join(root, 'index.db'))
+        _forget_open_files()
+
+    def catalog_queries():
+        for expt in netcdf_index.get_experiments(configuration):
+            for ncfile in netcdf_index.get_ncfiles(expt):
+                netcdf_index.get_variables(expt, ncfile)
+        netcdf_index.get_catalog().ncfiles(experiment, 'ocean.nc', ['temp'], None)
+
+    def get_nc_variable():
+        netcdf_index.get_nc_variable(experiment, 'ocean.nc', 'temp')
+
+    def mean_over_time():
+        netcdf_index.get_nc_variable(experiment, 'ocean_month.nc',
+                                     'eta_t').mean('time').compute()
+
+    def mean_3d():
+        netcdf_index.get_nc_variable(experiment, 'ocean.nc',
+                                     'temp').mean(['xt_ocean', 'time']).compute()
+
+    # the diagnostics themselves, rather than their cached results
+    def psi_avg():
+        overturning.psi_avg.func(experiment, n=parameters['nruns'])
+
+    def annual_scalar():
+        simple.annual_scalar.func(experiment, ['temp_global_ave', 'ke_tot'])
+
+    return [Benchmark('import', _import('cosima_cookbook')),
+            Benchmark('import_netcdf_index', _import('cosima_cookbook.netcdf_index')),
+            Benchmark('import_all', _import('cosima_cookbook.diagnostics, '
+                                            'cosima_cookbook.plots')),
+            Benchmark('build_index', netcdf_index.build_index, fresh_index),
+            Benchmark('build_index_incremental',
+                      lambda: netcdf_index.build_index(incremental=True), indexed),
+            Benchmark('catalog_queries', catalog_queries, indexed),
+            Benchmark('get_nc_variable', get_nc_variable, indexed),
+            Benchmark('mean_over_time', mean_over_time, indexed),
+            Benchmark('mean_3d', mean_3d, indexed),
+            Benchmark('psi_avg', psi_avg, indexed),
+            Benchmark('annual_scalar', annual_scalar, indexed)]
+
+
+def _machine():
+    from ..distributed import available_cores, available_memory
+    return {'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cores': available_cores(),
+            'memory': available_memory()}
+
+
+def _versions():
+    import dask
+    import netCDF4
+    import numpy
+    import pandas
+    import xarray
+    return {module.__name__: module.__version__
+            for module in (dask, netCDF4, numpy, pandas, xarray)}
+
+
+def run_benchmarks(scale='tiny', root=None, repeat=3, names=None, output=None):
+    """
+    Runs the benchmarks (only those of the given names, if given) on a
+    synthetic experiment of the given scale (one of synthetic.scales),
+    each repeat times, and returns the results as a dictionary.
+
+    The experiment is generated under root, where it is kept for later
+    runs, or otherwise in a temporary directory removed afterwards.
+    The results are also written as JSON to output, if given.
+    """
+    from .. import netcdf_index
+
+    parameters = synthetic.scales[scale]
+    keep = root is not None
+    if root is None:
+        root = tempfile.mkdtemp(prefix='cosima-cookbook-benchmarks-')
+    data = os.path.join(root, scale)
+
+    saved = (netcdf_index.directoriesToSearch, netcdf_index.database_url)
+    results = {}
+    try:
+        start = time.perf_counter()
+        synthetic.make_experiment(data, configuration, experiment, **parameters)
+        generated = time.perf_counter() - start
+
+        netcdf_index.directoriesToSearch = [data]
+        netcdf_index.database_url = 'sqlite:///{}'.format(os.path.join(root, 'index.db'))
+        if os.path.exists(os.path.join(root, 'index.db')):
+            os.remove(os.path.join(root, 'index.db'))
+        netcdf_index.build_index()
+
+        for benchmark in benchmarks(root, parameters):
+            if names is None or benchmark.name in names:
+                logger.info('Running {}'.format(benchmark.name))
+                results[benchmark.name] = benchmark.run(repeat)
+    finally:
+        netcdf_index.directoriesToSearch, netcdf_index.database_url = saved
+        _forget_open_files()
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {'scale': scale,
+              'parameters': parameters,
+              'repeat': repeat,
+              'generated_in': generated,
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'machine': _machine(),
+              'versions': _versions(),
+              'benchmarks': results}
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
@@ -0,0 +1,37 @@
+import argparse
+import json
+import logging
+
+from . import run_benchmarks
+from .synthetic import scales
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time indexing, loading and diagnostics on synthetic output')
+    parser.add_argument('--scale', choices=sorted(scales), default='tiny')
+    parser.add_argument('--root', help='directory to keep the synthetic experiment in')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default all)')
+    args = parser.parse_args()
+
+    # report each benchmark as it starts
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('cosima_cookbook.benchmarks').setLevel(logging.INFO)
+
+    report = run_benchmarks(args.scale, args.root, args.repeat,
+                            args.names or None, args.output)
+
+    for name, result in report['benchmarks'].items():
+        if result['error'] is None:
+            print('{:28s} {:10.4f}s (median {:.4f}s)'.format(name, result['min'],
+                                                            result['median']))
+        else:
+            print('{:28s} failed: {}'.format(name, result['error']))
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Synthetic MOM5 / ACCESS-OM2 output for benchmarks.
+
+make_experiment writes an experiment laid out as payu leaves it,
+
+    root/configuration/experiment/outputNNN/ocean/ocean*.nc
+
+with one year per output directory, unlimited time axes in days since
+1700-01-01 (noleap) and the storage chunking, dimension names and
+attributes of MOM output, so that indexing and loading follow the same
+paths as on real experiments.  The values are random.
+"""
+
+import os
+
+import netCDF4
+import numpy as np
+
+time_units = 'days since 1700-01-01 00:00:00'
+calendar = 'noleap'
+
+# the grid and length of experiments at each scale of benchmark
+scales = {
+    'tiny': {'nruns': 2, 'ny': 30, 'nx': 36, 'nz': 5, 'npotrho': 8},
+    'small': {'nruns': 10, 'ny': 150, 'nx': 180, 'nz': 25, 'npotrho': 40},
+    'medium': {'nruns': 40, 'ny': 300, 'nx': 360, 'nz': 50, 'npotrho': 80},
+    'large': {'nruns': 100, 'ny': 1080, 'nx': 1440, 'nz': 50, 'npotrho': 80},
+}
+
+_month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def _axis(ds, name, values, units, cartesian_axis, long_name=None):
+    ds.createDimension(name, len(values))
+    axis = ds.createVariable(name, 'f8', (name,))
+    axis.long_name = long_name or name
+    axis.units = units
+    axis.cartesian_axis = cartesian_axis
+    axis[:] = values
+
+
+def _time_axis(ds, days, year):
+    """
+    Creates the unlimited time axis of ds, at the middle of periods of
+    the given lengths in days from the start of year, with its bounds.
+    """
+    ds.createDimension('time', None)
+    ds.createDimension('nv', 2)
+    ends = 365 * year + np.cumsum(days)
+    starts = ends - days
+
+    time = ds.createVariable('time', 'f8', ('time',))
+    time.long_name = 'time'
+    time.units = time_units
+    time.calendar = calendar
+    time.cartesian_axis = 'T'
+    time.bounds = 'time_bounds'
+    time[:] = (starts + ends) / 2
+
+    bounds = ds.createVariable('time_bounds', 'f8', ('time', 'nv'))
+    bounds.long_name = 'time axis boundaries'
+    bounds.units = time_units
+    bounds[:] = np.stack([starts, ends], axis=1)
+
+
+def _horizontal_axes(ds, ny, nx, grid='t'):
+    prefix = 'grid_' if grid.startswith('grid') else ''
+    for kind in ('t', 'u'):
+        offset = 0.5 if kind == 'u' else 0
+        _axis(ds, '{}x{}_ocean'.format(prefix, kind),
+              -280 + (np.arange(nx) + offset) * 360 / nx,
+              'degrees_E', 'X', 'longitude')
+        _axis(ds, '{}y{}_ocean'.format(prefix, kind),
+              -80 + (np.arange(ny) + offset) * 170 / ny,
+              'degrees_N', 'Y', 'latitude')
+
+
+def _variable(ds, name, dims, chunks, rng, long_name, units, scale=1, offset=0):
+    var = ds.createVariable(name, 'f4', dims, chunksizes=chunks,
+                            fill_value=np.float32(-1e20), zlib=False)
+    var.long_name = long_name
+    var.units = units
+    var.cell_methods = 'time: mean'
+    var.time_avg_info = 'average_T1,average_T2,average_DT'
+    shape = [len(ds.dimensions[dim]) for dim in dims]
+    # one time step at a time, keeping memory use down at large scales
+    for i in range(shape[0]):
+        values = offset + scale * rng.standard_normal(shape[1:], dtype='f4')
+        var[i] = values
+    return var
+
+
+def write_ocean(path, year, ny, nx, nz, npotrho, rng, gm=True):
+    """
+    Writes ocean.nc: monthly temperature and overturning transports in
+    density coordinates.
+    """
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.filename = os.path.basename(path)
+        ds.title = 'ACCESS-OM2'
+        _time_axis(ds, _month_days, year)
+        _horizontal_axes(ds, ny, nx)
+        _horizontal_axes(ds, ny, nx, grid='grid')
+        _axis(ds, 'st_ocean', 5 + np.cumsum(np.linspace(10, 200, nz)),
+              'meters', 'Z', 'tcell zstar depth')
+        _axis(ds, 'potrho', np.linspace(1028, 1038, npotrho),
+              'kg/m^3', 'Z', 'potential density')
+
+        _variable(ds, 'temp', ('time', 'st_ocean', 'yt_ocean', 'xt_ocean'),
+                  (1, min(nz, 7), min(ny, 300), min(nx, 360)), rng,
+                  'Conservative temperature', 'K', scale=5, offset=285)
+        for name in ['ty_trans_rho'] + (['ty_trans_rho_gm'] if gm else []):
+            _variable(ds, name, ('time', 'potrho', 'grid_yu_ocean', 'grid_xt_ocean'),
+                      (1, min(npotrho, 20), min(ny, 300), min(nx, 360)), rng,
+                      'T-cell j-mass transport on potrho levels', 'kg/s', scale=1e9)
+
+
+def write_ocean_month(path, year, ny, nx, rng):
+    """
+    Writes ocean_month.nc: monthly 2D fields and vertically integrated
+    transports.
+    """
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.filename = os.path.basename(path)
+        _time_axis(ds, _month_days, year)
+        _horizontal_axes(ds, ny, nx)
+        chunks = (1, min(ny, 300), min(nx, 360))
+        _variable(ds, 'eta_t', ('time', 'yt_ocean', 'xt_ocean'), chunks, rng,
+                  'surface height on T cells', 'meter', scale=0.5)
+        _variable(ds, 'mld', ('time', 'yt_ocean', 'xt_ocean'), chunks, rng,
+                  'mixed layer depth determined by density criteria', 'm',
+                  scale=20, offset=50)
+        _variable(ds, 'tau_x', ('time', 'yu_ocean', 'xu_ocean'), chunks, rng,
+                  'i-directed wind stress forcing u-velocity', 'N/m^2', scale=0.1)
+        _variable(ds, 'tx_trans_int_z', ('time', 'yt_ocean', 'xu_ocean'), chunks, rng,
+                  'T-cell i-mass transport vertically summed', 'kg/s', scale=1e9)
+        _variable(ds, 'ty_trans_int_z', ('time', 'yu_ocean', 'xt_ocean'), chunks, rng,
+                  'T-cell j-mass transport vertically summed', 'kg/s', scale=1e9)
+
+
+def write_ocean_scalar(path, year, rng):
+    """
+    Writes ocean_scalar.nc: daily global diagnostics.
+    """
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.filename = os.path.basename(path)
+        _time_axis(ds, np.ones(365), year)
+        ds.createDimension('scalar_axis', 1)
+        axis = ds.createVariable('scalar_axis', 'f8', ('scalar_axis',))
+        axis.long_name = 'none'
+        axis.units = 'none'
+        axis[:] = 0
+        for name, long_name, units, offset in [
+                ('temp_global_ave', 'Global mean temp in liquid seawater', 'deg_C', 3.6),
+                ('salt_global_ave', 'Global mean salt in liquid seawater', 'psu', 34.7),
+                ('ke_tot', 'Globally integrated ocean kinetic energy', '10^15 Joules', 3000),
+                ('pe_tot', 'Globally integrated ocean potential energy', '10^15 Joules', 1e6)]:
+            _variable(ds, name, ('time', 'scalar_axis'), (365, 1), rng,
+                      long_name, units, scale=0.01 * offset, offset=offset)
+
+
+def make_experiment(root, configuration='access-om2', experiment='synthetic',
+                    nruns=2, ny=30, nx=36, nz=5, npotrho=8, first_run=0,
+                    gm=True, seed=0):
+    """
+    Writes nruns years of synthetic output (outputNNN directories from
+    first_run on) of the given experiment under root, on an ny by nx
+    grid of nz levels and npotrho density classes, and returns the
+    experiment directory.  Existing output directories are kept, so an
+    experiment can be extended run by run.
+    """
+    expt_dir = os.path.join(root, configuration, experiment)
+    for run in range(first_run, first_run + nruns):
+        ocean_dir = os.path.join(expt_dir, 'output{:03d}'.format(run), 'ocean')
+        if os.path.isdir(ocean_dir):
+            continue
+        os.makedirs(ocean_dir + '.tmp', exist_ok=True)
+        rng = np.random.default_rng([seed, run])
+        write_ocean(os.path.join(ocean_dir + '.tmp', 'ocean.nc'), run,
+                    ny, nx, nz, npotrho, rng, gm=gm)
+        write_ocean_month(os.path.join(ocean_dir + '.tmp', 'ocean_month.nc'), run,
+                          ny, nx, rng)
+        write_ocean_scalar(os.path.join(ocean_dir + '.tmp', 'ocean_scalar.nc'), run, rng)
+        # only complete runs appear in the tree
+        os.rename(ocean_dir + '.tmp', ocean_dir)
+    return expt_dir
@@ -0,0 +1,1173 @@
+"""
+Schema of the variable catalog behind netcdf_index.
+
+The catalog is normalized: experiments contain runs, runs contain
+files, and the file_variables link table records which variables
+(with their dimensions and chunking) are found in each file.  The
+experiment and basename pattern of each file are repeated in the link
+table so that the common lookups (experiment, basename_pattern,
+variable) are answered from a single covering index.
+
+The shape of each variable in each file, and the length and values of
+each file's time axis, are recorded along with the dtype, fill value
+and attributes of the variables of each basename pattern and the
+values of its static coordinates.  This is enough to lay out the
+contents of an experiment without opening its files.
+
+The long_name, units and standard_name of the variables of each
+pattern are also kept in a descriptions table, with a full-text (FTS5
+trigram) index over it where SQLite supports one, so that variables can
+be searched for by name or description across all experiments (see
+Catalog.search).
+
+For backwards compatibility a view called ncfiles presents the catalog
+in the layout of the original, denormalized, ncfiles table.
+
+Lookups go through a Catalog, which holds a connection to the database
+and runs the parameterized statements defined in this module.  A
+Catalog may answer lookups from a read-only snapshot of the database
+on a local disk (see take_snapshot), sparing a shared filesystem the
+queries of many kernels; the index is still written centrally.
+"""
+
+import ast
+import contextlib
+import errno
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+import dataset
+import numpy as np
+from sqlalchemy import text, bindparam
+
+SCHEMA_VERSION = 1
+
+# Distinct descriptions of variables, with missing attributes as empty
+# strings so that they compare equal.
+_create_descriptions = [
+    """
+    CREATE TABLE IF NOT EXISTS descriptions (
+        id INTEGER PRIMARY KEY,
+        variable TEXT NOT NULL,
+        long_name TEXT NOT NULL,
+        units TEXT NOT NULL,
+        standard_name TEXT NOT NULL,
+        UNIQUE (variable, long_name, units, standard_name)
+    )""",
+    """
+    CREATE INDEX IF NOT EXISTS pattern_variables_by_description
+        ON pattern_variables (description_id)""",
+]
+
+# The full-text (FTS5 trigram) index of the descriptions, created where
+# SQLite supports it (see trigram_search).  Descriptions are never
+# deleted, so the index only needs updating on insert.
+_create_variable_search = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS variable_search USING fts5 (
+        variable, long_name, units, standard_name,
+        content = 'descriptions', content_rowid = 'id', tokenize = 'trigram'
+    )""",
+    """
+    CREATE TRIGGER IF NOT EXISTS descriptions_search AFTER INSERT ON descriptions
+    BEGIN
+        INSERT INTO variable_search (rowid, variable, long_name, units, standard_name)
+        VALUES (new.id, new.variable, new.long_name, new.units, new.standard_name);
+    END""",
+]
+
+_schema = [
+    """
+    CREATE TABLE IF NOT EXISTS experiments (
+        id INTEGER PRIMARY KEY,
+        rootdir TEXT NOT NULL,
+        configuration TEXT NOT NULL,
+        experiment TEXT NOT NULL,
+        UNIQUE (rootdir, configuration, experiment)
+    )""",
+    """
+    CREATE INDEX IF NOT EXISTS experiments_by_name
+        ON experiments (experiment, configuration)""",
+    """
+    CREATE INDEX IF NOT EXISTS experiments_by_configuration
+        ON experiments (configuration, experiment)""",
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        experiment_id INTEGER NOT NULL REFERENCES experiments (id),
+        run TEXT NOT NULL,
+        indexed INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (experiment_id, run)
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY,
+        run_id INTEGER NOT NULL REFERENCES runs (id),
+        experiment_id INTEGER NOT NULL REFERENCES experiments (id),
+        ncfile TEXT NOT NULL UNIQUE,
+        basename TEXT NOT NULL,
+        basename_pattern TEXT NOT NULL,
+        size INTEGER,
+        mtime REAL,
+        time_first REAL,
+        time_last REAL,
+        time_units TEXT,
+        calendar TEXT,
+        time_length INTEGER,
+        time_values BLOB
+    )""",
+    """
+    CREATE INDEX IF NOT EXISTS files_by_pattern
+        ON files (experiment_id, basename_pattern, ncfile)""",
+    """
+    CREATE INDEX IF NOT EXISTS files_by_run
+        ON files (run_id)""",
+    """
+    CREATE TABLE IF NOT EXISTS variables (
+        id INTEGER PRIMARY KEY,
+        variable TEXT NOT NULL UNIQUE
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS file_variables (
+        file_id INTEGER NOT NULL REFERENCES files (id),
+        variable_id INTEGER NOT NULL REFERENCES variables (id),
+        experiment_id INTEGER NOT NULL,
+        basename_pattern TEXT NOT NULL,
+        dimensions TEXT,
+        chunking TEXT,
+        shape TEXT,
+        PRIMARY KEY (file_id, variable_id)
+    ) WITHOUT ROWID""",
+    """
+    CREATE INDEX IF NOT EXISTS file_variables_lookup
+        ON file_variables (experiment_id, basename_pattern, variable_id, file_id)""",
+    """
+    CREATE TABLE IF NOT EXISTS pattern_variables (
+        experiment_id INTEGER NOT NULL REFERENCES experiments (id),
+        basename_pattern TEXT NOT NULL,
+        variable_id INTEGER NOT NULL REFERENCES variables (id),
+        dimensions TEXT,
+        dtype TEXT,
+        decoded_dtype TEXT,
+        fill_value REAL,
+        attributes TEXT,
+        coordinate_values BLOB,
+        description_id INTEGER REFERENCES descriptions (id),
+        PRIMARY KEY (experiment_id, basename_pattern, variable_id)
+    ) WITHOUT ROWID""",
+] + _create_descriptions + [
+    """
+    CREATE VIEW IF NOT EXISTS ncfiles AS
+    SELECT files.ncfile, experiments.rootdir, experiments.configuration,
+           experiments.experiment, runs.run, files.basename,
+           files.basename_pattern, variables.variable,
+           file_variables.dimensions, file_variables.chunking,
+           files.size, files.mtime
+    FROM file_variables
+    JOIN files ON files.id = file_variables.file_id
+    JOIN runs ON runs.id = files.run_id
+    JOIN experiments ON experiments.id = files.experiment_id
+    JOIN variables ON variables.id = file_variables.variable_id""",
+]
+
+
+def _execute(db, statement, params=None):
+    if isinstance(statement, str):
+        statement = text(statement)
+    if params is None:
+        return db.executable.execute(statement)
+    return db.executable.execute(statement, params)
+
+
+@functools.lru_cache(maxsize=None)
+def trigram_search():
+    """
+    Returns whether SQLite supports the full-text index of descriptions:
+    FTS5 with the trigram tokenizer, from SQLite 3.34.
+    """
+    try:
+        with contextlib.closing(sqlite3.connect(':memory:')) as conn:
+            conn.execute("CREATE VIRTUAL TABLE probe USING fts5 (text, tokenize = 'trigram')")
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def schema_version(db):
+    """
+    Returns the version of the catalog schema in db, 0 if there is none.
+    """
+    return _execute(db, 'PRAGMA user_version').scalar()
+
+
+def _has_table(db, name):
+    return _execute(db, "SELECT 1 FROM sqlite_master "
+                        "WHERE type = 'table' AND name = :name",
+                    {'name': name}).scalar() is not None
+
+
+def create_schema(db):
+    """
+    Creates the catalog tables in db if they do not exist yet.
+
+    An index using the original denormalized ncfiles table is migrated
+    to the catalog schema (see migrate_index).
+    """
+    if schema_version(db) >= SCHEMA_VERSION:
+        return
+
+    if _has_table(db, 'ncfiles'):
+        migrate_index(db)
+        return
+
+    with db:
+        _create_schema(db)
+        _execute(db, 'PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+
+
+def _create_schema(db):
+    for statement in _schema:
+        _execute(db, statement)
+    if trigram_search():
+        for statement in _create_variable_search:
+            _execute(db, statement)
+    else:
+        logging.info('SQLite has no FTS5 trigram tokenizer, so variables '
+                     'are searched without a full-text index')
+
+
+def migrate_index(db):
+    """
+    Migrates an index in the original layout, a single denormalized
+    ncfiles table, to the normalized catalog schema.
+
+    The migration runs in a single transaction entirely within SQLite.
+    Afterwards the ncfiles table is replaced by a view of the same name.
+    """
+    if not _has_table(db, 'ncfiles'):
+        return
+
+    logging.info('Migrating index to catalog schema version {}'.format(SCHEMA_VERSION))
+
+    with db:
+        _execute(db, 'ALTER TABLE ncfiles RENAME TO ncfiles_legacy')
+        _create_schema(db)
+
+        _execute(db, """
+            INSERT OR IGNORE INTO experiments (rootdir, configuration, experiment)
+            SELECT DISTINCT rootdir, configuration, experiment
+            FROM ncfiles_legacy""")
+        _execute(db, """
+            INSERT OR IGNORE INTO runs (experiment_id, run)
+            SELECT DISTINCT experiments.id, legacy.run
+            FROM ncfiles_legacy AS legacy
+            JOIN experiments USING (rootdir, configuration, experiment)""")
+
+        # The original build_index only saved complete runs
+        _execute(db, 'UPDATE runs SET indexed = 1')
+
+        # The original layout holds no per-file information.  Leaving the
+        # fingerprints empty makes an incremental build_index re-read them.
+        _execute(db, """
+            INSERT OR IGNORE INTO files (run_id, experiment_id, ncfile, basename,
+                                         basename_pattern)
+            SELECT runs.id, experiments.id, legacy.ncfile, legacy.basename,
+                   legacy.basename_pattern
+            FROM ncfiles_legacy AS legacy
+            JOIN experiments USING (rootdir, configuration, experiment)
+            JOIN runs ON runs.experiment_id = experiments.id
+                     AND runs.run = legacy.run
+            GROUP BY legacy.ncfile""")
+        _execute(db, """
+            INSERT OR IGNORE INTO variables (variable)
+            SELECT DISTINCT variable FROM ncfiles_legacy""")
+        _execute(db, """
+            INSERT OR IGNORE INTO file_variables (file_id, variable_id, experiment_id,
+                                                  basename_pattern, dimensions, chunking)
+            SELECT files.id, variables.id, files.experiment_id,
+                   files.basename_pattern, legacy.dimensions, legacy.chunking
+            FROM ncfiles_legacy AS legacy
+            JOIN files ON files.ncfile = legacy.ncfile
+            JOIN variables ON variables.variable = legacy.variable""")
+
+        _execute(db, 'DROP TABLE ncfiles_legacy')
+        _execute(db, 'PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+
+
+def indexed_runs(db):
+    """
+    Returns a list of (rootdir, configuration, experiment, run) for
+    every run that has been completely indexed.
+    """
+    rows = _execute(db, """
+        SELECT experiments.rootdir, experiments.configuration,
+               experiments.experiment, runs.run
+        FROM runs JOIN experiments ON experiments.id = runs.experiment_id
+        WHERE runs.indexed""")
+
+    return [tuple(row) for row in rows]
+
+
+def indexed_files(db):
+    """
+    Returns a dictionary mapping each file in the catalog to its
+    (size, mtime) fingerprint.
+    """
+    rows = _execute(db, 'SELECT ncfile, size, mtime FROM files')
+
+    return {ncfile: (size, mtime) for ncfile, size, mtime in rows}
+
+
+_select_file_ids = text(
+    'SELECT id FROM files WHERE ncfile IN :ncfiles'
+).bindparams(bindparam('ncfiles', expanding=True))
+
+_delete_file_variables = text(
+    'DELETE FROM file_variables WHERE file_id IN :file_ids'
+).bindparams(bindparam('file_ids', expanding=True))
+
+_delete_files = text(
+    'DELETE FROM files WHERE id IN :file_ids'
+).bindparams(bindparam('file_ids', expanding=True))
+
+_insert_experiment = text(
+    'INSERT OR IGNORE INTO experiments (rootdir, configuration, experiment) '
+    'VALUES (:rootdir, :configuration, :experiment)')
+
+_select_experiment = text(
+    'SELECT id FROM experiments WHERE rootdir = :rootdir '
+    'AND configuration = :configuration AND experiment = :experiment')
+
+_insert_run = text(
+    'INSERT OR IGNORE INTO runs (experiment_id, run) '
+    'VALUES (:experiment_id, :run)')
+
+_select_run = text(
+    'SELECT id FROM runs WHERE experiment_id = :experiment_id AND run = :run')
+
+_mark_run_indexed = text('UPDATE runs SET indexed = 1 WHERE id = :run_id')
+
+_delete_run = text('DELETE FROM runs WHERE id = :run_id')
+
+_delete_empty_experiments = text(
+    'DELETE FROM experiments WHERE id NOT IN (SELECT experiment_id FROM runs)')
+
+_delete_orphan_pattern_variables = text(
+    'DELETE FROM pattern_variables '
+    'WHERE experiment_id NOT IN (SELECT id FROM experiments)')
+
+_insert_variable = text(
+    'INSERT OR IGNORE INTO variables (variable) VALUES (:variable)')
+
+_select_variable = text('SELECT id FROM variables WHERE variable = :variable')
+
+_insert_file = text(
+    'INSERT INTO files (run_id, experiment_id, ncfile, basename, '
+    'basename_pattern, size, mtime, '
+    'time_first, time_last, time_units, calendar, time_length, time_values) '
+    'VALUES (:run_id, :experiment_id, :ncfile, :basename, '
+    ':basename_pattern, :size, :mtime, '
+    ':time_first, :time_last, :time_units, :calendar, '
+    ':time_length, :time_values)')
+
+# fields that may be missing from index records
+_file_defaults = {'size': None, 'mtime': None,
+                  'time_first': None, 'time_last': None,
+                  'time_units': None, 'calendar': None,
+                  'time_length': None, 'time_values': None}
+
+_variable_defaults = {'shape': None, 'dtype': None, 'decoded_dtype': None,
+                      'fill_value': None,
+                      'attributes': None, 'coordinate_values': None,
+                      'description_id': None}
+
+# the attributes of variables kept in descriptions
+described_attributes = ('long_name', 'units', 'standard_name')
+
+_insert_description = text(
+    'INSERT OR IGNORE INTO descriptions (variable, long_name, units, standard_name) '
+    'VALUES (:variable, :long_name, :units, :standard_name)')
+
+_select_description = text(
+    'SELECT id FROM descriptions WHERE variable = :variable '
+    'AND long_name = :long_name AND units = :units '
+    'AND standard_name = :standard_name')
+
+_insert_file_variable = text(
+    'INSERT INTO file_variables (file_id, variable_id, experiment_id, '
+    'basename_pattern, dimensions, chunking, shape) '
+    'VALUES (:file_id, :variable_id, :experiment_id, '
+    ':basename_pattern, :dimensions, :chunking, :shape)')
+
+# the most recently indexed file of a pattern describes its variables
+_replace_pattern_variable = text(
+    'INSERT OR REPLACE INTO pattern_variables (experiment_id, '
+    'basename_pattern, variable_id, dimensions, dtype, decoded_dtype, '
+    'fill_value, attributes, coordinate_values, description_id) '
+    'VALUES (:experiment_id, :basename_pattern, :variable_id, '
+    ':dimensions, :dtype, :decoded_dtype, :fill_value, :attributes, '
+    ':coordinate_values, :description_id)')
+
+
+def _get_id(db, insert, select, params):
+    _execute(db, insert, params)
+    return _execute(db, select, params).scalar()
+
+
+def _run_id(db, run):
+    experiment_id = _get_id(db, _insert_experiment, _select_experiment, run)
+    return experiment_id, _get_id(db, _insert_run, _select_run,
+                                  {'experiment_id': experiment_id,
+                                   'run': run['run']})
+
+
+def _description(variable, attributes):
+    """
+    Returns the description of variable with the given attributes (as
+    JSON) as a tuple of its name and described_attributes, or None if
+    there are no attributes.
+    """
+    if attributes is None:
+        return None
+    attributes = json.loads(attributes)
+    return (variable,) + tuple(str(attributes.get(name, ''))
+                               for name in described_attributes)
+
+
+def _remove_files(db, ncfiles):
+    ncfiles = list(ncfiles)
+    for i in range(0, len(ncfiles), 500):
+        file_ids = [row[0] for row in
+                    _execute(db, _select_file_ids, {'ncfiles': ncfiles[i:i+500]})]
+        if len(file_ids) > 0:
+            _execute(db, _delete_file_variables, {'file_ids': file_ids})
+            _execute(db, _delete_files, {'file_ids': file_ids})
+
+
+def write_records(db, ncvars, files_removed=(), runs_indexed=(), runs_removed=()):
+    """
+    Saves index records (as returned by netcdf_index.index_variables)
+    to the catalog in a single transaction.
+
+    Any existing entries for files_removed, or for the files of ncvars,
+    are deleted first so that re-read files replace their previous
+    entries.  Runs are given as dictionaries with rootdir,
+    configuration, experiment and run keys: runs_indexed are marked as
+    completely indexed and runs_removed are deleted.
+    """
+    files = {}
+    for ncvar in ncvars:
+        files.setdefault(ncvar['ncfile'], []).append(ncvar)
+
+    variable_ids = {}
+    description_ids = {None: None}
+    patterns_described = set()
+
+    with db:
+        _remove_files(db, list(files_removed) + list(files))
+
+        for run in runs_removed:
+            experiment_id, run_id = _run_id(db, run)
+            _execute(db, _delete_run, {'run_id': run_id})
+        if len(runs_removed) > 0:
+            _execute(db, _delete_empty_experiments)
+            _execute(db, _delete_orphan_pattern_variables)
+
+        for ncfile, records in files.items():
+            experiment_id, run_id = _run_id(db, records[0])
+            file_id = _execute(db, _insert_file,
+                               dict(_file_defaults, **records[0],
+                                    run_id=run_id,
+                                    experiment_id=experiment_id)).lastrowid
+
+            file_variables = []
+            for record in records:
+                variable = record['variable']
+                if variable not in variable_ids:
+                    variable_ids[variable] = _get_id(db, _insert_variable,
+                                                     _select_variable, record)
+                file_variables.append(dict(_variable_defaults, **record,
+                                           file_id=file_id,
+                                           variable_id=variable_ids[variable],
+                                           experiment_id=experiment_id))
+            _execute(db, _insert_file_variable, file_variables)
+
+            pattern = (experiment_id, records[0]['basename_pattern'])
+            if pattern not in patterns_described and 'dtype' in records[0]:
+                patterns_described.add(pattern)
+                for record in file_variables:
+                    description = _description(record['variable'],
+                                               record['attributes'])
+                    if description not in description_ids:
+                        params = dict(zip(('variable',) + described_attributes,
+                                          description))
+                        description_ids[description] = _get_id(
+                            db, _insert_description, _select_description, params)
+                    record['description_id'] = description_ids[description]
+                _execute(db, _replace_pattern_variable, file_variables)
+
+        for run in runs_indexed:
+            experiment_id, run_id = _run_id(db, run)
+            _execute(db, _mark_run_indexed, {'run_id': run_id})
+
+
+# experiments matching an experiment name, optionally within a configuration
+_experiment_ids = ('SELECT id FROM experiments WHERE experiment = :experiment '
+                   'AND (:configuration IS NULL OR configuration = :configuration)')
+
+_select_configurations = text(
+    'SELECT DISTINCT configuration FROM experiments ORDER BY configuration')
+
+_select_experiments = text(
+    'SELECT DISTINCT experiment FROM experiments '
+    'WHERE configuration = :configuration ORDER BY experiment')
+
+_select_basename_patterns = text(
+    'SELECT DISTINCT basename_pattern FROM files '
+    'WHERE experiment_id IN ({}) ORDER BY basename_pattern'.format(_experiment_ids))
+
+# one probe of the covering index per known variable name, rather than
+# a scan over every occurrence in the experiment
+_select_variables = text(
+    'SELECT variable FROM variables '
+    'WHERE EXISTS (SELECT 1 FROM file_variables '
+    'WHERE experiment_id IN ({}) '
+    'AND basename_pattern = :basename_pattern '
+    'AND variable_id = variables.id) '
+    'ORDER BY variable'.format(_experiment_ids))
+
+# the last :n files (all of them if :n is -1) containing any of :variables
+# and overlapping the time values [:time_min, :time_max), with the
+# dimensions and chunking of the first of :variables they contain
+_first_variable = """
+    (SELECT {column} FROM file_variables
+     WHERE file_id = selected.id
+     AND variable_id IN (SELECT id FROM variables WHERE variable IN :variables)
+     ORDER BY variable_id = (SELECT id FROM variables WHERE variable = :variable) DESC
+     LIMIT 1)"""
+
+_select_ncfiles = text("""
+    WITH selected AS (
+        SELECT DISTINCT files.id, files.ncfile
+        FROM file_variables
+        JOIN files ON files.id = file_variables.file_id
+        WHERE file_variables.experiment_id IN ({experiment_ids})
+        AND file_variables.basename_pattern = :basename_pattern
+        AND file_variables.variable_id IN (
+            SELECT id FROM variables WHERE variable IN :variables)
+        AND (:time_min IS NULL OR files.time_last IS NULL
+             OR files.time_last >= :time_min)
+        AND (:time_max IS NULL OR files.time_first IS NULL
+             OR files.time_first < :time_max)
+        ORDER BY files.ncfile DESC
+        LIMIT :n)
+    SELECT selected.ncfile, {dimensions} AS dimensions, {chunking} AS chunking
+    FROM selected
+    ORDER BY selected.ncfile""".format(
+        experiment_ids=_experiment_ids,
+        dimensions=_first_variable.format(column='dimensions'),
+        chunking=_first_variable.format(column='chunking'))
+).bindparams(bindparam('variables', expanding=True))
+
+# units of the time axis of the first file with one
+_select_time_units = text(
+    'SELECT time_units FROM files '
+    'WHERE experiment_id IN ({}) '
+    'AND basename_pattern = :basename_pattern '
+    'AND time_units IS NOT NULL '
+    'ORDER BY ncfile LIMIT 1'.format(_experiment_ids))
+
+_select_pattern_variables = text(
+    'SELECT variables.variable, pattern_variables.dimensions, '
+    'pattern_variables.dtype, pattern_variables.decoded_dtype, '
+    'pattern_variables.fill_value, '
+    'pattern_variables.attributes, pattern_variables.coordinate_values '
+    'FROM pattern_variables '
+    'JOIN variables ON variables.id = pattern_variables.variable_id '
+    'WHERE pattern_variables.experiment_id IN ({}) '
+    'AND pattern_variables.basename_pattern = :basename_pattern'.format(_experiment_ids))
+
+_select_file_layout = text(
+    'SELECT files.ncfile, files.time_values, variables.variable, '
+    'file_variables.shape, file_variables.chunking '
+    'FROM files '
+    'JOIN file_variables ON file_variables.file_id = files.id '
+    'JOIN variables ON variables.id = file_variables.variable_id '
+    'WHERE files.ncfile IN :ncfiles AND variables.variable IN :variables'
+).bindparams(bindparam('ncfiles', expanding=True),
+             bindparam('variables', expanding=True))
+
+_select_fingerprints = text(
+    'SELECT ncfile, size, mtime FROM files WHERE ncfile IN :ncfiles'
+).bindparams(bindparam('ncfiles', expanding=True))
+
+_select_pattern_summaries = text(
+    'SELECT basename_pattern, COUNT(*), TOTAL(size), MIN(mtime), MAX(mtime) '
+    'FROM files WHERE experiment_id IN ({}) '
+    'GROUP BY basename_pattern ORDER BY basename_pattern'.format(_experiment_ids))
+
+_select_scalar_variables = text(
+    'SELECT DISTINCT variables.variable '
+    'FROM file_variables '
+    'JOIN files ON files.id = file_variables.file_id '
+    'JOIN experiments ON experiments.id = files.experiment_id '
+    'JOIN variables ON variables.id = file_variables.variable_id '
+    'WHERE files.basename = :basename '
+    'AND file_variables.dimensions = :dimensions '
+    'AND experiments.configuration = :configuration')
+
+# variables found by Catalog.search, with the conditions on the
+# descriptions, and the other filters, filled in
+_search_variables = """
+    SELECT experiments.configuration, experiments.experiment,
+           pattern_variables.basename_pattern, descriptions.variable,
+           descriptions.long_name, descriptions.units,
+           descriptions.standard_name, pattern_variables.dimensions
+    FROM descriptions
+    JOIN pattern_variables ON pattern_variables.description_id = descriptions.id
+    JOIN experiments ON experiments.id = pattern_variables.experiment_id
+    WHERE {conditions}
+    ORDER BY experiments.configuration, experiments.experiment,
+             pattern_variables.basename_pattern, descriptions.variable"""
+
+
+def _like_pattern(pattern):
+    """
+    Returns a LIKE pattern matching (at least) the names matched by the
+    glob pattern, for a search of the trigram index.
+    """
+    like = pattern.replace('*', '%').replace('?', '_')
+    return re.sub(r'\[[^]]*\]', '_', like)
+
+
+def _contains_pattern(word):
+    """
+    Returns a LIKE pattern (with escape character \\) matching strings
+    containing word.
+    """
+    return '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', word))
+
+
+def _match_phrases(words):
+    """
+    Returns an FTS5 query matching all of the words (as literal strings).
+    """
+    return ' '.join('"{}"'.format(word.replace('"', '""'))
+                    for word in words.split())
+
+
+def split_expt(expt):
+    """
+    Returns (configuration, experiment) for expt, which may be given
+    as either "experiment" or "configuration/experiment".
+    """
+    if '/' in expt:
+        configuration, experiment = expt.split('/')
+    else:
+        configuration, experiment = None, expt
+
+    return configuration, experiment
+
+
+# seconds between checks of the central database for changes, while
+# lookups are answered from a snapshot
+snapshot_check_interval = 10
+
+
+def _sqlite_path(url):
+    """
+    Returns the path of the SQLite database at url, or None if url is
+    not that of an SQLite file.
+    """
+    prefix = 'sqlite:///'
+    if url.startswith(prefix) and url[len(prefix):] not in ('', ':memory:'):
+        return url[len(prefix):]
+    return None
+
+
+def _source_stamp(path):
+    """
+    Returns a stamp of the SQLite database at path (the size and
+    modification time of the file and of its write-ahead log), which
+    changes whenever the database is written.
+    """
+    stamp = []
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+        except OSError:
+            st = None
+        # an empty log is left by connections that have not written
+        if st is None or st.st_size == 0:
+            stamp.append(None)
+        else:
+            stamp.append([st.st_size, st.st_mtime_ns])
+    return json.dumps(stamp)
+
+
+def _read_only(path):
+    return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+
+def private_dir(path):
+    """
+    Creates the directory path, accessible only to the user, if it does
+    not exist, and returns it.  Raises PermissionError if path, or the
+    directory holding it, could be changed by anyone else (other than
+    root, or within a sticky directory such as /tmp).
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    uid = os.getuid()
+
+    st = os.stat(path)
+    if st.st_uid != uid or st.st_mode & 0o022:
+        raise PermissionError(errno.EACCES, 'Directory is not private', path)
+    parent = os.path.dirname(os.path.abspath(path))
+    st = os.stat(parent)
+    if (st.st_uid not in (uid, 0)
+            or st.st_mode & 0o022 and not st.st_mode & stat.S_ISVTX):
+        raise PermissionError(errno.EACCES, 'Directory is not private', parent)
+    return path
+
+
+def _owned(path):
+    try:
+        return os.stat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+def snapshot_stamp(path):
+    """
+    Returns the stamp of the source of the snapshot at path (see
+    take_snapshot), or None if there is no valid snapshot there.
+    """
+    try:
+        with contextlib.closing(_read_only(path)) as conn:
+            return conn.execute('SELECT stamp FROM snapshot_stamp').fetchone()[0]
+    except (sqlite3.Error, TypeError):
+        return None
+
+
+def take_snapshot(source, path):
+    """
+    Copies the SQLite database at source to path and returns the stamp
+    of source, which is recorded in the copy.
+
+    The copy is made with SQLite's backup API, so is consistent even if
+    source is being written, and is written to a temporary file renamed
+    over path, so readers of path see either the old or the new copy.
+    The stamp is taken before copying, so that writes made meanwhile
+    show as changes at the next check.
+    """
+    stamp = _source_stamp(source)
+    directory = private_dir(os.path.dirname(os.path.abspath(path)))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        with contextlib.closing(_read_only(source)) as src, \
+             contextlib.closing(sqlite3.connect(tmp)) as dst:
+            src.backup(dst)
+            # readers then need no log, which could be left from the old copy
+            dst.execute('PRAGMA journal_mode = DELETE')
+            dst.execute('CREATE TABLE snapshot_stamp (source TEXT, stamp TEXT)')
+            dst.execute('INSERT INTO snapshot_stamp VALUES (?, ?)', (source, stamp))
+            dst.commit()
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return stamp
+
+
+def _parse_chunking(chunking):
+    """
+    Returns the storage chunking recorded as str(var.chunking()): a
+    tuple of chunk sizes, 'contiguous', or None if unknown.
+    """
+    if chunking is None or chunking == 'contiguous':
+        return chunking
+    try:
+        return tuple(ast.literal_eval(chunking))
+    except (ValueError, SyntaxError, TypeError):
+        return None
+
+
+class Catalog(object):
+    """
+    Lookups in the catalog database at url.
+
+    A Catalog connects on first use and keeps its connection pool for
+    later lookups, giving each thread its own pooled connection.  The
+    schema is created or migrated when the catalog first connects.
+
+    Given a snapshot_dir (typically on a node-local disk, such as
+    $TMPDIR), lookups in an SQLite catalog are answered from a snapshot
+    of the database there, shared by the user's processes on the node.
+    snapshot_dir must be private to the user (see private_dir), and
+    only snapshots belonging to the user are read.  The
+    central database is checked for changes (by the size and
+    modification time of its file) at most every snapshot_check_interval
+    seconds, and after any use of db, and the snapshot taken afresh
+    whenever it has changed.
+    """
+
+    def __init__(self, url, snapshot_dir=None):
+        self.url = url
+        self.snapshot_dir = snapshot_dir
+        self._db = None
+        self._lock = threading.RLock()
+
+        self.snapshot_path = None
+        self._snapshot = None
+        self._snapshot_stamp = None
+        self._checked = None
+        source = _sqlite_path(url)
+        if snapshot_dir is not None and source is not None:
+            source = os.path.abspath(source)
+            name = '{}-{}'.format(hashlib.sha1(source.encode('utf-8')).hexdigest()[:12],
+                                  os.path.basename(source))
+            self.snapshot_path = os.path.join(snapshot_dir, name)
+
+    def __repr__(self):
+        return 'Catalog({!r})'.format(self.url)
+
+    @property
+    def db(self):
+        """
+        The dataset.Database of the central catalog, holding the
+        connection pool, through which the index is written.
+        """
+        with self._lock:
+            if self._db is None:
+                db = dataset.connect(self.url)
+                create_schema(db)
+                self._db = db
+            # what is written here is looked up in a new snapshot
+            self._checked = None
+
+        return self._db
+
+    @property
+    def read_db(self):
+        """
+        The dataset.Database lookups are made in: the snapshot, if there
+        is one, and otherwise the central catalog.
+        """
+        if self.snapshot_path is None:
+            return self.db
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._snapshot is None or self._checked is None
+                    or now - self._checked > snapshot_check_interval):
+                try:
+                    self._refresh_snapshot()
+                except (OSError, sqlite3.Error) as e:
+                    logging.warning('Unable to keep a snapshot of {} in {}, '
+                                    'reading it directly: {}'.format(
+                                        self.url, self.snapshot_dir, e))
+                    self.snapshot_path = None
+                    return self.db
+                self._checked = now
+
+            return self._snapshot
+
+    def _refresh_snapshot(self):
+        """
+        Takes a new snapshot if the central database has changed since
+        the current one, and connects to the snapshot if it is new.
+        """
+        source = os.path.abspath(_sqlite_path(self.url))
+        if not os.path.exists(source):
+            self.db
+        stamp = _source_stamp(source)
+        if self._snapshot is not None and stamp == self._snapshot_stamp:
+            return
+
+        # another process on the node may have taken it already
+        private_dir(self.snapshot_dir)
+        if (not _owned(self.snapshot_path)
+                or snapshot_stamp(self.snapshot_path) != stamp):
+            take_snapshot(source, self.snapshot_path)
+            with contextlib.closing(_read_only(self.snapshot_path)) as conn:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                # an original ncfiles index is migrated by connecting centrally
+                self.db
+                take_snapshot(source, self.snapshot_path)
+
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = dataset.connect(
+            'sqlite:///file:{}?mode=ro&uri=true'.format(self.snapshot_path),
+            ensure_schema=False, sqlite_wal_mode=False)
+        self._snapshot_stamp = snapshot_stamp(self.snapshot_path)
+
+    def close(self):
+        """
+        Closes all connections to the database and snapshot.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
+
+    def query(self, statement, **params):
+        """
+        Runs statement with bound params and returns a list of rows.
+        """
+        return list(_execute(self.read_db, statement, params))
+
+    def configurations(self):
+        """
+        Returns list of all configurations.
+        """
+        return [row[0] for row in self.query(_select_configurations)]
+
+    def experiments(self, configuration):
+        """
+        Returns list of all experiments for the given configuration.
+        """
+        rows = self.query(_select_experiments, configuration=configuration)
+        return [row[0] for row in rows]
+
+    def basename_patterns(self, expt):
+        """
+        Returns list of basename patterns for the given experiment.
+        """
+        configuration, experiment = split_expt(expt)
+        rows = self.query(_select_basename_patterns,
+                          configuration=configuration, experiment=experiment)
+        return [row[0] for row in rows]
+
+    def variables(self, expt, basename_pattern):
+        """
+        Returns list of variables available in the given experiment
+        and basename pattern.
+        """
+        configuration, experiment = split_expt(expt)
+        rows = self.query(_select_variables,
+                          configuration=configuration, experiment=experiment,
+                          basename_pattern=basename_pattern)
+        return [row[0] for row in rows]
+
+    def ncfiles(self, expt, basename_pattern, variables, n=None,
+                time_min=None, time_max=None):
+        """
+        Returns a list of (ncfile, dimensions, chunking) in order of
+        ncfile for the files of the given experiment and basename
+        pattern that contain any of variables.  The dimensions and
+        chunking are those of the first of variables in each file.
+
+        If time_min or time_max are given, only files whose time axis
+        overlaps [time_min, time_max) are returned.  These are raw time
+        values, in the units of the files.  Files indexed without time
+        information are always returned.
+
+        If n is given, only the last n (matching) files are returned.
+        """
+        configuration, experiment = split_expt(expt)
+        variables = list(variables)
+        rows = self.query(_select_ncfiles,
+                          configuration=configuration, experiment=experiment,
+                          basename_pattern=basename_pattern,
+                          variables=variables,
+                          variable=variables[0],
+                          n=-1 if n is None else n,
+                          time_min=time_min, time_max=time_max)
+        return [tuple(row) for row in rows]
+
+    def time_units(self, expt, basename_pattern):
+        """
+        Returns the units of the time axis of the first file of the given
+        experiment and basename pattern, or None if it is not known.
+        """
+        configuration, experiment = split_expt(expt)
+        rows = self.query(_select_time_units,
+                          configuration=configuration, experiment=experiment,
+                          basename_pattern=basename_pattern)
+        return rows[0][0] if len(rows) > 0 else None
+
+    def pattern_variables(self, expt, basename_pattern):
+        """
+        Returns a dictionary describing each variable of the given
+        experiment and basename pattern, as found in the most recently
+        indexed file, with keys dimensions (a tuple), dtype,
+        decoded_dtype (that of the variable opened with xarray),
+        fill_value, attributes (a dictionary) and coordinate_values, an
+        array holding the values of static coordinates and None for
+        other variables.
+
+        Variables indexed without this information are left out.
+        """
+        configuration, experiment = split_expt(expt)
+        rows = self.query(_select_pattern_variables,
+                          configuration=configuration, experiment=experiment,
+                          basename_pattern=basename_pattern)
+
+        pattern_variables = {}
+        for (variable, dimensions, dtype, decoded_dtype, fill_value,
+             attributes, values) in rows:
+            if dtype is None:
+                continue
+            if values is not None:
+                values = np.frombuffer(values, dtype=dtype)
+            pattern_variables[variable] = {
+                'dimensions': ast.literal_eval(dimensions),
+                'dtype': np.dtype(dtype),
+                'decoded_dtype': np.dtype(decoded_dtype),
+                'fill_value': fill_value,
+                'attributes': json.loads(attributes),
+                'coordinate_values': values,
+            }
+
+        return pattern_variables
+
+    def file_layout(self, ncfiles, variables):
+        """
+        Returns a dictionary mapping each of ncfiles to a tuple of
+        (time_values, shapes, chunking), where time_values is an array
+        of the values of its time axis (or None), and shapes and chunking
+        are dictionaries giving the shape and storage chunking (a tuple,
+        or 'contiguous') of each of variables found in the file.
+        """
+        ncfiles = list(ncfiles)
+        variables = list(variables)
+
+        layout = {}
+        for i in range(0, len(ncfiles), 500):
+            rows = self.query(_select_file_layout,
+                              ncfiles=ncfiles[i:i+500], variables=variables)
+            for ncfile, time_values, variable, shape, chunking in rows:
+                if ncfile not in layout:
+                    if time_values is not None:
+                        time_values = np.frombuffer(time_values, dtype='f8')
+                    layout[ncfile] = (time_values, {}, {})
+                if shape is not None:
+                    layout[ncfile][1][variable] = ast.literal_eval(shape)
+                    layout[ncfile][2][variable] = _parse_chunking(chunking)
+
+        return layout
+
+    def fingerprint(self, ncfiles):
+        """
+        Returns a hash of the size and modification time recorded for
+        each of ncfiles, which changes whenever any of them is re-indexed
+        after changing.
+        """
+        ncfiles = sorted(ncfiles)
+        fingerprints = {}
+        for i in range(0, len(ncfiles), 500):
+            for ncfile, size, mtime in self.query(_select_fingerprints,
+                                                  ncfiles=ncfiles[i:i+500]):
+                fingerprints[ncfile] = (size, mtime)
+
+        sha = hashlib.sha1()
+        for ncfile in ncfiles:
+            sha.update(repr((ncfile, fingerprints.get(ncfile))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def experiment_fingerprint(self, expt, basename_patterns=None):
+        """
+        Returns a hash of the number, total size and range of modification
+        times of the files of the given experiment (only those of
+        basename_patterns, if given), which changes when files are added,
+        removed or re-indexed after changing.
+        """
+        configuration, experiment = split_expt(expt)
+        rows = self.query(_select_pattern_summaries,
+                          configuration=configuration, experiment=experiment)
+
+        sha = hashlib.sha1()
+        for row in rows:
+            if basename_patterns is None or row[0] in basename_patterns:
+                sha.update(repr(tuple(row)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def scalar_variables(self, configuration):
+        """
+        Returns list of variables in ocean_scalar.nc files of the given
+        configuration.
+        """
+        rows = self.query(_select_scalar_variables,
+                          basename='ocean_scalar.nc',
+                          dimensions=str(('time', 'scalar_axis')),
+                          configuration=configuration)
+        return [row[0] for row in rows]
+
+    def search(self, variable=None, words=None, units=None, configuration=None):
+        """
+        Returns a list of the variables of every experiment and basename
+        pattern matching all of the conditions given, as dictionaries of
+        configuration, experiment, basename_pattern, variable, long_name,
+        units, standard_name and dimensions (a tuple).  Attributes a
+        variable does not have are given as empty strings.
+
+        Parameters
+        ----------
+        variable : str, optional
+            Glob pattern (with *, ? and [...]) of variable names, such
+            as '*trans*int_z'.
+        words : str, optional
+            Words (of at least three characters) found anywhere in the
+            name, long_name, units or standard_name, in any case.
+        units : str, optional
+            Units, exactly as in the files.
+        configuration : str, optional
+            Configuration the experiments belong to.
+
+        The variables are found in a single query, through the full-text
+        index of their descriptions if the catalog has one (see
+        trigram_search), and otherwise by scanning the descriptions.
+        """
+        indexed = _has_table(self.read_db, 'variable_search')
+        search, conditions, params = [], [], {}
+        if variable is not None:
+            if indexed:
+                search.append('variable_search.variable LIKE :like')
+                params['like'] = _like_pattern(variable)
+            conditions.append('descriptions.variable GLOB :variable')
+            params['variable'] = variable
+        if words is not None and indexed:
+            search.append('variable_search MATCH :words')
+            params['words'] = _match_phrases(words)
+        elif words is not None:
+            for i, word in enumerate(words.split()):
+                conditions.append('({})'.format(' OR '.join(
+                    "descriptions.{} LIKE :word{} ESCAPE '\\'".format(column, i)
+                    for column in ('variable', 'long_name', 'units', 'standard_name'))))
+                params['word{}'.format(i)] = _contains_pattern(word)
+        if units is not None:
+            conditions.append('descriptions.units = :units')
+            params['units'] = units
+        if configuration is not None:
+            conditions.append('experiments.configuration = :configuration')
+            params['configuration'] = configuration
+        if len(search) > 0:
+            conditions.insert(0, 'descriptions.id IN (SELECT rowid FROM variable_search '
+                                 'WHERE {})'.format(' AND '.join(search)))
+
+        statement = _search_variables.format(
+            conditions=' AND '.join(conditions) if len(conditions) > 0 else '1')
+        columns = ('configuration', 'experiment', 'basename_pattern', 'variable',
+                   'long_name', 'units', 'standard_name', 'dimensions')
+        results = []
+        for row in self.query(statement, **params):
+            result = dict(zip(columns, row))
+            result['dimensions'] = ast.literal_eval(result['dimensions'])
+            results.append(result)
+        return results
@@ -0,0 +1,161 @@
+"""
+Planning dask chunks from the storage chunking of netCDF variables.
+
+Using the HDF5 chunking of the files directly as dask chunks often
+gives tens of thousands of tiny tasks per variable.  plan_chunks
+instead grows the storage chunks, by whole multiples so that no storage
+chunk is split between dask chunks, until each dask chunk holds about
+target_chunk_bytes.  Along time, chunks may span several files.
+"""
+
+import os
+
+import numpy as np
+from dask.utils import format_bytes, parse_bytes
+
+# The size of dask chunk aimed for, unless given to plan_chunks
+target_chunk_bytes = parse_bytes(os.environ.get('COSIMA_COOKBOOK_CHUNK_SIZE', '128MiB'))
+
+
+class ChunkPlan(object):
+    """
+    The chunks planned for a variable, and the reasons for them.
+
+    chunks is a tuple with the chunk sizes along each dimension, as
+    taken by dask.array.
+    """
+
+    def __init__(self, variable, dimensions, chunks, itemsize, reasons):
+        self.variable = variable
+        self.dimensions = tuple(dimensions)
+        self.chunks = chunks
+        self.itemsize = itemsize
+        self.reasons = reasons
+
+    @property
+    def nchunks(self):
+        return int(np.prod([len(c) for c in self.chunks]))
+
+    @property
+    def chunk_bytes(self):
+        return int(np.prod([max(c) for c in self.chunks])) * self.itemsize
+
+    def __str__(self):
+        lines = ['Chunks for {}: {} chunks of up to {}'.format(
+            self.variable, self.nchunks, format_bytes(self.chunk_bytes))]
+        lines.extend('  {}: {}'.format(dim, reason)
+                     for dim, reason in zip(self.dimensions, self.reasons))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<ChunkPlan {}: {}>'.format(self.variable, dict(zip(self.dimensions,
+                                                                    self.chunks)))
+
+
+def _split(length, size):
+    chunks = (size,) * (length // size)
+    if length % size:
+        chunks += (length % size,)
+    return chunks
+
+
+def _time_chunks(file_lengths, storage, steps):
+    """
+    Returns chunks along time holding about steps time steps, in
+    multiples of the storage chunk within each file, or whole files.
+    """
+    if all(steps >= length for length in file_lengths):
+        # whole files, as many as fit
+        chunks = []
+        for length in file_lengths:
+            if len(chunks) > 0 and chunks[-1] + length <= steps:
+                chunks[-1] += length
+            else:
+                chunks.append(length)
+        return tuple(chunks)
+
+    size = max(storage, steps // storage * storage)
+    return tuple(chunk for length in file_lengths for chunk in _split(length, size))
+
+
+def plan_chunks(variable, dimensions, shape, dtype, storage_chunks=None,
+                chunks=None, file_lengths=None, target_bytes=None):
+    """
+    Plans dask chunks for a variable of the given dimensions, shape and
+    dtype stored in chunks of storage_chunks (None if not chunked).
+
+    chunks may fix the chunk size along some dimensions, as a dictionary
+    (None meaning the whole dimension).  The other dimensions, from the
+    last to the first and time at the end, are given whole multiples of
+    their storage chunks until the chunks hold about target_bytes
+    (target_chunk_bytes by default).  file_lengths are the lengths along
+    time of the files making up the variable: chunks along time do not
+    split storage chunks in any file, and span several (whole) files
+    where they are small.
+
+    Returns a ChunkPlan.
+    """
+    if target_bytes is None:
+        target_bytes = target_chunk_bytes
+    if isinstance(target_bytes, str):
+        target_bytes = parse_bytes(target_bytes)
+    if chunks is None:
+        chunks = {}
+    itemsize = np.dtype(dtype).itemsize
+
+    if storage_chunks is None or isinstance(storage_chunks, str):
+        storage_chunks = shape
+        storage = 'contiguous'
+    else:
+        storage = 'storage chunk'
+    if 'time' in dimensions and file_lengths is None:
+        file_lengths = [shape[dimensions.index('time')]]
+
+    sizes = {}
+    reasons = {}
+    for dim, length, stored in zip(dimensions, shape, storage_chunks):
+        if dim in chunks:
+            size = chunks[dim]
+            sizes[dim] = length if size is None or size < 0 else min(size, length)
+            reasons[dim] = '{} as requested'.format(sizes[dim])
+        else:
+            sizes[dim] = max(1, min(stored, length))
+
+    def chunk_bytes():
+        return int(np.prod(list(sizes.values()))) * itemsize
+
+    free = [dim for dim in reversed(dimensions) if dim not in chunks and dim != 'time']
+    for dim, length, stored in reversed(list(zip(dimensions, shape, storage_chunks))):
+        if dim not in free:
+            continue
+        stored = sizes[dim]
+        others = chunk_bytes() // stored
+        multiple = max(1, target_bytes // max(1, others * stored))
+        sizes[dim] = min(length, stored * multiple)
+        if sizes[dim] == length:
+            reasons[dim] = 'whole dimension ({})'.format(length)
+        else:
+            reasons[dim] = '{} ({} x {} of {})'.format(sizes[dim], sizes[dim] // stored,
+                                                      storage, stored)
+
+    planned = {dim: _split(length, sizes[dim]) if length > 0 else (0,)
+               for dim, length in zip(dimensions, shape)}
+
+    if 'time' in dimensions and 'time' not in chunks:
+        stored = sizes['time']
+        step_bytes = chunk_bytes() // stored
+        steps = max(stored, target_bytes // max(1, step_bytes))
+        planned['time'] = _time_chunks(file_lengths, stored, steps)
+        files_per_chunk = len(file_lengths) / len(planned['time'])
+        if files_per_chunk > 1:
+            reasons['time'] = 'up to {} steps, {:.3g} files per chunk'.format(
+                max(planned['time']), files_per_chunk)
+        else:
+            reasons['time'] = 'up to {} steps ({} of {} within each file)'.format(
+                max(planned['time']), storage, stored)
+    elif 'time' in chunks:
+        planned['time'] = _time_chunks(file_lengths, 1, sizes['time'])
+
+    return ChunkPlan(variable, dimensions,
+                     tuple(planned[dim] for dim in dimensions),
+                     itemsize, [reasons[dim] for dim in dimensions])
@@ -2,4 +2,4 @@ from . mean_tau_x import mean_tau_x
 from . simple import *
 from . overturning import *
 
-__all__ = ['mean_tau_x', 'annual_scalar', 'drake_passage', 'sea_surface_temperature', 'sea_surface_salinity', 'psi_avg', 'zonal_mean','mixed_layer_depth']
\ No newline at end of file
+__all__ = ['mean_tau_x', 'annual_scalar', 'drake_passage', 'sea_surface_temperature', 'sea_surface_salinity', 'psi_avg', 'psi_sum', 'overturning_metrics', 'zonal_mean','mixed_layer_depth']
\ No newline at end of file
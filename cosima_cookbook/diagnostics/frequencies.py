@@ -0,0 +1,11 @@
+"""
+Resampling frequencies understood by the installed version of pandas.
+"""
+
+import pandas as pd
+
+# pandas 2.2 renamed the year end frequency 'A' to 'YE'
+if tuple(int(v) for v in pd.__version__.split('.')[:2]) >= (2, 2):
+    yearly = 'YE'
+else:
+    yearly = 'A'
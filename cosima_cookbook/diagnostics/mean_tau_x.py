@@ -1,7 +1,7 @@
 from ..memory import memory
 from ..netcdf_index import get_nc_variable
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_month.nc'])
 def mean_tau_x(expt):
     """
     10-year zonal average of horizontal wind stress.
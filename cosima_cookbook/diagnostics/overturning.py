@@ -1,16 +1,40 @@
-from ..netcdf_index import get_nc_variable, get_variables
-from ..memory import memory
-
-@memory.cache
-def psi_avg(expt, n=10):
+import logging
 
-    def op(p):
-        summed_p = p.sum('grid_xt_ocean')
-        #summed_p.attrs['units'] = p.units
-        return summed_p
+import dask
 
+from ..netcdf_index import get_nc_variable, get_variables
+from ..memory import memory
+from .frequencies import yearly
+
+# The latitude, the lightest potential density and the reduction over
+# density of each of the standard overturning metrics.
+overturning_sections = {
+    'aabw': (-55, 1036, 'min'),
+    'amoc': (26, 1035.5, 'max'),
+    'amoc_south': (-35, 1035.5, 'max'),
+}
+
+three_yearly = '3' + yearly
+
+
+def psi_sum(expt, n=None):
+    """
+    Overturning streamfunction in density coordinates.
+
+    Parameters
+    ----------
+    expt : str
+        Experiment name.
+    n : int, optional
+        Only use the last n files.
+
+    Returns
+    -------
+    xarray
+        Lazy psi_sum(time, potrho, grid_yu_ocean) in Sv, summed zonally
+        and including the GM contribution where there is one.
+    """
     psi = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho',
-                       #   op=op,
                           chunks={'potrho': None}, n=n,
                           time_units = 'days since 1700-01-01')
     psi = psi.sum('grid_xt_ocean')
@@ -19,52 +43,8 @@ def psi_avg(expt, n=10):
     if 'ty_trans_rho_gm' in varlist:
         GM = True
         psiGM = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho_gm',
-                          #    op=op,
-                              chunks={'potrho': None}, n=n,
-                              time_units = 'days since 1700-01-01')
-        psiGM = psiGM.sum('grid_xt_ocean')
-    else:
-        GM = False
-
-    #if psi.units == 'kg/s':
-        #print('WARNING: Changing units for ', expt)
-    # assume units of kg/s, convert to Sv.
-    psi = psi*1.0e-9
-    if GM:
-        psiGM = psiGM*1.0e-9
-
-    psi_avg = psi.cumsum('potrho').mean('time') - \
-                psi.sum('potrho').mean('time')
-    if GM:
-        psi_avg = psi_avg + psiGM.mean('time')
-
-    psi_avg.load()
-
-    return psi_avg
-
-
-@memory.cache
-def calc_aabw(expt):
-    print('Calculating {} timeseries of AABW transport at 55S '.format(expt))
-
-    def op(p):
-        summed_p = p.sum('grid_xt_ocean')
-        #summed_p.attrs['units'] = p.units
-        return summed_p
-
-    psi = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho',
-                          #op=op,
-                          chunks={'potrho': None},
-                          time_units = 'days since 1700-01-01')
-    psi = psi.sum('grid_xt_ocean')
-    
-    varlist = get_variables(expt, 'ocean.nc')
-    if 'ty_trans_rho_gm' in varlist:
-        GM = True
-        psiGM = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho_gm',
-                              #op=op,
-                              chunks={'potrho': None},
-                              time_units = 'days since 1700-01-01')
+                                chunks={'potrho': None}, n=n,
+                                time_units = 'days since 1700-01-01')
         psiGM = psiGM.sum('grid_xt_ocean')
     else:
         GM = False
@@ -72,7 +52,6 @@ def calc_aabw(expt):
     #if psi.units == 'kg/s':
         #print('WARNING: Changing units for ', expt)
     # assume units of kg/s, convert to Sv.
-
     psi = psi*1.0e-9
     if GM:
         psiGM = psiGM*1.0e-9
@@ -81,103 +60,72 @@ def calc_aabw(expt):
     if GM:
         psi_sum = psi_sum + psiGM
 
-    psi_aabw = psi_sum.sel(method='Nearest',grid_yu_ocean=-55).sel(potrho=slice(1036,None))\
-                .min('potrho').resample('3A',dim='time')
-    psi_aabw = psi_aabw.compute()
+    return psi_sum
 
-    return psi_aabw
 
+@memory.cache(basename_patterns=['ocean.nc'])
+def psi_avg(expt, n=10):
 
-@memory.cache
-def calc_amoc(expt):
-    print('Calculating {} timeseries of AMOC transport at 26N '.format(expt))
+    psi_avg = psi_sum(expt, n=n).mean('time')
+    psi_avg.load()
 
-    def op(p):
-        summed_p = p.sum('grid_xt_ocean')
-        #summed_p.attrs['units'] = p.units
-        return summed_p
+    return psi_avg
 
-    psi = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho',
-                          #op=op,
-                          chunks={'potrho': None},
-                          time_units = 'days since 1700-01-01')
-    psi = psi.sum('grid_xt_ocean')
 
-    varlist = get_variables(expt, 'ocean.nc')
-    if 'ty_trans_rho_gm' in varlist:
-        GM = True
-        psiGM = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho_gm',
-                              #op=op,
-                              chunks={'potrho': None},
-                              time_units = 'days since 1700-01-01')
-        psiGM = psiGM.sum('grid_xt_ocean')
-    else:
-        GM = False
+@memory.cache(basename_patterns=['ocean.nc'])
+def overturning_metrics(expt, sections=None):
+    """
+    Timeseries of overturning metrics, all computed in a single pass
+    over the transports.
 
-    #if psi.units == 'kg/s':
-        #print('WARNING: Changing units for ', expt)
-    # assume units of kg/s, convert to Sv.
+    Parameters
+    ----------
+    expt : str
+        Experiment name.
+    sections : dict, optional
+        Maps the name of each metric to (latitude, lightest potrho,
+        'min' or 'max'), defaulting to overturning_sections.
 
-    psi = psi*1.0e-9
-    if GM:
-        psiGM = psiGM*1.0e-9
+    Returns
+    -------
+    dict
+        3-yearly averages of each metric, in Sv, by name.
+    """
+    if sections is None:
+        sections = overturning_sections
 
-    psi_sum = psi.cumsum('potrho') - psi.sum('potrho')
-    if GM:
-        psi_sum = psi_sum + psiGM
+    psi = psi_sum(expt)
 
-    psi_amoc = psi_sum.sel(method='Nearest',grid_yu_ocean=26).sel(potrho=slice(1035.5,None))\
-                .max('potrho').resample('3A',dim='time')
-    psi_amoc = psi_amoc.compute()
+    metrics = {}
+    for name, (latitude, potrho, reduction) in sections.items():
+        section = psi.sel(method='Nearest', grid_yu_ocean=latitude)\
+                     .sel(potrho=slice(potrho, None))
+        metrics[name] = getattr(section, reduction)('potrho')\
+                            .resample(time=three_yearly).mean()
 
-    return psi_amoc
+    # one compute shares the reads and zonal sums between the metrics
+    return dict(zip(metrics, dask.compute(*metrics.values())))
 
 
-@memory.cache
-def calc_amoc_south(expt):
-    print('Calculating {} timeseries of AMOC transport at 35S '.format(expt))
+def calc_aabw(expt):
+    logging.debug('Calculating {} timeseries of AABW transport at 55S'.format(expt))
 
-    def op(p):
-        summed_p = p.sum('grid_xt_ocean')
-        #summed_p.attrs['units'] = p.units
-        return summed_p
+    return overturning_metrics(expt)['aabw']
 
-    psi = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho',
-                          #op=op,
-                          chunks={'potrho': None},
-                          time_units = 'days since 1700-01-01')
-    psi = psi.sum('grid_xt_ocean')
 
-    varlist = get_variables(expt, 'ocean.nc')
-    if 'ty_trans_rho_gm' in varlist:
-        GM = True
-        psiGM = get_nc_variable(expt, 'ocean.nc', 'ty_trans_rho_gm',
-                              #op=op,
-                              chunks={'potrho': None},
-                              time_units = 'days since 1700-01-01')
-        psiGM = psiGM.sum('grid_xt_ocean')
-    else:
-        GM = False
+def calc_amoc(expt):
+    logging.debug('Calculating {} timeseries of AMOC transport at 26N'.format(expt))
 
-    #if psi.units == 'kg/s':
-        #print('WARNING: Changing units for ', expt)
-    # assume units of kg/s, convert to Sv.
-    
-    psi = psi*1.0e-9
-    if GM:
-        psiGM = psiGM*1.0e-9
+    return overturning_metrics(expt)['amoc']
 
-    psi_sum = psi.cumsum('potrho') - psi.sum('potrho')
-    if GM:
-        psi_sum = psi_sum + psiGM
 
-    psi_amoc_south = psi_sum.sel(method='Nearest',grid_yu_ocean=-35).sel(potrho=slice(1035.5,None))\
-                .max('potrho').resample('3A',dim='time')
-    psi_amoc_south = psi_amoc_south.compute()
+def calc_amoc_south(expt):
+    logging.debug('Calculating {} timeseries of AMOC transport at 35S'.format(expt))
+
+    return overturning_metrics(expt)['amoc_south']
 
-    return psi_amoc_south
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean.nc'])
 def zonal_mean(expt, variable, n=10, resolution=1):
 
     zonal_var = get_nc_variable(expt, 'ocean.nc', variable,
@@ -16,6 +16,7 @@
 
 from ..netcdf_index import get_nc_variable, get_variables
 from ..memory import memory
+from .frequencies import yearly
 
 import logging
 
@@ -101,7 +102,7 @@ def transport(expt, transect):
     """
 
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_scalar.nc'])
 def annual_scalar(expt, variables):
     """
     """
@@ -115,7 +116,7 @@ def annual_scalar(expt, variables):
                              )
     
     logging.debug('Resampling in time')
-    annual_average = darray.resample('A', 'time').compute()
+    annual_average = darray.resample(time=yearly).mean().compute()
     
     for v in annual_average.data_vars:
 
@@ -127,7 +128,7 @@ def annual_scalar(expt, variables):
     return annual_average
 
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_month.nc'])
 def zonal_transport(expt, lon, lat):
     """
     Calculate time series of zonal transport across meridional section.
@@ -161,17 +162,17 @@ def zonal_transport(expt, lon, lat):
     tx_trans = tx.sel(xu_ocean=-69, method='nearest')\
         .sel(yt_ocean=slice(-72, -52))
     if tx_trans.units == 'Sv (10^9 kg/s)':
-        transport = tx_trans.sum('yt_ocean').resample('A', 'time')
+        transport = tx_trans.sum('yt_ocean').resample(time=yearly).mean()
     else:
         print('WARNING: Changing units for ', expt)
-        transport = tx_trans.sum('yt_ocean').resample('A', 'time')*1.0e-9
+        transport = tx_trans.sum('yt_ocean').resample(time=yearly).mean()*1.0e-9
 
     transport.load()
 
     return transport
 
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_month.nc'])
 def drake_passage(expt):
     """
     Calculate time series of zonal transport trough Drake Passage.
@@ -189,7 +190,7 @@ def drake_passage(expt):
     return zonal_transport(expt, -69, (-72, -52))
 
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_month.nc'])
 def bering_strait(expt):
     ty = get_nc_variable(expt,'ocean_month.nc',
                          'ty_trans_int_z',
@@ -197,10 +198,10 @@ def bering_strait(expt):
                          time_units = 'days since 1700-01-01')
     ty_trans = ty.sel(yu_ocean=67,method='nearest').sel(xt_ocean=slice(-171,-167))
     if ty_trans.units == 'Sv (10^9 kg/s)':
-        transport = ty_trans.sum('xt_ocean').resample('A','time')
+        transport = ty_trans.sum('xt_ocean').resample(time=yearly).mean()
     else:
         #print('WARNING: Changing units for ', expt)
-        transport = ty_trans.sum('xt_ocean').resample('A','time')*1.0e-9
+        transport = ty_trans.sum('xt_ocean').resample(time=yearly).mean()*1.0e-9
 
     transport.load()
     
@@ -261,7 +262,7 @@ def sea_surface_salinity(expt, resolution=1):
 
     return SSS, SSSdiff
 
-@memory.cache
+@memory.cache(basename_patterns=['ocean_month.nc'])
 def mixed_layer_depth(expt):
     ## Load MLD from expt 
     varlist = get_variables(expt, 'ocean_month.nc')
@@ -1,24 +1,163 @@
 import os, socket, getpass
-from distributed import Client, LocalCluster
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from distributed import Client, LocalCluster, default_client
+from distributed import wait as distributed_wait
 
+from collections import deque
 from itertools import product
+import netCDF4
 import numpy as np
+import psutil
 import xarray as xr
+from dask.base import tokenize
+from dask.utils import format_bytes
 
 from tqdm import tqdm_notebook
 
-def start_cluster(diagnostics_port=0):
-    "Set up a LocalCluster for distributed"
-    
+# the root of the cgroup filesystem, for the limits of batch jobs
+_cgroup_root = '/sys/fs/cgroup'
+
+# fraction of the available memory shared between workers, leaving the
+# rest to the notebook and the scheduler
+memory_fraction = 0.9
+
+# workers per core and threads per worker of each profile of cluster
+cluster_profiles = {
+    # processes of a couple of threads each, as before
+    'default': {'workers_per_core': 0.5, 'threads_per_worker': 2},
+    # a few processes (each with its own HDF5 lock) of many threads, for
+    # reading and simple reductions where workers mostly wait on the disk
+    'io': {'workers_per_core': 0.25, 'threads_per_worker': 8},
+    # a single threaded process per core, for work holding the GIL
+    'compute': {'workers_per_core': 1, 'threads_per_worker': 1},
+}
+
+
+def _read_cgroup(*names):
+    """
+    Returns the contents of the first of the named cgroup files found
+    (under both cgroup v2 and v1 layouts), or None.
+    """
+    for name in names:
+        try:
+            with open(os.path.join(_cgroup_root, name)) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def available_cores():
+    """
+    Returns the number of cores this process may use, within its CPU
+    affinity, any cgroup CPU quota and the ncpus of a PBS job.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count()
+
+    quota = _read_cgroup('cpu.max')
+    if quota is not None:
+        quota, _, period = quota.partition(' ')
+    else:
+        quota, period = (_read_cgroup('cpu/cpu.cfs_quota_us', 'cpu.cfs_quota_us'),
+                         _read_cgroup('cpu/cpu.cfs_period_us', 'cpu.cfs_period_us'))
+    try:
+        if int(quota) > 0:
+            cores = min(cores, max(1, int(quota) // int(period)))
+    except (TypeError, ValueError):
+        pass
+
+    for name in ('PBS_NCPUS', 'NCPUS'):
+        if os.environ.get(name, '').isdigit():
+            cores = min(cores, int(os.environ[name]))
+            break
+
+    return max(1, cores)
+
+
+def available_memory():
+    """
+    Returns the memory in bytes this process may use, within the memory
+    of the host, any cgroup limit and the vmem of a PBS job.
+    """
+    memory = psutil.virtual_memory().total
+
+    limit = _read_cgroup('memory.max', 'memory/memory.limit_in_bytes',
+                         'memory.limit_in_bytes')
+    if limit is not None and limit.isdigit():
+        memory = min(memory, int(limit))
+
+    for name in ('PBS_VMEM', 'PBS_MEM'):
+        if os.environ.get(name, '').isdigit():
+            memory = min(memory, int(os.environ[name]))
+            break
+
+    return memory
+
+
+def cluster_layout(profile='default', cores=None, memory=None):
+    """
+    Returns the n_workers, threads_per_worker and memory_limit (in
+    bytes, per worker) of a LocalCluster of the given profile (one of
+    cluster_profiles) using cores and memory, by default those
+    available.
+    """
+    if profile not in cluster_profiles:
+        raise ValueError('Unknown cluster profile {!r}, expected one of {}'.format(
+            profile, ', '.join(cluster_profiles)))
+    if cores is None:
+        cores = available_cores()
+    if memory is None:
+        memory = available_memory()
+
+    layout = cluster_profiles[profile]
+    n_workers = max(1, int(cores * layout['workers_per_core']))
+    threads_per_worker = max(1, min(layout['threads_per_worker'], cores // n_workers))
+    if profile == 'io':
+        # waiting on the disk, threads may outnumber the cores
+        threads_per_worker = layout['threads_per_worker']
+
+    return {'n_workers': n_workers,
+            'threads_per_worker': threads_per_worker,
+            'memory_limit': int(memory * memory_fraction / n_workers)}
+
+
+def start_cluster(diagnostics_port=0, profile='default', adapt=False,
+                  **kwargs):
+    """
+    Set up a LocalCluster for distributed, laid out by cluster_layout
+    for the cores and memory available (including the limits of a PBS
+    job), and return a Client connected to it.
+
+    profile is 'default', 'io' (for reading many files) or 'compute'
+    (for work holding the GIL).  With adapt=True the cluster starts a
+    single worker and scales up to the layout as work arrives.  Other
+    arguments are passed to LocalCluster, overriding the layout.
+    """
     hostname = socket.gethostname()
-    n_workers = os.cpu_count() // 2
+    layout = cluster_layout(profile)
+    layout.update(kwargs)
+    print('Starting {} workers of {} threads and {} each'.format(
+        layout['n_workers'], layout['threads_per_worker'],
+        format_bytes(layout['memory_limit'])))
+
+    n_workers = layout['n_workers']
+    if adapt:
+        layout['n_workers'] = 1
     cluster = LocalCluster(ip='localhost',
-                       n_workers=n_workers,
-                       diagnostics_port=diagnostics_port,
-                       memory_limit=6e9)
+                           dashboard_address='localhost:{}'.format(diagnostics_port),
+                           **layout)
+    if adapt:
+        cluster.adapt(minimum=1, maximum=n_workers)
     client = Client(cluster)
 
-    params = { 'bokeh_port': cluster.scheduler.services['bokeh'].port,
+    dashboard = cluster.scheduler.services.get('dashboard')
+    if dashboard is None:
+        return client
+
+    params = { 'bokeh_port': dashboard.port,
            'user': getpass.getuser(),
            'scheduler_ip': cluster.scheduler.ip,
            'hostname': hostname, }
@@ -30,28 +169,272 @@ def start_cluster(diagnostics_port=0):
     return client
 
 
-def compute_by_block(dsx):
+# the name under which a DataArray is computed as a Dataset
+_dataarray_variable = '__dataarray__'
+
+
+def _regions(ds):
     """
-    
+    Returns the list of regions (dictionaries of slices by dimension)
+    covering the chunks of ds.
     """
-    
-    # determine index key for each chunk
+    dims = list(ds.chunks)
     slices = []
-    for chunks in dsx.chunks:
-        L  = [0,] + list(np.cumsum(chunks))
-        slices.append( [slice(a, b) 
+    for dim in dims:
+        L  = [0,] + list(np.cumsum(ds.chunks[dim]))
+        slices.append( [slice(a, b)
                         for a,b in (zip(L[:-1], L[1:]))]  )
-    indexes = list(product(*slices))
-    
-    # allocate memory to receive result
+    return [dict(zip(dims, index)) for index in product(*slices)]
+
+
+def _index(var, region):
+    return tuple(region.get(dim, slice(None)) for dim in var.dims)
+
+
+class _MemoryTarget(object):
+    """
+    Receives the blocks of ds into arrays in memory.
+    """
+
+    def __init__(self, ds):
+        self.ds = ds
+        self.arrays = {name: np.zeros(var.shape, dtype=var.dtype)
+                       for name, var in ds.data_vars.items()}
+
+    def write(self, region, block):
+        for name, var in block.data_vars.items():
+            self.arrays[name][_index(var, region)] = var.values
+
+    def result(self):
+        return self.ds.copy(data=self.arrays).load()
+
+
+class _MemmapTarget(_MemoryTarget):
+    """
+    Receives the blocks of a single variable into a memory-mapped .npy file.
+    """
+
+    def __init__(self, ds, path, resume):
+        if len(ds.data_vars) != 1:
+            raise ValueError('Only a single variable can be saved to {}'.format(path))
+        self.ds = ds
+        (name, var), = ds.data_vars.items()
+        mode = 'r+' if resume else 'w+'
+        self.arrays = {name: np.lib.format.open_memmap(path, mode=mode, dtype=var.dtype,
+                                                       shape=var.shape)}
+
+    def write(self, region, block):
+        super().write(region, block)
+        for array in self.arrays.values():
+            array.flush()
+
+    def result(self):
+        return self.ds.copy(data=self.arrays)
+
+
+class _NetCDFTarget(object):
+    """
+    Receives the blocks of ds into a NetCDF file.
+    """
+
+    def __init__(self, ds, path, resume):
+        self.path = path
+        if not resume:
+            xr.Dataset(coords=ds.coords).to_netcdf(path)
+        self.nc = netCDF4.Dataset(path, 'a')
+        for name, var in ds.data_vars.items():
+            if name in self.nc.variables:
+                continue
+            for dim, size in var.sizes.items():
+                if dim not in self.nc.dimensions:
+                    self.nc.createDimension(dim, size)
+            fill_value = np.nan if var.dtype.kind == 'f' else None
+            ncvar = self.nc.createVariable(name, var.dtype, var.dims, zlib=True,
+                                           fill_value=fill_value)
+            ncvar.setncatts({key: value for key, value in var.attrs.items()
+                             if not key.startswith('_')
+                             and isinstance(value, (str, int, float, np.number, np.ndarray))})
+
+    def write(self, region, block):
+        for name, var in block.data_vars.items():
+            self.nc.variables[name][_index(var, region)] = var.values
+        self.nc.sync()
+
+    def result(self):
+        self.nc.close()
+        return xr.open_dataset(self.path, chunks={})
+
+
+class _ZarrTarget(object):
+    """
+    Receives the blocks of ds into a Zarr store.
+    """
+
+    def __init__(self, ds, path, resume):
+        self.path = path
+        if not resume:
+            ds.to_zarr(path, mode='w', compute=False)
+
+    def write(self, region, block):
+        block.drop_vars(list(block.coords)).to_zarr(self.path, region=region)
+
+    def result(self):
+        return xr.open_zarr(self.path)
+
+
+def _target(ds, path, resume):
+    if path is None:
+        return _MemoryTarget(ds)
+    if path.endswith('.npy'):
+        return _MemmapTarget(ds, path, resume)
+    if path.endswith('.zarr'):
+        return _ZarrTarget(ds, path, resume)
+    return _NetCDFTarget(ds, path, resume)
+
+
+def _progress(path, signature):
+    """
+    Returns the set of blocks recorded as done in the progress file at
+    path by an earlier computation with the same signature.
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().split()
+    except OSError:
+        return set()
+    if len(lines) == 0 or lines[0] != signature:
+        return set()
+    return set(int(line) for line in lines[1:])
+
+
+def compute_by_block(dsx, target=None, max_in_flight=None, client=None):
+    """
+    Computes the DataArray or Dataset dsx one chunk at a time, keeping
+    up to max_in_flight chunks (by default, twice the number of threads
+    available) computing at once.
+
+    Chunks are computed on client, or on the current distributed client
+    if there is one, or otherwise by the local dask scheduler.
+
+    By default the result is assembled in memory.  Otherwise it is
+    written as each chunk finishes to target, a .npy file (memory
+    mapped, for a single variable), a .zarr store or otherwise a NetCDF
+    file, and then opened lazily.  The chunks written are recorded in
+    target + '.progress', so that after an interruption calling
+    compute_by_block again with the same dsx and target only computes
+    the remaining chunks.
+    """
     if isinstance(dsx, xr.DataArray):
-        result = xr.zeros_like(dsx).load()
+        name = dsx.name
+        ds = dsx.to_dataset(name=_dataarray_variable)
     else:
-        result = np.zeros(dsx.shape)
-    
-    #evaluate each chunk one at a time
-    for index in tqdm_notebook(indexes, leave=False):
-        block = dsx.__getitem__(index).compute()
-        result.__setitem__(index, block)
-    
-    return result 
\ No newline at end of file
+        ds = dsx
+
+    if client is None:
+        try:
+            client = default_client()
+        except ValueError:
+            client = None
+
+    if max_in_flight is None:
+        if client is not None:
+            max_in_flight = 2 * sum(client.nthreads().values())
+        else:
+            max_in_flight = 2 * os.cpu_count()
+
+    regions = _regions(ds)
+    signature = tokenize(ds)
+    done = set()
+    if target is not None:
+        progress_path = target + '.progress'
+        done = _progress(progress_path, signature)
+        if not os.path.exists(target):
+            done = set()
+        if len(done) == 0:
+            with open(progress_path, 'w') as f:
+                f.write(signature + '\n')
+    output = _target(ds, target, resume=len(done) > 0)
+
+    if client is not None:
+        submit = client.compute
+        wait_first = lambda futures: distributed_wait(futures, return_when='FIRST_COMPLETED')
+        pool = None
+    else:
+        pool = ThreadPoolExecutor(max(1, max_in_flight))
+        submit = lambda block: pool.submit(block.compute)
+        wait_first = lambda futures: wait(futures, return_when=FIRST_COMPLETED)
+
+    todo = deque(i for i in range(len(regions)) if i not in done)
+    progress_bar = tqdm_notebook(total=len(todo), leave=False)
+    in_flight = {}
+    try:
+        while len(todo) > 0 or len(in_flight) > 0:
+            while len(todo) > 0 and len(in_flight) < max_in_flight:
+                i = todo.popleft()
+                in_flight[submit(ds.isel(regions[i]))] = i
+
+            finished, _ = wait_first(list(in_flight))
+            for future in finished:
+                i = in_flight.pop(future)
+                output.write(regions[i], future.result())
+                if target is not None:
+                    with open(progress_path, 'a') as f:
+                        f.write('{}\n'.format(i))
+                progress_bar.update(1)
+    finally:
+        for future in in_flight:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=True)
+        progress_bar.close()
+
+    result = output.result()
+    if isinstance(dsx, xr.DataArray):
+        result = result[_dataarray_variable]
+        result.name = name
+    return result
+
+
+def evaluate(diagnostic, expts, *args, max_workers=None, **kwargs):
+    """
+    Returns a list of diagnostic(expt, *args, **kwargs) for each of
+    expts, evaluating the experiments concurrently.
+
+    Results already cached (see memory.cache) are loaded at once.  The
+    rest are computed together, each in its own thread (up to
+    max_workers at a time, by default all of them), and collected as
+    they finish.  The dask computations of the diagnostics then all run
+    at once on the current distributed client, if there is one, or
+    otherwise on the local dask scheduler.
+    """
+    results = [None] * len(expts)
+    pending = []
+    lookup = getattr(diagnostic, 'lookup', None)
+    for i, expt in enumerate(expts):
+        found = False
+        if lookup is not None:
+            found, results[i] = lookup(expt, *args, **kwargs)
+        if not found:
+            pending.append(i)
+
+    if len(pending) == 0:
+        return results
+
+    if max_workers is None:
+        max_workers = len(pending)
+
+    progress_bar = tqdm_notebook(total=len(expts), initial=len(expts) - len(pending),
+                                 leave=False, desc='experiments')
+    with ThreadPoolExecutor(max(1, min(max_workers, len(pending)))) as pool:
+        futures = {pool.submit(diagnostic, expts[i], *args, **kwargs): i
+                   for i in pending}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                progress_bar.update(1)
+        finally:
+            for future in futures:
+                future.cancel()
+            progress_bar.close()
+
+    return results
@@ -0,0 +1,233 @@
+"""
+A process-wide cache of open files.
+
+Notebooks often read several variables from the same files in turn,
+each time opening and parsing the headers of thousands of files.  The
+handle cache keeps recently used files open, keyed by path and
+modification time so that a rewritten file is opened afresh, and
+closes the least recently used ones once there are more than
+max_handles open or their estimated memory use exceeds max_bytes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import netCDF4
+import xarray as xr
+from xarray.backends.locks import HDF5_LOCK
+
+from . import timing
+
+# estimated memory held by an open file, besides any coordinates read
+handle_overhead = 64 * 1024
+
+
+class _HDF5Lock(object):
+    """
+    xarray's HDF5_LOCK, which the thread holding it may acquire again.
+
+    xarray itself does not hold the lock while opening a file, only
+    while reading from it, so opening files from several threads needs
+    the lock held around xr.open_dataset as well as within it.
+    """
+
+    _local = threading.local()
+
+    def acquire(self, blocking=True, timeout=-1):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0 and not HDF5_LOCK.acquire(blocking, timeout):
+            return False
+        self._local.depth = depth + 1
+        return True
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            HDF5_LOCK.release()
+
+    def locked(self):
+        return HDF5_LOCK.locked()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __reduce__(self):
+        return (_get_hdf5_lock, ())
+
+
+def _get_hdf5_lock():
+    return hdf5_lock
+
+
+hdf5_lock = _HDF5Lock()
+
+# the lock to give xr.open_dataset for files opened under hdf5_lock.
+# xarray's own lock also takes NETCDFC_LOCK, before HDF5_LOCK: taking it
+# while holding hdf5_lock could deadlock, and every netCDF call is made
+# under the HDF5 lock in any case.
+netcdf_lock = hdf5_lock
+
+
+def _handle_nbytes(handle):
+    """
+    Returns an estimate of the memory held by an open file.
+    """
+    if isinstance(handle, xr.Dataset):
+        # index coordinates are read when the file is opened
+        return handle_overhead + sum(var.nbytes for var in handle.variables.values()
+                                     if isinstance(var, xr.IndexVariable))
+    if isinstance(handle, netCDF4.Dataset):
+        return handle_overhead + 1024 * len(handle.variables)
+    return handle_overhead
+
+
+class HandleCache(object):
+    """
+    LRU cache of open files, bounded by the number of files open and
+    their estimated memory use.
+    """
+
+    def __init__(self, max_handles=512, max_bytes=512 * 1024 * 1024):
+        self.max_handles = max_handles
+        self.max_bytes = max_bytes
+        self._handles = OrderedDict()
+        # the key of the handle cached for each kind and path
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, kind, path, opener, close=None):
+        """
+        Returns the cached handle of the given kind for path, or the
+        result of opener(path) which is then cached.
+
+        close(handle) is called when the handle is evicted; otherwise
+        evicted handles are simply released.
+        """
+        key = (kind, path, os.stat(path).st_mtime)
+
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None:
+                self._handles.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # opened outside the lock, so that different files open concurrently
+        handle = opener(path)
+        nbytes = _handle_nbytes(handle)
+
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None:
+                # opened meanwhile by another thread
+                evicted = [(handle, nbytes, close)]
+                handle = entry[0]
+            else:
+                evicted = []
+                # the handle of an older version of the file is not used again
+                stale = self._keys.get(key[:2])
+                if stale is not None and stale != key:
+                    evicted.append(self._remove(stale))
+                self._handles[key] = (handle, nbytes, close)
+                self._keys[key[:2]] = key
+                self.nbytes += nbytes
+                evicted.extend(self._evict())
+
+        for evicted_handle, _, evicted_close in evicted:
+            if evicted_close is not None:
+                evicted_close(evicted_handle)
+
+        return handle
+
+    def _remove(self, key):
+        entry = self._handles.pop(key)
+        if self._keys.get(key[:2]) == key:
+            del self._keys[key[:2]]
+        self.nbytes -= entry[1]
+        self.evictions += 1
+        return entry
+
+    def _evict(self):
+        evicted = []
+        while len(self._handles) > 1 and (len(self._handles) > self.max_handles
+                                          or self.nbytes > self.max_bytes):
+            evicted.append(self._remove(next(iter(self._handles))))
+        return evicted
+
+    def clear(self):
+        """
+        Closes and forgets all cached handles.
+        """
+        with self._lock:
+            evicted = list(self._handles.values())
+            self._handles.clear()
+            self._keys.clear()
+            self.nbytes = 0
+
+        for handle, _, close in evicted:
+            if close is not None:
+                close(handle)
+
+    def stats(self):
+        """
+        Returns a dictionary of the hits, misses and evictions so far and
+        the number and estimated memory use of the handles held.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'handles': len(self._handles),
+                    'nbytes': self.nbytes}
+
+
+handle_cache = HandleCache()
+
+
+def _open_netcdf(path):
+    with timing.span('open_file', files=1), hdf5_lock:
+        return netCDF4.Dataset(path)
+
+
+def _close_netcdf(ds):
+    with hdf5_lock:
+        ds.close()
+
+
+def netcdf_dataset(path):
+    """
+    Returns an open netCDF4.Dataset for path from the handle cache.
+
+    The netCDF library is not thread-safe: callers must hold hdf5_lock
+    while using the dataset, and check that it is still open as another
+    thread may have evicted it.
+    """
+    return handle_cache.get('netCDF4', path, _open_netcdf, close=_close_netcdf)
+
+
+def _close_xarray(ds):
+    # xarray reopens the file if the dataset is read from again
+    with hdf5_lock:
+        ds.close()
+
+
+def xarray_dataset(path, opener, chunks=None):
+    """
+    Returns the xarray.Dataset opener(path) from the handle cache, for
+    files opened with xr.open_dataset(path, chunks=chunks,
+    decode_times=False, lock=netcdf_lock).
+    """
+    kind = ('xarray', repr(sorted(chunks.items())) if chunks else repr(chunks))
+    return handle_cache.get(kind, path, opener, close=_close_xarray)
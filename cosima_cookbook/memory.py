@@ -5,10 +5,425 @@ The memory object lives in this module.
 Other components of the cookbook access by
 
 from ..memory import memory
+
+and decorate diagnostics with @memory.cache.  Results are saved under
+memory.cachedir, one directory per diagnostic and experiment, and the
+least recently used are removed once they take more than
+memory.max_bytes.  These default to the COSIMA_COOKBOOK_CACHE_DIR and
+COSIMA_COOKBOOK_CACHE_SIZE environment variables, and can be changed
+with memory.configure().  As results are pickled, the cache directory
+must be private to the user (see catalog.private_dir): no results are
+read from or saved to one that others could write to.
+
+xarray objects within results are saved as compressed NetCDF (or Zarr,
+with memory.storage = 'zarr' or COSIMA_COOKBOOK_CACHE_FORMAT=zarr) and
+are opened lazily, so only the parts used are read back.  Everything
+else is pickled.
+
+Cached results are keyed on the arguments of the diagnostic, its source
+code and a fingerprint of the files of the experiment in the index, so
+a diagnostic is computed afresh once its experiment has new output
+(after build_index).  The experiment is taken from the expt argument.
 """
 
-from joblib import Memory
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from urllib.parse import quote, unquote
+
+import dask.base
+import xarray as xr
+from dask.utils import parse_bytes
+
+from . import catalog, netcdf_index, timing
+
+default_cachedir = os.path.join(tempfile.gettempdir(),
+                                'cosima-cookbook-{}'.format(os.getuid()))
+default_max_bytes = '10GB'
+default_storage = 'netcdf'
+
+# stands in for the experiment of functions without an expt argument
+_no_experiment = '_'
+
+
+def _source_hash(func):
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__qualname__
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def experiment_fingerprint(expt, basename_patterns=None):
+    """
+    Returns a fingerprint of the files indexed for expt (only those of
+    basename_patterns, if given), or None if the index is unavailable.
+    """
+    try:
+        return netcdf_index.get_catalog().experiment_fingerprint(expt,
+                                                                 basename_patterns)
+    except Exception as e:
+        logging.warning('Unable to fingerprint {} from the index: {}'.format(expt, e))
+        return None
+
+
+# the pickled result within an entry
+_manifest = 'result.pkl'
+
+# the name under which DataArrays are saved
+_dataarray_variable = '__dataarray__'
+
+
+class _StoredArray(object):
+    """
+    Stands in for an xarray object, saved in its own file, within the
+    pickled result of an entry.
+    """
+
+    def __init__(self, obj, index, storage):
+        self.is_dataarray = isinstance(obj, xr.DataArray)
+        self.name = obj.name if self.is_dataarray else None
+        self.filename = '{}.{}'.format(index, 'zarr' if storage == 'zarr' else 'nc')
+
+    def save(self, path, obj):
+        if self.is_dataarray:
+            obj = obj.to_dataset(name=_dataarray_variable)
+
+        filename = os.path.join(path, self.filename)
+        if self.filename.endswith('.zarr'):
+            # encodings of the files the result was computed from do not
+            # apply, and zarr compresses by default
+            obj = obj.copy()
+            for var in obj.variables.values():
+                var.encoding = {}
+            obj.to_zarr(filename)
+        else:
+            netcdf_index.write_netcdf(obj, filename)
+
+    def open(self, path):
+        filename = os.path.join(path, self.filename)
+        if self.filename.endswith('.zarr'):
+            ds = xr.open_zarr(filename)
+        else:
+            ds = xr.open_dataset(filename, chunks={})
+        if not self.is_dataarray:
+            return ds
+        dataarray = ds[_dataarray_variable]
+        dataarray.name = self.name
+        return dataarray
+
+
+def _replace(value, replace):
+    """
+    Returns value with each xarray object (or _StoredArray) within it,
+    or within any tuples, lists or dictionaries it holds, replaced by
+    replace(obj).
+    """
+    if isinstance(value, (xr.DataArray, xr.Dataset, _StoredArray)):
+        return replace(value)
+    if isinstance(value, tuple) and not hasattr(value, '_fields'):
+        return tuple(_replace(item, replace) for item in value)
+    if isinstance(value, list):
+        return [_replace(item, replace) for item in value]
+    if isinstance(value, dict):
+        return type(value)((key, _replace(item, replace))
+                           for key, item in value.items())
+    return value
+
+
+def _entry_nbytes(path):
+    nbytes = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                nbytes += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return nbytes
+
+
+def _remove_entry(path):
+    """
+    Removes the cache entry at path, returning whether it was removed.
+    """
+    try:
+        # without its manifest the entry is no longer found
+        os.remove(os.path.join(path, _manifest))
+    except OSError:
+        return False
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+class Memory(object):
+    """
+    A bounded cache of diagnostic results on disk.
+    """
+
+    def __init__(self, cachedir=None, max_bytes=None, storage=None, verbose=0):
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+        self.configure(cachedir, max_bytes, storage)
+
+    def __repr__(self):
+        return 'Memory(cachedir={!r}, max_bytes={!r})'.format(self.cachedir,
+                                                              self.max_bytes)
+
+    def configure(self, cachedir=None, max_bytes=None, storage=None):
+        """
+        Sets the cache directory, the size it may grow to (either in
+        bytes or as a string such as '20GB') and the storage format of
+        xarray results ('netcdf' or 'zarr').  Each defaults to its
+        environment variable, if set, and otherwise to default_cachedir,
+        default_max_bytes and default_storage.
+        """
+        if cachedir is None:
+            cachedir = os.environ.get('COSIMA_COOKBOOK_CACHE_DIR', default_cachedir)
+        if max_bytes is None:
+            max_bytes = os.environ.get('COSIMA_COOKBOOK_CACHE_SIZE', default_max_bytes)
+        if isinstance(max_bytes, str):
+            max_bytes = parse_bytes(max_bytes)
+        if storage is None:
+            storage = os.environ.get('COSIMA_COOKBOOK_CACHE_FORMAT', default_storage)
+        if storage not in ('netcdf', 'zarr'):
+            raise ValueError('Unknown cache storage format {!r}'.format(storage))
+
+        self.cachedir = os.path.expanduser(cachedir)
+        self.max_bytes = int(max_bytes)
+        self.storage = storage
+
+    def cache(self, func=None, basename_patterns=None):
+        """
+        Decorates func so that its results are cached.  The decorated
+        function has a lookup method, with the same arguments, returning
+        (True, result) if the result is cached and (False, None) if not.
+
+        May be used as @memory.cache, or as
+        @memory.cache(basename_patterns=['ocean.nc']) so that only new
+        output in files of those patterns invalidates the results.
+        """
+        if func is None:
+            return functools.partial(self.cache,
+                                     basename_patterns=basename_patterns)
+
+        signature = inspect.signature(func)
+        source_hash = _source_hash(func)
+        span_name = 'diagnostic.{}'.format(func.__name__)
+
+        @functools.wraps(func)
+        def cached(*args, **kwargs):
+            with timing.span(span_name) as span:
+                return self._call(func, signature, source_hash, basename_patterns,
+                                  span, args, kwargs)
+
+        def lookup(*args, **kwargs):
+            path = self._path(func, signature, source_hash, basename_patterns,
+                              args, kwargs)
+            return self._load(path)
+
+        cached.func = func
+        cached.lookup = lookup
+        return cached
+
+    def _path(self, func, signature, source_hash, basename_patterns, args, kwargs):
+        """
+        Returns the path of the cache entry of func(*args, **kwargs).
+        """
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+
+        expt = bound.arguments.get('expt')
+        if isinstance(expt, str):
+            fingerprint = experiment_fingerprint(expt, basename_patterns)
+        else:
+            expt, fingerprint = _no_experiment, None
+
+        key = dask.base.tokenize(func.__module__, func.__qualname__,
+                                 source_hash, bound.args,
+                                 sorted(bound.kwargs.items()), fingerprint)
+        return self._entry_path(func.__name__, expt, key)
+
+    def _call(self, func, signature, source_hash, basename_patterns, span, args, kwargs):
+        """
+        Returns the cached result of func(*args, **kwargs), computing and
+        saving it if there is none, counting hits and misses in span.
+        """
+        path = self._path(func, signature, source_hash, basename_patterns,
+                          args, kwargs)
+
+        with timing.span('diagnostic.load') as load_span:
+            found, result = self._load(path, load_span)
+        if found:
+            span.add(hits=1)
+            return result
+        span.add(misses=1)
+        with self._lock:
+            self.misses += 1
+
+        with timing.span('diagnostic.compute'):
+            result = func(*args, **kwargs)
+        with timing.span('diagnostic.save') as save_span:
+            self._save(path, result, save_span)
+        return result
+
+    def _entry_path(self, diagnostic, expt, key):
+        return os.path.join(self.cachedir, diagnostic, quote(expt, safe=''), key)
+
+    def _load(self, path, span=timing._null_span):
+        manifest = os.path.join(path, _manifest)
+        try:
+            catalog.private_dir(self.cachedir)
+            with open(manifest, 'rb') as f:
+                result = pickle.load(f)
+            # xarray objects are opened lazily from the files saved with
+            # the result
+            result = _replace(result, lambda stored: stored.open(path))
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return False, None
+
+        # the modification time records when an entry was last used
+        try:
+            os.utime(manifest)
+        except OSError:
+            pass
+
+        nbytes = _entry_nbytes(path)
+        span.add(nbytes=nbytes)
+        with self._lock:
+            self.hits += 1
+            self.bytes_read += nbytes
+        if self.verbose:
+            print('Loaded cached result from {}'.format(path))
+
+        return True, result
+
+    def _save(self, path, result, span=timing._null_span):
+        try:
+            catalog.private_dir(self.cachedir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        except OSError as e:
+            logging.warning('Unable to cache result in {}: {}'.format(path, e))
+            return
+        # written under a temporary name so readers never see a partial entry
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            stored = []
+
+            def store(obj):
+                stored.append(_StoredArray(obj, len(stored), self.storage))
+                try:
+                    stored[-1].save(tmpdir, obj)
+                except Exception as e:
+                    logging.warning('Unable to save {} result as {}, '
+                                    'pickling it: {}'.format(type(obj).__name__,
+                                                             self.storage, e))
+                    return obj
+                return stored[-1]
+
+            manifest = _replace(result, store)
+            with open(os.path.join(tmpdir, _manifest), 'wb') as f:
+                pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+            nbytes = _entry_nbytes(tmpdir)
+            os.rename(tmpdir, path)
+        except (OSError, pickle.PicklingError, TypeError) as e:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if not os.path.isdir(path):
+                logging.warning('Unable to cache result in {}: {}'.format(path, e))
+            return
+
+        span.add(nbytes=nbytes)
+        with self._lock:
+            self.bytes_written += nbytes
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries while the cache holds
+        more than max_bytes.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry['last_used'])
+        total = sum(entry['nbytes'] for entry in entries)
+
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if not _remove_entry(entry['path']):
+                continue
+            total -= entry['nbytes']
+            with self._lock:
+                self.evictions += 1
+
+    def entries(self, expt=None, diagnostic=None):
+        """
+        Returns a list of the cached results (of the given experiment
+        and diagnostic, if given), each a dictionary with the diagnostic,
+        expt, path, nbytes and last_used (a time in seconds since the
+        epoch) of the entry.
+        """
+        entries = []
+        if not os.path.isdir(self.cachedir):
+            return entries
+
+        for diagnostic_dir in os.scandir(self.cachedir):
+            if not diagnostic_dir.is_dir():
+                continue
+            if diagnostic is not None and diagnostic_dir.name != diagnostic:
+                continue
+            for expt_dir in os.scandir(diagnostic_dir.path):
+                if not expt_dir.is_dir():
+                    continue
+                if expt is not None and unquote(expt_dir.name) != expt:
+                    continue
+                for entry in os.scandir(expt_dir.path):
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(entry.path, _manifest))
+                    except OSError:
+                        continue
+                    entries.append({'diagnostic': diagnostic_dir.name,
+                                    'expt': unquote(expt_dir.name),
+                                    'path': entry.path,
+                                    'nbytes': _entry_nbytes(entry.path),
+                                    'last_used': stat.st_mtime})
+
+        return entries
+
+    def purge(self, expt=None, diagnostic=None):
+        """
+        Removes the cached results of the given experiment and
+        diagnostic, or all of them if neither is given.  Returns the
+        number of entries removed.
+        """
+        return sum(_remove_entry(entry['path'])
+                   for entry in self.entries(expt, diagnostic))
+
+    def stats(self):
+        """
+        Returns a dictionary of the hits, misses, bytes read and written
+        and evictions so far, and the number of entries and bytes held.
+        """
+        entries = self.entries()
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'bytes_read': self.bytes_read,
+                    'bytes_written': self.bytes_written,
+                    'evictions': self.evictions,
+                    'entries': len(entries),
+                    'nbytes': sum(entry['nbytes'] for entry in entries)}
+
 
-# pick up cachedir from an environment variable?
-cachedir='/tmp'
-memory = Memory(cachedir=cachedir, verbose=0)
+memory = Memory()
@@ -1,33 +1,36 @@
 """
 Common tools for accessing NetCDF4 variables.
 """
-# TODO: avoid use of db.query with concatenated string as this is vulnerable to sql injection by careless use
-# .... but the only thing at risk is the sql database, which is easily rebuilt...
-# is this any help? http://docs.sqlalchemy.org/en/latest/faq/sqlexpressions.html 
-# should it be constructed via methods rather than using string concat?
-# http://docs.sqlalchemy.org/en/latest/orm/query.html
-
-print('netcdf_index loaded.')
 
 __all__ = ['build_index', 'get_nc_variable',
            'get_experiments', 'get_configurations',
-           'get_variables', 'get_ncfiles']
+           'get_variables', 'get_ncfiles', 'search_variables']
 
+import ast
 import netCDF4
-import dataset
 import re
 import os
+import sys
 import fnmatch
-import dask.bag
-import distributed
-from distributed.diagnostics.progressbar import progress
+import itertools
+import collections
+import tempfile
+import datetime
+import json
+import numpy as np
+import pandas as pd
+import dask.base
 import xarray as xr
-import subprocess
-import tqdm
-import IPython.display
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+
+from . import catalog as catalog_schema
+from .catalog import Catalog
+from . import virtual
+from . import handles
+from . import timing
 
 import logging
-logging.basicConfig(level=logging.INFO)
 
 directoriesToSearch = ['/g/data3/hh5/tmp/cosima/',
                        '/g/data1/v45/APE-MOM',
@@ -37,7 +40,386 @@ cosima_cookbook_dir = '/g/data1/v45/cosima-cookbook'
 database_file = '{}/cosima-cookbook.db'.format(cosima_cookbook_dir)
 database_url = 'sqlite:///{}'.format(database_file)
 
-def build_index(use_bag=False):
+# Number of directories scanned concurrently while crawling for runs and
+# .nc files.  Metadata operations on Lustre have high latency but scale
+# well with the number of outstanding requests.
+crawler_max_workers = 16
+
+# Number of files opened concurrently by get_nc_variable, and the number
+# of bytes at the start of each file read ahead of opening it.  The
+# netCDF library is not thread-safe, so the opening itself is serialized
+# by the HDF5 lock, but the read ahead (which brings the header into the
+# page cache) runs without any lock and hides most of the I/O latency.
+opener_max_workers = 8
+opener_readahead = 1 << 20
+
+# Opt-in cache of get_nc_variable results (see cache in get_nc_variable).
+# The most recent result_cache_size results are kept in memory.  Results
+# of at most result_cache_max_nbytes are loaded, and also saved in
+# result_cache_dir (as NetCDF, in a directory private to the user) for
+# later sessions.
+result_cache_size = 32
+result_cache_max_nbytes = 64 * 1024 * 1024
+result_cache_dir = os.path.join(
+    os.environ.get('COSIMA_COOKBOOK_CACHE_DIR',
+                   os.path.join(tempfile.gettempdir(),
+                                'cosima-cookbook-{}'.format(os.getuid()))),
+    'get_nc_variable')
+
+# Opt-in node-local snapshot of the index (see Catalog), from which all
+# lookups are answered while the index is written to database_url.  The
+# snapshot is kept in snapshot_dir, by default in a directory of the
+# user's own under $TMPDIR.
+use_snapshot = os.environ.get('COSIMA_COOKBOOK_SNAPSHOT', '0') not in ('', '0')
+snapshot_dir = os.path.join(tempfile.gettempdir(),
+                            'cosima-cookbook-{}'.format(os.getuid()), 'snapshots')
+
+_result_cache = collections.OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def _scandir(path, unreadable=None):
+    """
+    Returns the entries of directory path, warning rather than
+    failing if it cannot be read, in which case path is added to the
+    set unreadable (if given).
+    """
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except OSError as e:
+        logging.warning('Unable to read directory {}: {}'.format(path, e))
+        if unreadable is not None:
+            unreadable.add(os.path.normpath(path))
+        return []
+
+
+def _within(path, directories):
+    """
+    Returns whether path is one of directories, or below one of them.
+    """
+    path = os.path.normpath(path)
+    for directory in directories:
+        directory = os.path.normpath(directory)
+        if path == directory or path.startswith(directory.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+
+def _walk_ncfiles(directory, stat=False, unreadable=None):
+    """
+    Returns a sorted list of all .nc files in directory and
+    its subdirectories.
+
+    If stat is True, each item is a (path, size, mtime) tuple instead.
+    Files that vanish before they can be stat'ed are skipped.
+    Directories that cannot be read are added to the set unreadable.
+    """
+    ncfiles = []
+    subdirs = [directory]
+    while subdirs:
+        for entry in _scandir(subdirs.pop(), unreadable):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif not entry.name.endswith('.nc'):
+                continue
+            elif stat:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                ncfiles.append((entry.path, st.st_size, st.st_mtime))
+            else:
+                ncfiles.append(entry.path)
+
+    return sorted(ncfiles)
+
+
+def find_runs(roots=None, max_workers=None, maxdepth=3, unreadable=None):
+    """
+    Generator yielding all run directories (outputNNN) found at most
+    maxdepth levels below each of roots.
+
+    Directories are scanned concurrently by a pool of max_workers
+    threads and runs are yielded as soon as they are found, in no
+    particular order.
+
+    Parameters
+    ----------
+    roots : list of str, optional
+        Directories to search. Defaults to directoriesToSearch.
+    max_workers : int, optional
+        Maximum number of directories scanned concurrently.
+        Defaults to crawler_max_workers.
+    maxdepth : int
+        Maximum depth of a run directory below its root.
+    unreadable : set, optional
+        Directories (including roots) that cannot be read are added to
+        this set, so that their runs are not taken for removed.
+    """
+    if roots is None:
+        roots = directoriesToSearch
+
+    with ThreadPoolExecutor(max_workers or crawler_max_workers) as pool:
+        pending = {pool.submit(_scandir, root, unreadable): 1 for root in roots}
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    for entry in future.result():
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        if find_run_name.match(entry.name):
+                            yield os.path.normpath(entry.path)
+                        elif depth < maxdepth:
+                            child = pool.submit(_scandir, entry.path, unreadable)
+                            pending[child] = depth + 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def find_ncfiles(directories, max_workers=None, stat=False, unreadable=None):
+    """
+    Generator yielding all .nc files found in (or below) each of
+    directories.
+
+    Directories are walked concurrently by a pool of max_workers
+    threads. Files are yielded as each directory completes, so they
+    can be processed before the whole crawl has finished. The files
+    of any one directory are yielded together and in sorted order.
+
+    Parameters
+    ----------
+    directories : iterable of str
+        Directories (typically run directories) to walk.
+    max_workers : int, optional
+        Maximum number of directories walked concurrently.
+        Defaults to crawler_max_workers.
+    stat : bool
+        If True, yield (path, size, mtime) tuples, with the files
+        stat'ed by the worker threads.
+    unreadable : set, optional
+        Directories that cannot be read are added to this set, so that
+        their files are not taken for removed.
+    """
+    with ThreadPoolExecutor(max_workers or crawler_max_workers) as pool:
+        pending = {pool.submit(_walk_ncfiles, d, stat, unreadable)
+                   for d in directories}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# output* directories
+# match the parent and grandparent directory to configuration/experiment
+find_output = re.compile(r'(.*)/([^/]*)/([^/]*)/(output\d+)/.*\.nc')
+
+# names of the run directories found by find_runs, which find_output
+# also matches
+find_run_name = re.compile(r'output\d{3}$')
+
+# determine general pattern for ncfile names
+find_basename_pattern = re.compile(r'(?P<root>[^\d]+)(?P<index>__\d+_\d+)?(?P<indexice>\.\d+\-\d+)?(?P<ext>\.nc)')
+
+
+def _time_range(ds):
+    """
+    Returns a dictionary with the first and last values, units,
+    calendar, length and values of the time axis of the open
+    netCDF4.Dataset ds.
+
+    The range is taken from the time bounds, if there are any.
+    """
+    time_range = {'time_first': None, 'time_last': None,
+                  'time_units': None, 'calendar': None,
+                  'time_length': None, 'time_values': None}
+
+    time = ds.variables.get('time')
+    if time is None or time.ndim != 1 or time.size == 0:
+        return time_range
+
+    time_range['time_units'] = getattr(time, 'units', None)
+    time_range['calendar'] = getattr(time, 'calendar', None)
+    time_range['time_length'] = time.size
+    time_range['time_values'] = np.ma.filled(
+        time[:].astype('f8'), np.nan).tobytes()
+
+    bounds = ds.variables.get(getattr(time, 'bounds', ''))
+    if bounds is not None and bounds.ndim == 2 and bounds.shape[0] == time.size:
+        first, last = bounds[0, 0], bounds[-1, -1]
+    else:
+        first, last = time[0], time[-1]
+
+    if not (np.ma.is_masked(first) or np.ma.is_masked(last)):
+        time_range['time_first'] = float(first)
+        time_range['time_last'] = float(last)
+
+    return time_range
+
+
+def _json_attribute(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _describe_variable(v):
+    """
+    Returns the shape, dtype (as stored and as decoded), fill value and
+    attributes of the netCDF4.Variable v, and the values of v if it is
+    a static (not time dependent) dimension coordinate.
+    """
+    dtype = np.dtype(v.dtype)
+    stored_attributes = {name: v.getncattr(name) for name in v.ncattrs()}
+    attributes = {name: _json_attribute(value)
+                  for name, value in stored_attributes.items()}
+
+    fill_value = attributes.get('_FillValue', attributes.get('missing_value'))
+    if isinstance(fill_value, list):
+        fill_value = fill_value[0] if len(fill_value) > 0 else None
+    if not isinstance(fill_value, (int, float)):
+        fill_value = None
+
+    coordinate_values = None
+    if (v.dimensions == (v.name,) and v.name != 'time'
+            and dtype.kind in 'iuf'):
+        coordinate_values = np.ma.getdata(v[:]).astype(dtype).tobytes()
+
+    return {'shape': str(v.shape),
+            'dtype': dtype.str,
+            'decoded_dtype': virtual.decoded_dtype(dtype, stored_attributes).str,
+            'fill_value': fill_value,
+            'attributes': json.dumps(attributes, default=str),
+            'coordinate_values': coordinate_values}
+
+
+def index_variables(ncfile):
+    """
+    Returns a list of index records, one for each variable in ncfile.
+
+    Each record also holds the size and modification time of ncfile
+    so that later calls to build_index can tell if it has changed,
+    the range, units, calendar, length and values of its time axis,
+    and the shape, dtype, fill value and attributes of the variable.
+    """
+
+    matched = find_output.match(ncfile)
+    if matched is None:
+        return []
+
+    try:
+        stat = os.stat(ncfile)
+    except OSError:
+        return []
+
+    basename = os.path.basename(ncfile)
+    m = find_basename_pattern.match(basename)
+    if m is None:
+        basename_pattern = basename
+    else:
+        basename_pattern = m.group('root') + (r'__\d+_\d+' if m.group('index') else '') + (r'.\d+-\d+' if m.group('indexice') else '') + m.group('ext')
+
+    try:
+        with timing.span('build_index.read_metadata', files=1, nbytes=stat.st_size), \
+             netCDF4.Dataset(ncfile) as ds:
+            time_range = _time_range(ds)
+            ncvars = [ dict(time_range, **{'ncfile': ncfile,
+               'rootdir': matched.group(1),
+               'configuration': matched.group(2),
+               'experiment' : matched.group(3),
+               'run' : matched.group(4),
+               'basename' : basename,
+               'basename_pattern' : basename_pattern,
+               'variable' : v.name,
+               'dimensions' : str(v.dimensions),
+               'chunking' : str(v.chunking()),
+               'size' : stat.st_size,
+               'mtime' : stat.st_mtime,
+               }, **_describe_variable(v)) for v in ds.variables.values()]
+    except:
+        print(sys.exc_info()[0],
+              'Exception occurred while trying to read {}'.format(ncfile))
+        ncvars = []
+
+    return ncvars
+
+
+def _run_record(run):
+    """
+    Splits the path of a run directory into its index fields.
+    """
+    rootdir, run = os.path.split(run)
+    rootdir, experiment = os.path.split(rootdir)
+    rootdir, configuration = os.path.split(rootdir)
+
+    return {'rootdir': rootdir,
+            'configuration': configuration,
+            'experiment': experiment,
+            'run': run}
+
+
+def _run_directory(ncfile):
+    """
+    Returns the run directory containing ncfile.
+    """
+    matched = find_output.match(ncfile)
+    if matched is None:
+        return None
+
+    return os.path.join(*matched.groups())
+
+
+def _write_batch(db, ncvars, files_removed=(), runs_indexed=(), runs_removed=()):
+    """
+    Saves a batch of index records to the catalog in a single transaction.
+    Runs are given as paths of run directories.
+    """
+    with timing.span('build_index.insert', records=len(ncvars),
+                     files_removed=len(files_removed)):
+        catalog_schema.write_records(db, ncvars, files_removed,
+                                     [_run_record(run) for run in runs_indexed],
+                                     [_run_record(run) for run in runs_removed])
+
+
+# The catalog of database_url shared by all lookups, see get_catalog
+catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """
+    Returns the module-level Catalog for database_url.
+
+    The catalog, and its connection pool, is created on first use and
+    replaced if database_url, use_snapshot or snapshot_dir is changed.
+    """
+    global catalog
+
+    with _catalog_lock:
+        directory = snapshot_dir if use_snapshot else None
+        if (catalog is None or catalog.url != database_url
+                or catalog.snapshot_dir != directory):
+            if catalog is not None:
+                catalog.close()
+            catalog = Catalog(database_url, snapshot_dir=directory)
+
+        return catalog
+
+
+@timing.timed('build_index')
+def build_index(use_bag=False, max_workers=None, incremental=False,
+                batch_size=10000):
     """
     An experiment is a collection of outputNNN directories.  Each directory
     represents the output of a single job submission script. These directories
@@ -51,154 +433,186 @@ def build_index(use_bag=False):
 
     .ncfile, varname, dimensions, chunksize
 
-    """
+    Run directories and the .nc files within them are found by a
+    concurrent crawler (see find_runs and find_ncfiles); max_workers
+    limits the number of directories scanned at once.
 
-# TODO: make build_index warn on unreadable directories rather than failing
+    By default only runs that have not been seen before are indexed.
+    With incremental=True, the files of runs already in the index are
+    also checked: files whose size or modification time has changed,
+    or that were added since the run was indexed, are (re)indexed, and
+    files that no longer exist are removed from the index.
 
-    # Build index of all NetCDF files found in directories to search.
+    Records are saved as they are read, in transactions of about
+    batch_size variables.  A run is only marked as indexed once all of
+    its files have been saved, so if build_index is interrupted the
+    next call carries on with the files that were not yet saved.
+    """
 
-    ncfiles = []
-    runs_available = []
+    # Build index of all NetCDF files found in directories to search.
 
     print('Finding runs on disk...', end='')
-    for directoryToSearch in directoriesToSearch:
-        #print('Searching {}'.format(directoryToSearch))
-
-        # find all subdirectories
-        results = subprocess.check_output(['find', directoryToSearch, '-maxdepth', '3', '-type', 'd',
-            '-name', 'output???'])
-
-        results = [s for s in results.decode('utf-8').split()]
-        runs_available.extend(results)
+    with timing.span('build_index.discover') as span:
+        unreadable = set()
+        runs_available = set(find_runs(directoriesToSearch, max_workers,
+                                       unreadable=unreadable))
+        span.add(runs=len(runs_available))
     print('found {} run directories'.format( len(runs_available)))
 
-    #ncfiles.extend(results)
-#
-#    results = subprocess.check_output(['find', directoryToSearch, '-name', '*.nc'])
-#
-#    print('Found {} .nc files'.format(len(ncfiles)))
-
     # We can persist this index by storing it in a sqlite database placed in a
     # centrally available location.
 
-    # The use of the `dataset` module hides the details of working with SQL directly.
-
-    # In this database is a single table listing all variables in NetCDF4 seen previously.
+    # The catalog in this database lists all variables in NetCDF4 files
+    # seen previously (see the catalog module for its schema).
     print('Using database {}'.format(database_url))
     print('Querying database...', end='')
 
-    db = dataset.connect(database_url)
+    db = get_catalog().db
 
     # find list of all run directories
-    r = db.query('SELECT DISTINCT rootdir, configuration, experiment, run FROM ncfiles')
-
-    runs_already_seen = [os.path.join(*row.values())
-                         for row in r]
+    with timing.span('build_index.query') as span:
+        runs_already_seen = set(os.path.join(*run)
+                                for run in catalog_schema.indexed_runs(db))
+        indexed_files = catalog_schema.indexed_files(db)
+        span.add(runs=len(runs_already_seen), files=len(indexed_files))
 
     print('runs already indexed: {}'.format(len(runs_already_seen)))
 
-    runs_to_index = list(set(runs_available) - set(runs_already_seen))
-
-    if len(runs_to_index) == 0:
+    runs_to_index = runs_available - runs_already_seen
+
+    files_to_remove = []
+    files_to_update = []
+    runs_to_remove = []
+    if incremental:
+        print('Checking files of indexed runs...', end='')
+
+        on_disk = {}
+        with timing.span('build_index.stat') as span:
+            for ncfile, size, mtime in find_ncfiles(
+                    sorted(runs_already_seen & runs_available),
+                    max_workers, stat=True, unreadable=unreadable):
+                on_disk[ncfile] = (size, mtime)
+            span.add(files=len(on_disk))
+
+        # only runs under roots that were searched, and not below any
+        # directory that could not be read, are known to be gone
+        runs_to_remove = sorted(run for run in runs_already_seen - runs_available
+                                if _within(run, directoriesToSearch)
+                                and not _within(run, unreadable))
+        # files missing from directories that could not be read may
+        # still exist, and are kept
+        runs_checked = (runs_already_seen & runs_available) | set(runs_to_remove)
+        files_to_remove = sorted(ncfile for ncfile in indexed_files
+                                 if ncfile not in on_disk
+                                 and _run_directory(ncfile) in runs_checked
+                                 and not _within(ncfile, unreadable))
+        files_to_update = sorted(ncfile for ncfile in on_disk
+                                 if indexed_files.get(ncfile) != on_disk[ncfile])
+        print('{} changed or new, {} removed'.format(len(files_to_update),
+                                                     len(files_to_remove)))
+
+    if len(runs_to_index) == 0 and len(files_to_update) == 0 \
+            and len(files_to_remove) == 0:
         print("No new runs found.")
         return
 
-    print('{} new run directories found including...'.format(len(runs_to_index)))
+    if len(runs_to_index) > 0:
+        print('{} new run directories found including...'.format(len(runs_to_index)))
 
-    for i in range(min(3, len(runs_to_index))):
-        print(runs_to_index[i])
-    if len(runs_to_index) > 3:
-        print('...')
+        for run in sorted(runs_to_index)[:3]:
+            print(run)
+        if len(runs_to_index) > 3:
+            print('...')
 
-    print('Finding files on disk...')
-    ncfiles = []
-    for run in tqdm.tqdm_notebook(runs_to_index, leave=True):
-        results = subprocess.check_output(['find', run, '-name', '*.nc'])
-        results = [s for s in results.decode('utf-8').split()]
+    # NetCDF files found on disk not seen before, streamed from the
+    # crawler so that indexing starts before the crawl has finished.
+    # Files in runs that were only partly indexed have already been saved.
+    # Files outside the layout find_output expects are skipped.
+    files_to_add = (ncfile for ncfile in
+                    find_ncfiles(sorted(runs_to_index), max_workers)
+                    if ncfile not in indexed_files
+                    and _run_directory(ncfile) is not None)
 
-        ncfiles.extend(results)
+    # For these new files, we can determine their configuration, experiment, and run.
+    # Using NetCDF4 to get list of all variables in each file.
 
-    IPython.display.clear_output(wait=True)
-    
-    # NetCDF files found on disk not seen before:
-    #files_to_add = set(ncfiles) - set(files_already_seen)
+    print('Indexing new .nc files...')
 
-    files_to_add = ncfiles
+    # files that no longer exist are removed with the first batch
+    _write_batch(db, [], files_to_remove, runs_removed=runs_to_remove)
 
-    print('Files found but not yet indexed: {}'.format(len(files_to_add)))
+    nvars = 0
+    if use_bag:
+        import dask.bag as dask_bag
+        import distributed
+        import tqdm
 
-    # For these new files, we can determine their configuration, experiment, and run.
-    # Using NetCDF4 to get list of all variables in each file.
+        files_to_add = files_to_update + list(files_to_add)
 
-    # output* directories
-    # match the parent and grandparent directory to configuration/experiment
-    find_output = re.compile('(.*)/([^/]*)/([^/]*)/(output\d+)/.*\.nc')
+        with distributed.Client() as client:
+            bag = dask_bag.from_sequence(files_to_add)
+            bag = bag.map(lambda ncfile: (ncfile, index_variables(ncfile)))
+
+            futures = client.compute(bag.to_delayed())
+
+            # each partition is written as soon as it completes
+            progress_bar = tqdm.tqdm(total=len(files_to_add), leave=False,
+                                     desc='files')
+            for future in distributed.as_completed(futures):
+                results = future.result()
+                ncvars = [v for _, records in results for v in records]
+                _write_batch(db, ncvars,
+                             [f for f, _ in results if f in indexed_files])
+                nvars += len(ncvars)
+                progress_bar.update(len(results))
+                future.release()
+            progress_bar.close()
+
+        _write_batch(db, [], runs_indexed=runs_to_index)
+    else:
+        ncvars = []
+        files_replaced = []
+        runs_indexed = []
 
-    # determine general pattern for ncfile names
-    find_basename_pattern = re.compile('(?P<root>[^\d]+)(?P<index>__\d+_\d+)?(?P<indexice>\.\d+\-\d+)?(?P<ext>\.nc)')
+        import IPython.display
+        import tqdm
 
-    def index_variables(ncfile):
+        progress_bar = tqdm.tqdm_notebook(leave=False, desc='files')
 
-        matched = find_output.match(ncfile)
-        if matched is None:
-            return []
+        for ncfile in files_to_update:
+            ncvars.extend(index_variables(ncfile))
+            files_replaced.append(ncfile)
+            progress_bar.update()
 
-        if not os.path.exists(ncfile):
-            return []
+            if len(ncvars) >= batch_size:
+                _write_batch(db, ncvars, files_replaced)
+                nvars += len(ncvars)
+                ncvars, files_replaced = [], []
 
-        basename = os.path.basename(ncfile)
-        m = find_basename_pattern.match(basename)
-        if m is None:
-            basename_pattern = basename
-        else:
-            basename_pattern = m.group('root') + ('__\d+_\d+' if m.group('index') else '') + ('.\d+-\d+' if m.group('indexice') else '') + m.group('ext')
+        # the crawler yields all files of a run together
+        for run, ncfiles in itertools.groupby(files_to_add, _run_directory):
+            for ncfile in ncfiles:
+                ncvars.extend(index_variables(ncfile))
+                progress_bar.update()
 
-        try:
-            with netCDF4.Dataset(ncfile) as ds:
-                ncvars = [ {'ncfile': ncfile,
-                   'rootdir': matched.group(1),
-                   'configuration': matched.group(2),
-                   'experiment' : matched.group(3),
-                   'run' : matched.group(4),
-                   'basename' : basename,
-                   'basename_pattern' : basename_pattern,
-                   'variable' : v.name,
-                   'dimensions' : str(v.dimensions),
-                   'chunking' : str(v.chunking()),
-                   } for v in ds.variables.values()]
-        except:
-            print(sys.exc_info()[0],
-                  'Exception occurred while trying to read {}'.format(ncfile))
-            ncvars = []
-
-        return ncvars
-
-    if len(files_to_add) == 0:
-        print("No new .nc files found.")
-        return True
+                if len(ncvars) >= batch_size:
+                    _write_batch(db, ncvars, files_replaced, runs_indexed)
+                    nvars += len(ncvars)
+                    ncvars, files_replaced, runs_indexed = [], [], []
 
-    print('Indexing new .nc files...')
+            runs_indexed.append(run)
 
-    if use_bag:
-        with distributed.Client() as client:
-            bag = dask.bag.from_sequence(files_to_add)
-            bag = bag.map(index_variables).flatten()
+        # runs whose files were all indexed before an interruption
+        runs_indexed.extend(runs_to_index - set(runs_indexed))
 
-            futures = client.compute(bag)
-            progress(futures, notebook=False)
+        _write_batch(db, ncvars, files_replaced, runs_indexed)
+        nvars += len(ncvars)
 
-            ncvars = futures.result()
-    else:
-        ncvars = []
-        for file_to_add in tqdm.tqdm_notebook(files_to_add, leave=False):
-            ncvars.extend(index_variables(file_to_add))
+        progress_bar.close()
         IPython.display.clear_output()
-        
-    print('')
-    print('Found {} new variables'.format(len(ncvars)))
 
-    print('Saving results in database...')
-    db['ncfiles'].insert_many(ncvars)
+    print('')
+    print('Saved {} new variables'.format(nvars))
 
     print('Indexing complete.')
 
@@ -209,12 +623,7 @@ def get_configurations():
     """
     Returns list of all configurations
     """
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT configuration FROM ncfiles')
-    configurations = [row['configuration'] for row in rows]
-
-    return configurations
+    return get_catalog().configurations()
 
 
 def get_experiments(configuration):
@@ -226,25 +635,13 @@ def get_experiments(configuration):
     configuration : str
         Configuration name.
     """
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT experiment FROM ncfiles '
-                'WHERE configuration = "{configuration}" ORDER BY experiment'.format(configuration=configuration), )
-    expts = [row['experiment'] for row in rows]
-
-    return expts
+    return get_catalog().experiments(configuration)
 
 def get_ncfiles(expt):
     """
     Returns list of ncfiles for the given experiment
     """
-    with dataset.connect(database_url) as db:
-        rows = db.query('SELECT DISTINCT basename_pattern '
-                        'FROM ncfiles '
-                        f'WHERE experiment = "{expt}"')
-        ncfiles = [row['basename_pattern'] for row in rows]
-
-    return ncfiles
+    return get_catalog().basename_patterns(expt)
 
 
 def get_variables(expt, ncfile):
@@ -252,21 +649,265 @@ def get_variables(expt, ncfile):
     Returns list of variables available in given experiment
     and ncfile basename pattern
     """
+    return get_catalog().variables(expt, ncfile)
 
-    with dataset.connect(database_url) as db:
-        rows = db.query('SELECT DISTINCT variable '
-                        'FROM ncfiles '
-                        f'WHERE experiment = "{expt}" '
-                        f'AND basename_pattern = "{ncfile}"')
-        variables = [row['variable'] for row in rows]
 
-    return variables
+def search_variables(variable=None, words=None, units=None, configuration=None):
+    """
+    Returns a list of the variables, in all experiments, matching the
+    given conditions, each as a dictionary of its configuration,
+    experiment, basename_pattern, variable, long_name, units,
+    standard_name and dimensions.
+
+    Parameters
+    ----------
+    variable : str, optional
+        Glob pattern of variable names, such as '*trans*int_z'.
+    words : str, optional
+        Words to find in the names and attributes of variables.
+    units : str, optional
+        Units of the variables.
+    configuration : str, optional
+        Configuration name.
+    """
+    return get_catalog().search(variable, words, units, configuration)
     
+def _read_header(ncfile, nbytes):
+    """
+    Reads the first nbytes of ncfile, warming the page cache before the
+    netCDF library opens it.
+    """
+    try:
+        with open(ncfile, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, nbytes, os.POSIX_FADV_WILLNEED)
+            f.read(nbytes)
+    except OSError:
+        # reported when the file is opened
+        pass
+
+
+def open_ncfiles(ncfiles, variables, chunks=None, max_workers=None,
+                 progress=True):
+    """
+    Opens variables in each of ncfiles with xarray (without decoding
+    times) using a pool of max_workers threads, and returns a list of
+    Datasets in the order of ncfiles.
+
+    The header of each file is read in parallel before it is opened;
+    the opening itself is serialized by the HDF5 lock.
+    Files already open in the handle cache are not opened again.
+    """
+    if max_workers is None:
+        max_workers = opener_max_workers
+
+    def open_ncfile(ncfile):
+        _read_header(ncfile, opener_readahead)
+        with handles.hdf5_lock:
+            return xr.open_dataset(ncfile, chunks=chunks, decode_times=False,
+                                   lock=handles.netcdf_lock)
+
+    def cached_ncfile(ncfile):
+        return handles.xarray_dataset(ncfile, open_ncfile, chunks)[variables]
+
+    with ThreadPoolExecutor(max(1, min(max_workers, len(ncfiles)))) as pool:
+        datasets = pool.map(cached_ncfile, ncfiles)
+        if progress:
+            import tqdm
+            datasets = tqdm.tqdm_notebook(datasets, total=len(ncfiles),
+                                          desc='get_nc_variable:', leave=False)
+        return list(datasets)
+
+
+def _fingerprint(variable):
+    """
+    Returns a cheap summary of variable for comparison between files:
+    its dimensions, shape and dtype, and for index coordinates (whose
+    values are already in memory) the first and last values.
+    """
+    fingerprint = (variable.dims, variable.shape, str(variable.dtype))
+    if isinstance(variable, xr.IndexVariable) and variable.size > 0:
+        values = variable.values
+        fingerprint += (values[0].tobytes(), values[-1].tobytes())
+    return fingerprint
+
+
+def concat_ncfiles(datasets, dim='time'):
+    """
+    Concatenates datasets, opened from consecutive files, along dim.
+
+    Only the variables along dim are concatenated.  The others, such as
+    static coordinates, are taken from the first dataset once their
+    fingerprints are found to match in every dataset, without loading or
+    comparing their values.  If they do not match, the datasets are
+    concatenated by xr.concat(datasets, dim, coords='all') instead.
+    """
+    first = datasets[0]
+    static = {name: _fingerprint(var) for name, var in first.variables.items()
+              if dim not in var.dims}
+    along_dim = [name for name, var in first.variables.items()
+                 if dim in var.dims]
+
+    for ds in datasets[1:]:
+        if (sorted(ds.variables) != sorted(first.variables)
+                or any(dim not in ds.variables[name].dims for name in along_dim)
+                or any(_fingerprint(ds.variables[name]) != fingerprint
+                       for name, fingerprint in static.items())):
+            logging.warning('Static variables differ between files, '
+                            'comparing every file')
+            return xr.concat(datasets, dim=dim, coords='all')
+
+    variables = dict(first.variables)
+    for name in along_dim:
+        variables[name] = type(first.variables[name]).concat(
+            [ds.variables[name] for ds in datasets], dim)
+
+    return xr.Dataset({name: variables[name] for name in first.data_vars},
+                      coords={name: variables[name] for name in first.coords},
+                      attrs=first.attrs)
+
+
+def write_netcdf(ds, path):
+    """
+    Writes the xarray.Dataset ds to path as NetCDF, compressing its
+    numeric variables.  The encodings of the files ds was read from are
+    dropped, as they need not apply to it.
+    """
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {}
+    encoding = {name: {'zlib': True, 'complevel': 4}
+                for name, var in ds.data_vars.items()
+                if var.dtype.kind in 'iuf' and var.ndim > 0}
+    ds.to_netcdf(path, encoding=encoding)
+
+
+def _result_path(key):
+    return os.path.join(result_cache_dir, key + '.nc')
+
+
+def _cached_result(key):
+    """
+    Returns the cached result for key, or None.
+    """
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return _result_cache[key].copy()
+
+    path = _result_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        catalog_schema.private_dir(result_cache_dir)
+        with xr.open_dataset(path) as ds:
+            result = ds.load()
+    except (OSError, ValueError) as e:
+        logging.warning('Unable to read cached result {}: {}'.format(path, e))
+        return None
+
+    _remember_result(key, result)
+    return result.copy()
+
+
+def _remember_result(key, result):
+    with _result_cache_lock:
+        _result_cache[key] = result
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > result_cache_size:
+            _result_cache.popitem(last=False)
+
+
+def _cache_result(key, result):
+    """
+    Caches result for key, loading and saving it to disk if it is small.
+    """
+    if result.nbytes <= result_cache_max_nbytes:
+        result = result.load()
+        try:
+            catalog_schema.private_dir(result_cache_dir)
+            # written under a temporary name so readers never see a partial file
+            fd, tmpname = tempfile.mkstemp(dir=result_cache_dir, suffix='.tmp')
+            os.close(fd)
+            try:
+                write_netcdf(result, tmpname)
+                os.replace(tmpname, _result_path(key))
+            except BaseException:
+                os.remove(tmpname)
+                raise
+        except (OSError, ValueError) as e:
+            logging.warning('Unable to save result in {}: {}'.format(result_cache_dir, e))
+
+    _remember_result(key, result)
+    return result.copy()
+
+
+def clear_result_cache(disk=True):
+    """
+    Forgets the cached get_nc_variable results, including those saved
+    in result_cache_dir unless disk is False.
+    """
+    with _result_cache_lock:
+        _result_cache.clear()
+
+    if disk and os.path.isdir(result_cache_dir):
+        for entry in _scandir(result_cache_dir):
+            if entry.name.endswith('.nc'):
+                os.remove(entry.path)
+
+
+_date_pattern = re.compile(r'(\d{1,4})(?:-(\d{1,2})(?:-(\d{1,2})'
+                           r'(?:[ T](\d{1,2})(?::(\d{1,2})(?::(\d{1,2}))?)?)?)?)?$')
+
+
+def _parse_date(date, end=False):
+    """
+    Returns a datetime for date, given either as a string such as
+    '1980', '1980-06', '1980-06-15' or '1980-06-15 12:00:00', or as any
+    date object with year, month, day (and time) attributes.
+
+    If end is True, the first instant after the period described by
+    date is returned instead, e.g. 1991-01-01 for '1990'.
+    """
+    if isinstance(date, str):
+        matched = _date_pattern.match(date.strip())
+        if matched is None:
+            raise ValueError('Unable to parse date {!r}'.format(date))
+        fields = [int(field) for field in matched.groups() if field is not None]
+    else:
+        if isinstance(date, np.datetime64):
+            date = pd.Timestamp(date)
+        fields = [date.year, date.month, date.day,
+                  getattr(date, 'hour', 0), getattr(date, 'minute', 0),
+                  getattr(date, 'second', 0)]
+
+    precision = len(fields)
+    fields = fields + [1, 1, 0, 0, 0][precision - 1:]
+    result = datetime.datetime(*fields)
+
+    if end:
+        if precision == 1:
+            result = result.replace(year=result.year + 1)
+        elif precision == 2:
+            result = result.replace(year=result.year + result.month // 12,
+                                    month=result.month % 12 + 1)
+        else:
+            result += [datetime.timedelta(days=1), datetime.timedelta(hours=1),
+                       datetime.timedelta(minutes=1),
+                       datetime.timedelta(seconds=1)][precision - 3]
+
+    return result
+
+
+@timing.timed('get_nc_variable')
 def get_nc_variable(expt, ncfile,
                     variable, chunks={}, n=None,
                     op=None, 
                     time_units="days since 1900-01-01",
-                    use_bag = False):
+                    use_bag = False,
+                    start=None, end=None,
+                    fast_concat=True, cache=False,
+                    chunk_bytes=None, explain_chunks=False):
     """
     For a given experiment, concatenate together
     variable over all time given a basename ncfile.
@@ -274,9 +915,12 @@ def get_nc_variable(expt, ncfile,
     Since some NetCDF4 files have trailing integers (e.g. ocean_123_456.nc)
     ncfile is actually an regular expression.
 
-    By default, xarray is set to use the same chunking pattern that is
-    stored in the ncfile. This can be overwritten by passing in a dictionary
-    chunks or setting chunks=None for no chunking (load directly into memory).
+    By default, chunks are whole multiples of the chunking stored in the
+    ncfile, grown to about chunk_bytes (chunking.target_chunk_bytes by
+    default) and along time spanning several files where these are small.
+    explain_chunks=True prints the chunks chosen and why.  The chunks
+    along some dimensions can be fixed by passing in a dictionary chunks,
+    or chunks=None gives no chunking (load directly into memory).
 
     n > 0 means only use the last n ncfiles files. Useful for testing.
 
@@ -285,14 +929,29 @@ def get_nc_variable(expt, ncfile,
     time_units (e.g. "days since 1600-01-01") can be used to override
     the original time.units.  If time_units=None, no overriding is performed.
 
+    start and end (e.g. '1980' and '1990-06') limit the result to the
+    given dates, inclusive, as decoded using time_units. Files entirely
+    outside this period are excluded by the index and never opened.
+    n then applies to the files within the period.
+
+    The variables are laid out from the shapes and coordinates recorded
+    in the index, so that files are only opened to compute their chunks.
+    Files indexed by earlier versions of build_index are opened as before.
+    Their static coordinates are then taken from the first file, after
+    a cheap check that they match in the others, unless fast_concat is
+    False, in which case every coordinate is concatenated along time.
+
     if variable is a list, then return a dataset for all given variables
-    """
 
-    if '/' in expt:
-        # TODO: make use of configuration?
-        configuration, experiment = expt.split('/')
-    else:
-        experiment = expt
+    cache=True reuses the result of an earlier call with the same
+    arguments, as long as the files it used are unchanged in the index
+    (so an index updated with new output gives a new result).  Results
+    no larger than result_cache_max_nbytes are loaded into memory and
+    also kept on disk for later sessions.
+
+    expt may be given as "configuration/experiment" to select an
+    experiment within a particular configuration.
+    """
 
     if not isinstance(variable, list):
         variables = [variable]
@@ -301,37 +960,52 @@ def get_nc_variable(expt, ncfile,
         variables = variable
         return_dataarray = False
 
-    db = dataset.connect(database_url)
-
-    var_list = ",".join(['"{}"'.format(v) for v in variables])
+    # the time values (in the units used to decode them) bounding the
+    # requested period
+    time_min = time_max = None
+    if start is not None or end is not None:
+        decode_units = time_units
+        if decode_units is None:
+            decode_units = get_catalog().time_units(expt, ncfile)
+        if decode_units is None:
+            raise ValueError("No time units found for {} in {}".format(expt, ncfile))
+
+        if start is not None:
+            time_min = float(netCDF4.date2num(_parse_date(start),
+                                               decode_units, 'standard'))
+        if end is not None:
+            time_max = float(netCDF4.date2num(_parse_date(end, end=True),
+                                               decode_units, 'standard'))
+
+    # n is applied by the query, which returns only the last n files
+    with timing.span('get_nc_variable.query') as span:
+        rows = get_catalog().ncfiles(expt, ncfile, variables, n,
+                                     time_min=time_min, time_max=time_max)
+        span.add(files=len(rows))
+
+    ncfiles = [row[0] for row in rows]
 
-    sql = " ".join(['SELECT DISTINCT ncfile, dimensions, chunking ',
-                    'FROM ncfiles',
-                    'WHERE experiment = "{}"'.format(experiment),
-                    'AND basename_pattern = "{}"'.format(ncfile),
-                    'AND variable in ({})'.format(var_list),
-                    'ORDER BY ncfile'])
-
-    logging.debug(sql)
-
-    res = db.query(sql)
-    rows = list(res)
-
-    ncfiles = [row['ncfile'] for row in rows]
-    
-    #res.close()
-    
     if len(ncfiles) == 0:
         raise ValueError("No variable {} found for {} in {}".format(variable, expt, ncfile))
 
     #print('Found {} ncfiles'.format(len(ncfiles)))
 
-# TODO: avoid use of eval?
-    dimensions = eval(rows[0]['dimensions'])
-    chunking = eval(rows[0]['chunking'])
+    if cache:
+        key = dask.base.tokenize(expt, ncfile, variables, chunks, n, time_units,
+                                 start, end, chunk_bytes,
+                                 get_catalog().fingerprint(ncfiles))
+        with timing.span('get_nc_variable.cache_lookup'):
+            dataarray = _cached_result(key)
+        if dataarray is not None:
+            return dataarray[variable] if return_dataarray else dataarray
+
+    dimensions = ast.literal_eval(rows[0][1])
+    chunking = catalog_schema._parse_chunking(rows[0][2])
 
     #print ('chunking info', dimensions, chunking)
-    if chunking is not None:
+    requested_chunks = chunks
+    # contiguous variables have no storage chunks to default to
+    if isinstance(chunking, tuple):
         default_chunks = dict(zip(dimensions, chunking))
     else:
         default_chunks = {}
@@ -340,55 +1014,82 @@ def get_nc_variable(expt, ncfile,
         default_chunks.update(chunks)
         chunks = default_chunks
 
-    if n is not None:
-        #print('using last {} ncfiles only'.format(n))
-        ncfiles = ncfiles[-n:]
-
     if op is None:
         def op(x): return x
         # op = lambda x: x
 
 
-    #print ('Opening {} ncfiles...'.format(len(ncfiles)))
-    logging.debug(f'Opening {len(ncfiles)} ncfiles...')
-
-    if use_bag:
-        bag = dask.bag.from_sequence(ncfiles)
-        
-        load_variable = lambda ncfile: xr.open_dataset(ncfile, 
-                           chunks=chunks, 
-                           decode_times=False)[variables]
-        #bag = bag.map(load_variable, chunks, time_units, variables)
-        bag = bag.map(load_variable)
-        
-        dataarrays = bag.compute()
-    else:
-        dataarrays = []
-        for ncfile in tqdm.tqdm_notebook(ncfiles,
-            desc='get_nc_variable:', leave=False):
-            dataarray = xr.open_dataset(ncfile, chunks=chunks, decode_times=False)[variables]
-
-            #dataarray = op(dataarray)
-
-            dataarrays.append(dataarray)
-
-    #print ('Building dataarray.')
-
-    dataarray = xr.concat(dataarrays,
-                          dim='time', coords='all', )
+    # lay out the variables from the catalog, opening files only when
+    # their chunks are computed, unless the index lacks the information
+    dataarray = None
+    if not use_bag:
+        with timing.span('get_nc_variable.layout', files=len(ncfiles)):
+            dataarray = virtual.open_virtual_dataset(get_catalog(), expt, ncfile,
+                                                     ncfiles, variables, requested_chunks,
+                                                     target_bytes=chunk_bytes,
+                                                     explain=explain_chunks)
+
+    if dataarray is None:
+        #print ('Opening {} ncfiles...'.format(len(ncfiles)))
+        logging.debug(f'Opening {len(ncfiles)} ncfiles...')
+
+        with timing.span('get_nc_variable.open', files=len(ncfiles)):
+            if use_bag:
+                import dask.bag as dask_bag
+                bag = dask_bag.from_sequence(ncfiles)
+
+                load_variable = lambda ncfile: xr.open_dataset(ncfile,
+                                   chunks=chunks,
+                                   decode_times=False)[variables]
+                #bag = bag.map(load_variable, chunks, time_units, variables)
+                bag = bag.map(load_variable)
+
+                dataarrays = bag.compute()
+            else:
+                dataarrays = open_ncfiles(ncfiles, variables, chunks)
+
+        #print ('Building dataarray.')
+
+        with timing.span('get_nc_variable.concat', files=len(ncfiles)):
+            if fast_concat:
+                dataarray = concat_ncfiles(dataarrays, dim='time')
+            else:
+                dataarray = xr.concat(dataarrays,
+                                      dim='time', coords='all', )
 
     
+    if 'time' in dataarray.coords and (time_min is not None or time_max is not None):
+        # trim the files overlapping the ends of the period
+        keep = np.ones(dataarray.time.shape, dtype=bool)
+        if time_min is not None:
+            keep &= dataarray.time.values >= time_min
+        if time_max is not None:
+            keep &= dataarray.time.values < time_max
+        dataarray = dataarray.isel(time=np.flatnonzero(keep))
+
+    if chunks is None:
+        # without chunking, variables laid out from the catalog are read
+        # into memory as when opened
+        with timing.span('get_nc_variable.load') as span:
+            dataarray = dataarray.load()
+            span.add(nbytes=dataarray.nbytes)
+
     if 'time' in dataarray.coords:
         if time_units is None:
             time_units = dataarray.time.units
 
-        decoded_time = xr.conventions.decode_cf_datetime(dataarray.time, time_units)
-        dataarray.coords['time'] = ('time', decoded_time,
-                                    {'long_name' : 'time', 'decoded_using' : time_units }
-                                   )
+        with timing.span('get_nc_variable.decode', times=dataarray.time.size):
+            decoded_time = xr.coding.times.decode_cf_datetime(dataarray.time, time_units)
+            dataarray.coords['time'] = ('time', decoded_time,
+                                        {'long_name' : 'time', 'decoded_using' : time_units }
+                                       )
 
     #print ('Dataarray constructed.')
 
+    if cache:
+        with timing.span('get_nc_variable.cache_store'):
+            dataarray = _cache_result(key, dataarray)
+
     if return_dataarray:
         return dataarray[variable]
     else:
@@ -396,12 +1097,4 @@ def get_nc_variable(expt, ncfile,
 
 
 def get_scalar_variables(configuration):
-    db = dataset.connect(database_url)
-
-    rows = db.query('SELECT DISTINCT variable FROM ncfiles '
-         'WHERE basename = "ocean_scalar.nc" '
-         'AND dimensions = "(\'time\', \'scalar_axis\')" '
-         'AND configuration = "{configuration}"'.format(configuration=configuration))
-    variables = [row['variable'] for row in rows]
-
-    return variables
+    return get_catalog().scalar_variables(configuration)
@@ -1,8 +1,9 @@
 import matplotlib.pyplot as plt
 import cosima_cookbook as cc
-from tqdm import tqdm_notebook
 import IPython.display
 
+from ..distributed import evaluate
+
 def wind_stress(expts=[]):
     """
     Plot zonally averaged wind stress.
@@ -18,8 +19,8 @@ def wind_stress(expts=[]):
 
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        result = {'mean_tau_x': cc.diagnostics.mean_tau_x(expt),
+    for expt, mean_tau_x in zip(expts, evaluate(cc.diagnostics.mean_tau_x, expts)):
+        result = {'mean_tau_x': mean_tau_x,
                   'expt': expt }
         results.append(result)
             
@@ -61,9 +62,8 @@ def annual_scalar(expts=[], variables=[]):
 
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        annual_average = cc.diagnostics.annual_scalar(expt, variables)
-            
+    annual_averages = evaluate(cc.diagnostics.annual_scalar, expts, variables)
+    for expt, annual_average in zip(expts, annual_averages):
         result = {'annual_average': annual_average,
                   'expt': expt}
         results.append(result)
@@ -105,9 +105,7 @@ def drake_passage(expts=[]):
 
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        transport = cc.diagnostics.drake_passage(expt)
-            
+    for expt, transport in zip(expts, evaluate(cc.diagnostics.drake_passage, expts)):
         result = {'transport': transport,
                   'expt': expt}
         results.append(result)
@@ -141,8 +139,7 @@ def bering_strait(expts=[]):
     if not isinstance(expts, list):
         expts = [expts]
 
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        transport = cc.diagnostics.bering_strait(expt)
+    for expt, transport in zip(expts, evaluate(cc.diagnostics.bering_strait, expts)):
         transport.plot(label=expt)
         
     IPython.display.clear_output()
@@ -167,8 +164,7 @@ def aabw(expts=[]):
     if not isinstance(expts, list):
         expts = [expts]
 
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        psi_aabw = cc.diagnostics.calc_aabw(expt)
+    for expt, psi_aabw in zip(expts, evaluate(cc.diagnostics.calc_aabw, expts)):
         psi_aabw.plot(label=expt)
     
     IPython.display.clear_output()
@@ -194,8 +190,7 @@ def amoc(expts=[]):
     if not isinstance(expts, list):
         expts = [expts]
 
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        psi_amoc = cc.diagnostics.calc_amoc(expt)
+    for expt, psi_amoc in zip(expts, evaluate(cc.diagnostics.calc_amoc, expts)):
         psi_amoc.plot(label=expt)
     
     
@@ -221,8 +216,8 @@ def amoc_south(expts=[]):
     if not isinstance(expts, list):
         expts = [expts]
 
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        psi_amoc_south = cc.diagnostics.calc_amoc_south(expt)
+    for expt, psi_amoc_south in zip(expts, evaluate(cc.diagnostics.calc_amoc_south,
+                                                    expts)):
         psi_amoc_south.plot(label=expt)
     
     IPython.display.clear_output()
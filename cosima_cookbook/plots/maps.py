@@ -9,10 +9,11 @@
 
 import matplotlib.pyplot as plt
 import cosima_cookbook as cc
-from tqdm import tqdm_notebook
 
 import IPython.display
 
+from ..distributed import evaluate
+
 def sea_surface_temperature(expts=[],resolution=1):
     """
     Plot a map of SST from last decade of run.
@@ -23,9 +24,8 @@ def sea_surface_temperature(expts=[],resolution=1):
     
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        SST, SSTdiff = cc.diagnostics.sea_surface_temperature(expt, resolution)
-            
+    SSTs = evaluate(cc.diagnostics.sea_surface_temperature, expts, resolution)
+    for expt, (SST, SSTdiff) in zip(expts, SSTs):
         result = {'SST': SST,
                   'SSTdiff': SSTdiff,
                   'expt': expt}
@@ -58,9 +58,8 @@ def sea_surface_salinity(expts=[], resolution=1):
     
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        SSS, SSSdiff = cc.diagnostics.sea_surface_salinity(expt, resolution)
-            
+    SSSs = evaluate(cc.diagnostics.sea_surface_salinity, expts, resolution)
+    for expt, (SSS, SSSdiff) in zip(expts, SSSs):
         result = {'SSS': SSS,
                   'SSSdiff': SSSdiff,
                   'expt': expt}
@@ -93,9 +92,7 @@ def mixed_layer_depth(expts=[]):
     
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        MLD = cc.diagnostics.mixed_layer_depth(expt)
-            
+    for expt, MLD in zip(expts, evaluate(cc.diagnostics.mixed_layer_depth, expts)):
         result = {'MLD': MLD,
                   'expt': expt}
         results.append(result)
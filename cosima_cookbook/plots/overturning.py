@@ -1,9 +1,10 @@
 import cosima_cookbook as cc
 import matplotlib.pyplot as plt
 import numpy as np
-from tqdm import tqdm_notebook
 
 import IPython.display
+
+from ..distributed import evaluate
     
 def psi_avg(expts, n=10, clev=np.arange(-20,20,2)):
     
@@ -12,9 +13,7 @@ def psi_avg(expts, n=10, clev=np.arange(-20,20,2)):
         
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        psi_avg = cc.diagnostics.psi_avg(expt, n)
-            
+    for expt, psi_avg in zip(expts, evaluate(cc.diagnostics.psi_avg, expts, n)):
         result = {'psi_avg': psi_avg,
                   'expt': expt}
         results.append(result)
@@ -51,9 +50,8 @@ def zonal_mean(expts,variable,n=10,resolution=1):
     
     # computing
     results = []
-    for expt in tqdm_notebook(expts, leave=False, desc='experiments'):
-        zonal_mean, zonal_diff = cc.diagnostics.zonal_mean(expt,variable,n,resolution)
-            
+    zonal_means = evaluate(cc.diagnostics.zonal_mean, expts, variable, n, resolution)
+    for expt, (zonal_mean, zonal_diff) in zip(expts, zonal_means):
         result = {'zonal_mean': zonal_mean,
                   'zonal_diff': zonal_diff,
                   'expt': expt}
@@ -0,0 +1,250 @@
+"""
+Streaming statistics over the files of an experiment.
+
+Means, variances and covariances of several variables are accumulated
+in a single pass over their files, reading a bounded slab (some time
+steps of some levels) at a time, so that statistics of high frequency
+3D output can be computed without holding more than the results in
+memory.  The accumulation follows Welford, in the pairwise form of Chan
+et al., which stays accurate where sums of squares would lose precision
+(such as eddy variances small compared to the mean flow).
+
+eddy_statistics gives the eddy kinetic energy and eddy heat fluxes
+that scripts/mk_EKE_control_member_01.py computed level by level.
+"""
+
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from . import chunking, handles
+from .netcdf_index import get_catalog
+
+
+class RunningStats(object):
+    """
+    Running means of named fields and co-moments (sums of products of
+    deviations from the means) of pairs of them, at each point of a
+    grid of the given shape.
+
+    A sample counts at a point only where every field is finite there.
+    """
+
+    def __init__(self, names, pairs, shape):
+        self.names = list(names)
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.count = np.zeros(shape, dtype='i8')
+        self.mean = {name: np.zeros(shape) for name in self.names}
+        self.comoment = {pair: np.zeros(shape) for pair in self.pairs}
+
+    def update(self, fields, index=()):
+        """
+        Adds the samples along the first axis of each array in fields,
+        a dictionary by name, to the statistics at index.
+        """
+        values = {name: np.asarray(fields[name], dtype='f8') for name in self.names}
+        valid = np.all([np.isfinite(value) for value in values.values()], axis=0)
+        count = valid.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = {name: np.where(valid, value, 0).sum(axis=0) / count
+                    for name, value in values.items()}
+        deviation = {name: np.where(valid, value - mean[name], 0)
+                     for name, value in values.items()}
+        comoment = {(a, b): (deviation[a] * deviation[b]).sum(axis=0)
+                    for a, b in self.pairs}
+
+        self._merge(index, count, mean, comoment)
+
+    def merge(self, other):
+        """
+        Adds the samples accumulated by other, over the same grid.
+        """
+        self._merge((), other.count, other.mean, other.comoment)
+
+    def _merge(self, index, count, mean, comoment):
+        count_a = self.count[index]
+        total = count_a + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, count / total, 0)
+            delta = {name: np.where(count > 0, mean[name] - self.mean[name][index], 0)
+                     for name in self.names}
+            for a, b in self.pairs:
+                self.comoment[a, b][index] += (comoment[a, b] + delta[a] * delta[b]
+                                               * count_a * weight)
+            for name in self.names:
+                self.mean[name][index] += delta[name] * weight
+        self.count[index] = total
+
+    def variance(self, name):
+        return self.covariance(name, name)
+
+    def covariance(self, a, b):
+        comoment = self.comoment[(a, b) if (a, b) in self.comoment else (b, a)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, comoment / self.count, np.nan)
+
+
+def t_to_u_grid(values):
+    """
+    Averages values on the T grid of MOM's B grid to the U grid, over
+    the last two (y, x) axes.  The first row and column are left NaN.
+    """
+    values = np.asarray(values, dtype='f8')
+    averaged = np.full(values.shape, np.nan)
+    averaged[..., 1:, 1:] = (values[..., :-1, :-1] + values[..., :-1, 1:]
+                             + values[..., 1:, :-1] + values[..., 1:, 1:]) / 4
+    return averaged
+
+
+def _read(ncfile, variable, key=None):
+    """
+    Reads variable[key] from ncfile masked (as NaN) and scaled, or the
+    length of its time dimension if key is None.
+    """
+    while True:
+        ds = handles.netcdf_dataset(ncfile)
+        with handles.hdf5_lock:
+            if ds.isopen():
+                if key is None:
+                    return len(ds.dimensions['time'])
+                var = ds.variables[variable]
+                var.set_auto_maskandscale(True)
+                return np.ma.filled(var[key].astype('f8'), np.nan)
+
+
+def _slabs(ntime, shape, nvariables, block_bytes):
+    """
+    Yields (time slice, index) of slabs holding at most about
+    block_bytes of nvariables, split along time and then, for 3D
+    fields, along levels (never horizontally, for the sake of
+    transforms such as t_to_u_grid).
+    """
+    step_bytes = 8 * nvariables * int(np.prod(shape))
+    steps = int(min(ntime, max(1, block_bytes // step_bytes)))
+    if len(shape) > 2 and steps == 1:
+        levels = int(min(shape[0], max(1, block_bytes // (step_bytes // shape[0]))))
+        indices = [(slice(start, start + levels),) for start in range(0, shape[0], levels)]
+    else:
+        indices = [()]
+    for start, index in itertools.product(range(0, ntime, steps), indices):
+        yield slice(start, start + steps), index
+
+
+def streaming_stats(expt, ncfile, variables, covariances=(), n=None,
+                    transforms=None, max_workers=1, block_bytes=None,
+                    output=None):
+    """
+    Returns an xarray.Dataset of the mean ({variable}_mean) and variance
+    ({variable}_var) over time of each of variables, the covariance
+    ({a}_{b}_cov) of each pair (a, b) in covariances, and the number of
+    samples (count) at each point, computed in a single pass over the
+    files found for expt and ncfile (the last n files, if n is given).
+
+    transforms may map variables to functions applied to the values
+    read, for instance t_to_u_grid to bring temperature to the grid of
+    velocities.  All variables must then have the same shape, and the
+    result takes the coordinates of the first.
+
+    Files are read by max_workers threads, each accumulating its own
+    statistics (so using memory for as many copies of the results), in
+    slabs of about block_bytes (chunking.target_chunk_bytes by default).
+    The result is written to the NetCDF file output, if given.
+    """
+    if transforms is None:
+        transforms = {}
+    if block_bytes is None:
+        block_bytes = chunking.target_chunk_bytes
+    variables = list(variables)
+    covariances = [tuple(pair) for pair in covariances]
+    pairs = [(name, name) for name in variables] + covariances
+
+    ncfiles = [row[0] for row in get_catalog().ncfiles(expt, ncfile, variables, n)]
+    if len(ncfiles) == 0:
+        raise ValueError("No variables {} found for {} in {}".format(variables, expt, ncfile))
+
+    with handles.hdf5_lock, xr.open_dataset(ncfiles[0], decode_times=False,
+                                            lock=handles.netcdf_lock) as ds:
+        template = ds[variables[0]]
+        if template.dims[0] != 'time':
+            raise ValueError('{} has no time dimension'.format(variables[0]))
+        template = template.isel(time=0, drop=True)
+        template = xr.DataArray(coords={name: coord.load()
+                                        for name, coord in template.coords.items()},
+                                dims=template.dims, data=np.empty(template.shape))
+    shape = template.shape
+
+    def accumulate(ncfiles):
+        stats = RunningStats(variables, pairs, shape)
+        for path in ncfiles:
+            ntime = _read(path, variables[0])
+            logging.debug('Accumulating {} time steps from {}'.format(ntime, path))
+            for time, index in _slabs(ntime, shape, len(variables), block_bytes):
+                fields = {}
+                for name in variables:
+                    values = _read(path, name, (time,) + index)
+                    if name in transforms:
+                        values = transforms[name](values)
+                    fields[name] = values
+                stats.update(fields, index)
+        return stats
+
+    max_workers = max(1, min(max_workers, len(ncfiles)))
+    with ThreadPoolExecutor(max_workers) as pool:
+        partial = list(pool.map(accumulate, [ncfiles[i::max_workers]
+                                             for i in range(max_workers)]))
+    stats = partial[0]
+    for other in partial[1:]:
+        stats.merge(other)
+
+    def result(values, **attrs):
+        return template.copy(data=values).assign_attrs(attrs)
+
+    data_vars = {'count': result(stats.count, long_name='number of samples')}
+    for name in variables:
+        data_vars['{}_mean'.format(name)] = result(stats.mean[name],
+                                                   long_name='mean of {}'.format(name))
+        data_vars['{}_var'.format(name)] = result(stats.variance(name),
+                                                  long_name='variance of {}'.format(name))
+    for a, b in covariances:
+        data_vars['{}_{}_cov'.format(a, b)] = result(
+            stats.covariance(a, b), long_name='covariance of {} and {}'.format(a, b))
+
+    dataset = xr.Dataset(data_vars)
+    dataset.attrs['experiment'] = expt
+    dataset.attrs['ncfiles'] = len(ncfiles)
+    if output is not None:
+        dataset.to_netcdf(output)
+    return dataset
+
+
+def eddy_statistics(expt, ncfile, u='u', v='v', temp='temp', n=None,
+                    max_workers=1, block_bytes=None, output=None):
+    """
+    Returns an xarray.Dataset of the mean flow, eddy kinetic energy
+    (eke), mean kinetic energy (mke) and eddy heat fluxes (u_temp_cov
+    and v_temp_cov, with temperature averaged to the velocity grid) of
+    the given experiment, from the statistics of streaming_stats.
+
+    temp=None leaves out the heat fluxes.  The result is written to the
+    NetCDF file output, if given.
+    """
+    variables = [u, v] if temp is None else [u, v, temp]
+    covariances = [(u, v)] if temp is None else [(u, v), (u, temp), (v, temp)]
+    transforms = {} if temp is None else {temp: t_to_u_grid}
+
+    stats = streaming_stats(expt, ncfile, variables, covariances, n=n,
+                            transforms=transforms, max_workers=max_workers,
+                            block_bytes=block_bytes)
+
+    stats['eke'] = 0.5 * (stats['{}_var'.format(u)] + stats['{}_var'.format(v)])
+    stats['eke'].attrs['long_name'] = 'eddy kinetic energy'
+    stats['mke'] = 0.5 * (stats['{}_mean'.format(u)]**2 + stats['{}_mean'.format(v)]**2)
+    stats['mke'].attrs['long_name'] = 'mean kinetic energy'
+
+    if output is not None:
+        stats.to_netcdf(output)
+    return stats
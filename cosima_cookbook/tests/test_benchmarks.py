@@ -0,0 +1,40 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import xarray as xr
+
+from cosima_cookbook import benchmarks, netcdf_index
+from cosima_cookbook.benchmarks import synthetic
+
+
+class TestBenchmarks(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_synthetic(self):
+        expt_dir = synthetic.make_experiment(self.root, nruns=2)
+        self.assertEqual(sorted(os.listdir(expt_dir)), ['output000', 'output001'])
+
+        ocean = os.path.join(expt_dir, 'output001', 'ocean', 'ocean.nc')
+        with xr.open_dataset(ocean, use_cftime=True) as ds:
+            self.assertEqual(ds.temp.dims, ('time', 'st_ocean', 'yt_ocean', 'xt_ocean'))
+            self.assertEqual(ds.time.size, 12)
+            self.assertEqual(ds.time.values[0].year, 1701)
+
+    def test_run_benchmarks(self):
+        saved = netcdf_index.directoriesToSearch
+        output = os.path.join(self.root, 'results.json')
+        report = benchmarks.run_benchmarks('tiny', root=self.root, repeat=1,
+                                           output=output)
+
+        self.assertEqual(netcdf_index.directoriesToSearch, saved)
+        with open(output) as f:
+            self.assertEqual(json.load(f)['benchmarks'].keys(),
+                             report['benchmarks'].keys())
+        for name, result in report['benchmarks'].items():
+            self.assertIsNone(result['error'], name)
+            self.assertEqual(len(result['times']), 1)
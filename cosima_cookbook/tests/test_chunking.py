@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from cosima_cookbook.chunking import plan_chunks
+
+
+class TestPlanChunks(TestCase):
+    def test_storage_aligned(self):
+        # 4 byte values stored in 1 x 10 x 100 x 100 chunks (40kB)
+        plan = plan_chunks('temp', ('time', 'st_ocean', 'yt_ocean', 'xt_ocean'),
+                           (24, 50, 300, 360), 'f4', (1, 10, 100, 100),
+                           file_lengths=[12, 12], target_bytes=16 * 10**6)
+
+        self.assertEqual(plan.chunks[3], (360,))
+        self.assertEqual(plan.chunks[2], (300,))
+        # whole multiples of the storage chunk, within the target
+        self.assertEqual(plan.chunks[1], (30, 20))
+        # a time step is then most of the target
+        self.assertEqual(plan.chunks[0], (1,) * 24)
+        self.assertLessEqual(plan.chunk_bytes, 16 * 10**6)
+        self.assertIn('temp', str(plan))
+
+    def test_merge_files(self):
+        # small files are combined along time, without splitting any
+        plan = plan_chunks('eta_t', ('time', 'yt_ocean', 'xt_ocean'),
+                           (60, 300, 360), 'f4', (1, 300, 360),
+                           file_lengths=[12] * 4 + [6, 6],
+                           target_bytes=30 * 300 * 360 * 4)
+        self.assertEqual(plan.chunks[0], (24, 30, 6))
+        self.assertIn('files per chunk', plan.reasons[0])
+
+    def test_requested(self):
+        plan = plan_chunks('eta_t', ('time', 'yt_ocean', 'xt_ocean'),
+                           (4, 300, 360), 'f8', 'contiguous',
+                           chunks={'time': 1, 'yt_ocean': 100},
+                           file_lengths=[2, 2])
+        self.assertEqual(plan.chunks, ((1,) * 4, (100,) * 3, (360,)))
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from cosima_cookbook import distributed
+from cosima_cookbook import memory as memory_module
+from cosima_cookbook.distributed import compute_by_block, cluster_layout, evaluate
+from cosima_cookbook.memory import Memory
+
+
+class TestClusterLayout(TestCase):
+    def test_limits(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'cpu.max'), 'w') as f:
+            f.write('400000 100000\n')
+        with open(os.path.join(root, 'memory.max'), 'w') as f:
+            f.write('{}\n'.format(8 * 2**30))
+
+        with mock.patch.object(distributed, '_cgroup_root', root), \
+             mock.patch.dict(os.environ, {'PBS_NCPUS': '2'}):
+            self.assertEqual(distributed.available_cores(), min(2, os.cpu_count()))
+            self.assertLessEqual(distributed.available_memory(), 8 * 2**30)
+
+    def test_profiles(self):
+        memory = 190 * 10**9
+        layout = cluster_layout('default', cores=48, memory=memory)
+        self.assertEqual((layout['n_workers'], layout['threads_per_worker']), (24, 2))
+        self.assertEqual(layout['memory_limit'],
+                         int(memory * distributed.memory_fraction / 24))
+
+        layout = cluster_layout('compute', cores=48, memory=memory)
+        self.assertEqual((layout['n_workers'], layout['threads_per_worker']), (48, 1))
+        layout = cluster_layout('io', cores=2, memory=memory)
+        self.assertEqual((layout['n_workers'], layout['threads_per_worker']), (1, 8))
+
+
+class TestComputeByBlock(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.values = np.arange(48.).reshape(6, 8)
+        self.dataarray = xr.DataArray(da.from_array(self.values, chunks=(2, 4)),
+                                      dims=('time', 'x'), name='temp',
+                                      coords={'x': np.arange(8)})
+
+    def test_in_memory(self):
+        result = compute_by_block(self.dataarray, max_in_flight=2)
+        xr.testing.assert_identical(result, self.dataarray.compute())
+
+        ds = xr.Dataset({'temp': self.dataarray, 'salt': self.dataarray.mean('time')})
+        xr.testing.assert_identical(compute_by_block(ds), ds.compute())
+
+    def test_memmap(self):
+        target = os.path.join(self.root, 'temp.npy')
+        result = compute_by_block(self.dataarray, target)
+        xr.testing.assert_identical(result, self.dataarray.compute())
+        np.testing.assert_array_equal(np.load(target), self.values)
+
+    def test_resume(self):
+        target = os.path.join(self.root, 'temp.nc')
+        computed = []
+        interrupted = []
+
+        def compute(block, block_info=None):
+            location = tuple(block_info[None]['chunk-location'])
+            if location == (1, 1) and len(interrupted) == 0:
+                interrupted.append(location)
+                raise RuntimeError('interrupted')
+            computed.append(location)
+            return block
+
+        dataarray = self.dataarray.copy(
+            data=self.dataarray.data.map_blocks(compute, dtype='f8'))
+        with self.assertRaises(RuntimeError):
+            compute_by_block(dataarray, target, max_in_flight=1)
+
+        done = len(computed)
+        result = compute_by_block(dataarray, target, max_in_flight=1)
+        # only the blocks left are computed
+        self.assertEqual(len(computed), 6)
+        self.assertEqual(done, 3)
+        xr.testing.assert_identical(result.load(), self.dataarray.compute())
+
+
+class TestEvaluate(TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        patcher = mock.patch.object(memory_module, 'experiment_fingerprint',
+                                    lambda expt, patterns: 'a')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent(self):
+        memory = Memory(cachedir=self.cachedir)
+        # each call waits for all of them, so only succeeds concurrently
+        barrier = threading.Barrier(3, timeout=10)
+        calls = []
+
+        @memory.cache
+        def diagnostic(expt, n):
+            calls.append(expt)
+            barrier.wait()
+            return expt * n
+
+        expts = ['a', 'b', 'c']
+        self.assertEqual(evaluate(diagnostic, expts, 2), ['aa', 'bb', 'cc'])
+        self.assertEqual(sorted(calls), expts)
+
+        # cached results are loaded without computing
+        self.assertEqual(evaluate(diagnostic, expts, n=2), ['aa', 'bb', 'cc'])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(memory.stats()['hits'], 3)
+
+        # functions that are not cached are computed too
+        self.assertEqual(evaluate(str.upper, expts), ['A', 'B', 'C'])
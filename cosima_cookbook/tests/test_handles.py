@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from cosima_cookbook import handles
+
+
+class TestHandleCache(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            self.paths.append(os.path.join(self.root, '{}.nc'.format(i)))
+            open(self.paths[-1], 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lru(self):
+        cache = handles.HandleCache(max_handles=2)
+        closed = []
+
+        def get(path):
+            return cache.get('test', path, lambda path: [path],
+                             close=closed.append)
+
+        first = get(self.paths[0])
+        self.assertIs(get(self.paths[0]), first)
+        get(self.paths[1])
+        get(self.paths[0])
+        # the least recently used is evicted
+        get(self.paths[2])
+        self.assertEqual(closed, [[self.paths[1]]])
+
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 3, 'evictions': 1,
+                                         'handles': 2,
+                                         'nbytes': 2 * handles.handle_overhead})
+
+        # a modified file is opened again, and its old handle closed
+        os.utime(self.paths[0], (0, 0))
+        self.assertIsNot(get(self.paths[0]), first)
+        self.assertEqual(closed, [[self.paths[1]], first])
+        self.assertEqual(len(cache), 2)
+
+    def test_memory_bound(self):
+        cache = handles.HandleCache(max_bytes=2 * handles.handle_overhead)
+        for path in self.paths:
+            cache.get('test', path, lambda path: path)
+        self.assertEqual(len(cache), 2)
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+from unittest import TestCase
+
+import cosima_cookbook as cc
+from cosima_cookbook import netcdf_index
+
+
+class TestImports(TestCase):
+    def test_lazy_import(self):
+        # neither output nor heavy dependencies on import
+        script = ('import sys, cosima_cookbook.netcdf_index; '
+                  'print(sorted(m for m in ("matplotlib", "distributed", "IPython", '
+                  '"dask.bag", "cosima_cookbook.plots") if m in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', script], check=True,
+                                capture_output=True, text=True)
+        self.assertEqual(result.stdout, '[]\n')
+
+    def test_exports(self):
+        self.assertEqual(cc.__all__, netcdf_index.__all__)
+        self.assertIs(cc.get_nc_variable, netcdf_index.get_nc_variable)
+        # later submodules shadow earlier ones, as with the star imports
+        self.assertIs(cc.annual_scalar, cc.plots.lineplots.annual_scalar)
+        self.assertIs(cc.psi_sum, cc.diagnostics.overturning.psi_sum)
+        self.assertIs(cc.overturning, cc.plots.overturning)
+        self.assertIs(cc.start_cluster, cc.distributed.start_cluster)
+        self.assertIn('summary_md', dir(cc))
+        with self.assertRaises(AttributeError):
+            cc.missing
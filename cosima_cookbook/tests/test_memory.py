@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+import xarray as xr
+
+from cosima_cookbook import memory as memory_module
+from cosima_cookbook.memory import Memory
+
+
+class TestMemory(TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.fingerprint = 'a'
+        patcher = mock.patch.object(memory_module, 'experiment_fingerprint',
+                                    lambda expt, patterns: self.fingerprint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_cache(self):
+        memory = Memory(cachedir=self.cachedir)
+        calls = []
+
+        @memory.cache
+        def diagnostic(expt, n=10):
+            calls.append((expt, n))
+            return [expt] * n
+
+        self.assertEqual(diagnostic('expt', 2), ['expt', 'expt'])
+        self.assertEqual(diagnostic('expt', n=2), ['expt', 'expt'])
+        self.assertEqual(len(calls), 1)
+        stats = memory.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']),
+                         (1, 1, 1))
+
+        # new output for the experiment invalidates its results
+        self.fingerprint = 'b'
+        diagnostic('expt', 2)
+        self.assertEqual(len(calls), 2)
+
+        diagnostic('other/expt', 2)
+        self.assertEqual(len(memory.entries(expt='other/expt')), 1)
+        self.assertEqual(memory.purge(expt='expt'), 2)
+        self.assertEqual(memory.purge(diagnostic='diagnostic'), 1)
+        self.assertEqual(memory.entries(), [])
+
+    def test_shared_cachedir(self):
+        memory = Memory(cachedir=self.cachedir)
+        calls = []
+
+        @memory.cache
+        def diagnostic(expt):
+            calls.append(expt)
+            return expt
+
+        diagnostic('expt')
+        # results are not read from a directory others could write to
+        os.chmod(self.cachedir, 0o777)
+        with self.assertLogs(level='WARNING'):
+            diagnostic('expt')
+        self.assertEqual(len(calls), 2)
+
+    def test_eviction(self):
+        memory = Memory(cachedir=self.cachedir, max_bytes='3.5kB')
+
+        @memory.cache
+        def diagnostic(expt):
+            return bytes(1000)
+
+        for expt in ['a', 'b', 'c', 'a', 'd']:
+            diagnostic(expt)
+
+        # b was the least recently used
+        self.assertEqual(sorted(entry['expt'] for entry in memory.entries()),
+                         ['a', 'c', 'd'])
+        self.assertEqual(memory.stats()['evictions'], 1)
+
+    def test_xarray_results(self):
+        memory = Memory(cachedir=self.cachedir)
+        field = xr.DataArray(np.arange(12.).reshape(3, 4), name='temp',
+                             dims=['yt_ocean', 'xt_ocean'],
+                             coords={'yt_ocean': [-60., 0., 60.]},
+                             attrs={'units': 'K'})
+
+        @memory.cache
+        def diagnostic(expt):
+            return field, field.to_dataset(), 'label'
+
+        diagnostic('expt')
+        cached = diagnostic('expt')
+
+        # saved as NetCDF and read back lazily
+        entry, = memory.entries()
+        self.assertIn('0.nc', os.listdir(entry['path']))
+        self.assertIsNotNone(cached[0].chunks)
+        xr.testing.assert_identical(cached[0], field)
+        xr.testing.assert_identical(cached[1], field.to_dataset())
+        self.assertEqual(cached[2], 'label')
@@ -0,0 +1,462 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+import dataset
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from cosima_cookbook import netcdf_index
+from cosima_cookbook import catalog as catalog_schema
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+class TestCrawler(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ncfiles = []
+        for expt in ['expt1', 'expt2']:
+            for run in ['output000', 'output001']:
+                rundir = os.path.join(self.root, 'config', expt, run)
+                for name in ['ocean/ocean.nc', 'ice/OUTPUT/iceh.1900-01.nc']:
+                    self.ncfiles.append(os.path.join(rundir, name))
+                    touch(self.ncfiles[-1])
+                touch(os.path.join(rundir, 'ocean', 'input.nml'))
+        # too deep to be a run directory
+        touch(os.path.join(self.root, 'a', 'b', 'c', 'output000', 'x.nc'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find_runs(self):
+        runs = netcdf_index.find_runs([self.root], max_workers=2)
+        expected = [os.path.join(self.root, 'config', expt, run)
+                    for expt in ['expt1', 'expt2']
+                    for run in ['output000', 'output001']]
+        self.assertEqual(sorted(runs), expected)
+
+    def test_find_ncfiles(self):
+        runs = list(netcdf_index.find_runs([self.root]))
+        ncfiles = list(netcdf_index.find_ncfiles(runs, max_workers=3))
+        self.assertEqual(sorted(ncfiles), sorted(self.ncfiles))
+
+    def test_unreadable_root(self):
+        missing = os.path.join(self.root, 'missing')
+        self.assertEqual(list(netcdf_index.find_runs([missing])), [])
+
+
+def write_ncfile(path, variables=('temp',), ntime=2, start=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('xt_ocean', 4)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1900-01-01'
+        time.calendar = 'noleap'
+        time[:] = start + 365 * np.arange(ntime)
+        xt_ocean = ds.createVariable('xt_ocean', 'f8', ('xt_ocean',))
+        xt_ocean[:] = np.arange(4)
+        for name in variables:
+            var = ds.createVariable(name, 'f4', ('time', 'xt_ocean'),
+                                    fill_value=-1e20)
+            var.units = 'K'
+            var[:] = np.ma.masked_less(np.arange(ntime * 4).reshape(ntime, 4), 1)
+
+
+class TestBuildIndex(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = (netcdf_index.directoriesToSearch,
+                      netcdf_index.database_url)
+        netcdf_index.directoriesToSearch = [os.path.join(self.root, 'data')]
+        netcdf_index.database_url = 'sqlite:///{}'.format(
+            os.path.join(self.root, 'index.db'))
+
+        self.rundir = os.path.join(self.root, 'data', 'config', 'expt')
+        for i in range(2):
+            write_ncfile(os.path.join(self.rundir, 'output00{}'.format(i),
+                                      'ocean', 'ocean.nc'),
+                         start=730 * i)
+
+    def tearDown(self):
+        netcdf_index.directoriesToSearch, netcdf_index.database_url = self.saved
+        shutil.rmtree(self.root)
+
+    def indexed(self):
+        db = dataset.connect(netcdf_index.database_url)
+        rows = db.query('SELECT DISTINCT ncfile, variable FROM ncfiles')
+        return sorted((os.path.relpath(row['ncfile'], self.rundir),
+                       row['variable']) for row in rows)
+
+    def test_incremental(self):
+        netcdf_index.build_index()
+        self.assertEqual(len(self.indexed()), 6)
+
+        # rewrite one file, add another to the same run, remove a run
+        write_ncfile(os.path.join(self.rundir, 'output000', 'ocean',
+                                  'ocean.nc'), variables=('salt',))
+        write_ncfile(os.path.join(self.rundir, 'output000', 'ocean',
+                                  'ocean_month.nc'))
+        shutil.rmtree(os.path.join(self.rundir, 'output001'))
+
+        # without incremental, runs already indexed are not revisited
+        netcdf_index.build_index()
+        self.assertEqual(len(self.indexed()), 6)
+
+        netcdf_index.build_index(incremental=True)
+        self.assertEqual(self.indexed(),
+                         [('output000/ocean/ocean.nc', 'salt'),
+                          ('output000/ocean/ocean.nc', 'time'),
+                          ('output000/ocean/ocean.nc', 'xt_ocean'),
+                          ('output000/ocean/ocean_month.nc', 'temp'),
+                          ('output000/ocean/ocean_month.nc', 'time'),
+                          ('output000/ocean/ocean_month.nc', 'xt_ocean')])
+
+    def test_unreadable_directory(self):
+        netcdf_index.build_index()
+        scandir = os.scandir
+        broken = os.path.join(self.rundir, 'output000', 'ocean')
+
+        def failing(path):
+            if os.path.normpath(path) == broken:
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        # the files of a directory that cannot be read are kept
+        with mock.patch('os.scandir', failing):
+            netcdf_index.build_index(incremental=True)
+        self.assertEqual(len(self.indexed()), 6)
+
+    def test_non_numeric_run(self):
+        write_ncfile(os.path.join(self.rundir, 'outputold', 'ocean', 'ocean.nc'))
+
+        # only outputNNN directories are runs
+        self.assertEqual(sorted(netcdf_index.find_runs()),
+                         [os.path.join(self.rundir, 'output000'),
+                          os.path.join(self.rundir, 'output001')])
+        netcdf_index.build_index()
+        self.assertEqual(len(self.indexed()), 6)
+
+    def test_unreadable_root(self):
+        netcdf_index.build_index()
+        root = netcdf_index.directoriesToSearch[0]
+        scandir = os.scandir
+
+        def failing(path):
+            if os.path.normpath(path) == root:
+                raise FileNotFoundError(2, 'No such file or directory', path)
+            return scandir(path)
+
+        # the runs of a root that cannot be listed are kept
+        with mock.patch('os.scandir', failing):
+            netcdf_index.build_index(incremental=True)
+        self.assertEqual(len(self.indexed()), 6)
+        db = dataset.connect(netcdf_index.database_url)
+        self.assertEqual(db['runs'].count(), 2)
+
+    def test_resume(self):
+        index_variables = netcdf_index.index_variables
+        calls = []
+
+        def interrupted(ncfile):
+            calls.append(ncfile)
+            if len(calls) > 1:
+                raise KeyboardInterrupt
+            return index_variables(ncfile)
+
+        netcdf_index.index_variables = interrupted
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                netcdf_index.build_index(batch_size=1)
+        finally:
+            netcdf_index.index_variables = index_variables
+
+        # the first file was saved before the interruption
+        self.assertEqual(len(self.indexed()), 3)
+
+        netcdf_index.build_index(batch_size=1)
+        self.assertEqual(len(self.indexed()), 6)
+        db = dataset.connect(netcdf_index.database_url)
+        self.assertEqual(db['file_variables'].count(), 6)
+        self.assertEqual(db['runs'].count(indexed=1), 2)
+
+    def test_queries(self):
+        netcdf_index.build_index()
+
+        self.assertEqual(netcdf_index.get_configurations(), ['config'])
+        self.assertEqual(netcdf_index.get_experiments('config'), ['expt'])
+        self.assertEqual(netcdf_index.get_ncfiles('expt'), ['ocean.nc'])
+        self.assertEqual(netcdf_index.get_variables('config/expt', 'ocean.nc'),
+                         ['temp', 'time', 'xt_ocean'])
+        self.assertEqual(netcdf_index.get_variables('other/expt', 'ocean.nc'), [])
+
+    def test_search(self):
+        write_ncfile(os.path.join(self.root, 'data', 'config', 'other', 'output000',
+                                  'ocean', 'ocean_month.nc'),
+                     variables=('tx_trans_int_z', 'ty_trans_int_z', 'ty_trans'))
+        netcdf_index.build_index()
+
+        found = netcdf_index.search_variables('*trans*int_z')
+        self.assertEqual([(r['experiment'], r['basename_pattern'], r['variable'])
+                          for r in found],
+                         [('other', 'ocean_month.nc', 'tx_trans_int_z'),
+                          ('other', 'ocean_month.nc', 'ty_trans_int_z')])
+        self.assertEqual(found[0]['units'], 'K')
+        self.assertEqual(found[0]['long_name'], '')
+        self.assertEqual(found[0]['dimensions'], ('time', 'xt_ocean'))
+
+        self.assertEqual(len(netcdf_index.search_variables(units='K')), 4)
+        self.assertEqual([r['variable'] for r in
+                          netcdf_index.search_variables('t?_trans', configuration='config')],
+                         ['ty_trans'])
+        self.assertEqual(netcdf_index.search_variables('*trans*', configuration='x'), [])
+        self.assertEqual([r['variable'] for r in
+                          netcdf_index.search_variables(words='TEMP')], ['temp'])
+
+    def test_search_without_full_text(self):
+        write_ncfile(os.path.join(self.root, 'data', 'config', 'other', 'output000',
+                                  'ocean', 'ocean_month.nc'),
+                     variables=('tx_trans_int_z', 'ty_trans_int_z', 'ty_trans'))
+        # as with an SQLite without FTS5 or its trigram tokenizer
+        with mock.patch.object(catalog_schema, 'trigram_search', return_value=False):
+            netcdf_index.build_index()
+
+        db = dataset.connect(netcdf_index.database_url)
+        self.assertNotIn('variable_search', db.tables)
+        db.close()
+        self.assertEqual([r['variable'] for r in
+                          netcdf_index.search_variables('*trans*int_z')],
+                         ['tx_trans_int_z', 'ty_trans_int_z'])
+        self.assertEqual([r['variable'] for r in
+                          netcdf_index.search_variables(words='TEMP')], ['temp'])
+        self.assertEqual([r['variable'] for r in
+                          netcdf_index.search_variables(words='trans int_z')],
+                         ['tx_trans_int_z', 'ty_trans_int_z'])
+        self.assertEqual(netcdf_index.search_variables(words='trans%'), [])
+
+    def test_date_range(self):
+        netcdf_index.build_index()
+
+        # times are 0, 365 in the first file and 730, 1095 in the second
+        def times(**kwargs):
+            var = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp',
+                                               **kwargs)
+            return [str(t)[:10] for t in var.time.values]
+
+        self.assertEqual(times(start='1901', end='1902'),
+                         ['1901-01-01', '1902-01-01'])
+        self.assertEqual(times(start='1902-01-01'),
+                         ['1902-01-01', '1903-01-01'])
+        self.assertEqual(times(end='1900-06'), ['1900-01-01'])
+
+        # only the file within the period is opened
+        ncfiles = netcdf_index.get_catalog().ncfiles(
+            'expt', 'ocean.nc', ['temp'], time_min=730)
+        self.assertEqual([os.path.relpath(row[0], self.rundir) for row in ncfiles],
+                         [os.path.join('output001', 'ocean', 'ocean.nc')])
+
+    def test_virtual_dataset(self):
+        netcdf_index.build_index()
+
+        # laid out from the catalog without opening any file
+        with mock.patch.object(netcdf_index.netCDF4, 'Dataset',
+                               side_effect=AssertionError), \
+             mock.patch.object(xr, 'open_dataset', side_effect=AssertionError):
+            var = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp')
+
+        opened = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp',
+                                              use_bag=True)
+        xr.testing.assert_identical(var, opened)
+        self.assertTrue(np.isnan(var.values[0, 0]))
+        self.assertEqual(var.attrs, {'units': 'K'})
+        # the small files are read in a single chunk
+        self.assertEqual(var.chunks, ((4,), (4,)))
+
+        # one task per storage chunk of each file, in a single layer
+        var = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp',
+                                           chunk_bytes=1)
+        graph = var.data.__dask_graph__()
+        self.assertEqual(len(graph.layers), 1)
+        self.assertEqual(len(graph), 4)
+        xr.testing.assert_identical(var.load(), opened)
+
+    def test_virtual_dataset_packed(self):
+        # int16 packed with a float64 scale and offset decodes to float64
+        for run in ['output000', 'output001']:
+            path = os.path.join(self.rundir, run, 'ocean', 'ocean.nc')
+            with netCDF4.Dataset(path, 'a') as ds:
+                sst = ds.createVariable('sst', 'i2', ('time', 'xt_ocean'),
+                                        fill_value=-32768)
+                sst.scale_factor = np.float64(0.001)
+                sst.add_offset = np.float64(20.123456789)
+                sst.set_auto_maskandscale(False)
+                sst[:] = np.array([[-32768, 1, 2, 3], [4, 5, 6, 7]], dtype='i2')
+        netcdf_index.build_index()
+
+        var = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'sst')
+        opened = netcdf_index.get_nc_variable('expt', 'ocean.nc', 'sst',
+                                              use_bag=True)
+        self.assertEqual(var.dtype, np.float64)
+        xr.testing.assert_identical(var, opened)
+
+    def test_open_ncfiles(self):
+        ncfiles = [os.path.join(self.rundir, 'output00{}'.format(i), 'ocean',
+                                'ocean.nc') for i in [1, 0]]
+        datasets = netcdf_index.open_ncfiles(ncfiles, ['temp'], max_workers=2,
+                                             progress=False)
+        # in the order given, whichever file is opened first
+        self.assertEqual([ds.time.values.tolist() for ds in datasets],
+                         [[730, 1095], [0, 365]])
+
+    def test_concat_ncfiles(self):
+        ncfiles = [os.path.join(self.rundir, 'output00{}'.format(i), 'ocean',
+                                'ocean.nc') for i in [0, 1]]
+        datasets = netcdf_index.open_ncfiles(ncfiles, ['temp'], chunks={},
+                                             progress=False)
+
+        combined = netcdf_index.concat_ncfiles(datasets)
+        xr.testing.assert_identical(combined,
+                                    xr.concat(datasets, 'time', coords='all'))
+
+        # differing static coordinates are noticed
+        datasets[1] = datasets[1].assign_coords(xt_ocean=np.arange(4) + 0.5)
+        with self.assertLogs(level='WARNING'):
+            netcdf_index.concat_ncfiles(datasets)
+
+    def test_result_cache(self):
+        netcdf_index.build_index()
+        self.addCleanup(setattr, netcdf_index, 'result_cache_dir',
+                        netcdf_index.result_cache_dir)
+        netcdf_index.result_cache_dir = os.path.join(self.root, 'cache')
+
+        def get():
+            return netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp',
+                                                cache=True)
+
+        first = get()
+        saved, = os.listdir(netcdf_index.result_cache_dir)
+        self.assertTrue(saved.endswith('.nc'))
+        self.assertEqual(os.stat(netcdf_index.result_cache_dir).st_mode & 0o777, 0o700)
+
+        # later calls, and later sessions, are answered from the cache
+        netcdf_index.clear_result_cache(disk=False)
+        with mock.patch.object(netcdf_index.virtual, 'open_virtual_dataset',
+                               side_effect=AssertionError):
+            xr.testing.assert_identical(get(), first)
+
+        # new output in the index gives a new result
+        write_ncfile(os.path.join(self.rundir, 'output002', 'ocean', 'ocean.nc'),
+                     start=1460)
+        netcdf_index.build_index()
+        self.assertEqual(len(get().time), 6)
+
+        netcdf_index.clear_result_cache()
+        self.assertEqual(os.listdir(netcdf_index.result_cache_dir), [])
+
+    def test_migrate_legacy_index(self):
+        legacy_fields = ['ncfile', 'rootdir', 'configuration', 'experiment',
+                         'run', 'basename', 'basename_pattern', 'variable',
+                         'dimensions', 'chunking']
+        records = []
+        for run in ['output000', 'output001']:
+            ncfile = os.path.join(self.rundir, run, 'ocean', 'ocean.nc')
+            records.extend({field: record[field] for field in legacy_fields}
+                           for record in netcdf_index.index_variables(ncfile))
+
+        # the original layout: a single denormalized table
+        db = dataset.connect(netcdf_index.database_url)
+        db['ncfiles'].insert_many(records)
+        db.close()
+
+        self.assertEqual(netcdf_index.get_variables('expt', 'ocean.nc'),
+                         ['temp', 'time', 'xt_ocean'])
+        self.assertEqual(self.indexed(), sorted(
+            (os.path.join(run, 'ocean', 'ocean.nc'), variable)
+            for run in ['output000', 'output001']
+            for variable in ['temp', 'time', 'xt_ocean']))
+
+        # migrated runs count as indexed, and files without fingerprints
+        # are re-read by an incremental update
+        self.assertIsNone(netcdf_index.build_index())
+        self.assertTrue(netcdf_index.build_index(incremental=True))
+        self.assertEqual(len(self.indexed()), 6)
+
+    def test_catalog(self):
+        netcdf_index.build_index()
+
+        catalog = netcdf_index.get_catalog()
+        self.assertIs(netcdf_index.get_catalog(), catalog)
+
+        ncfiles = [os.path.relpath(ncfile, self.rundir)
+                   for ncfile, _, _ in catalog.ncfiles('expt', 'ocean.nc', ['temp'])]
+        self.assertEqual(ncfiles, ['output000/ocean/ocean.nc',
+                                   'output001/ocean/ocean.nc'])
+
+        # only the last n files
+        rows = catalog.ncfiles('expt', 'ocean.nc', ['temp', 'time'], n=1)
+        self.assertEqual(len(rows), 1)
+        self.assertTrue(rows[0][0].endswith('output001/ocean/ocean.nc'))
+        self.assertEqual(rows[0][1], str(('time', 'xt_ocean')))
+
+        # lookups from several threads share the catalog
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: catalog.variables('expt', 'ocean.nc'),
+                                    range(8)))
+        self.assertEqual(results, [['temp', 'time', 'xt_ocean']] * 8)
+
+    def test_snapshot(self):
+        netcdf_index.build_index()
+        snapshot_dir = os.path.join(self.root, 'snapshots')
+        with mock.patch.multiple(netcdf_index, use_snapshot=True,
+                                 snapshot_dir=snapshot_dir):
+            catalog = netcdf_index.get_catalog()
+            self.assertEqual(catalog.snapshot_dir, snapshot_dir)
+            self.assertEqual(netcdf_index.get_variables('expt', 'ocean.nc'),
+                             ['temp', 'time', 'xt_ocean'])
+
+            # lookups are answered from the snapshot, stamped with the
+            # state of the central database it was taken from
+            self.assertTrue(os.path.exists(catalog.snapshot_path))
+            self.assertTrue(catalog.read_db.url.endswith('mode=ro&uri=true'))
+            source = os.path.join(self.root, 'index.db')
+            stamp = catalog_schema.snapshot_stamp(catalog.snapshot_path)
+            self.assertEqual(stamp, catalog_schema._source_stamp(source))
+
+            # a catalog in another process reuses a valid snapshot
+            other = catalog_schema.Catalog(netcdf_index.database_url, snapshot_dir)
+            with mock.patch.object(catalog_schema, 'take_snapshot') as take:
+                self.assertEqual(other.variables('expt', 'ocean.nc'),
+                                 ['temp', 'time', 'xt_ocean'])
+            take.assert_not_called()
+            other.close()
+
+            # writing to the central database renews the snapshot
+            write_ncfile(os.path.join(self.rundir, 'output002', 'ocean', 'ocean.nc'),
+                         start=1460)
+            netcdf_index.build_index()
+            self.assertEqual(len(catalog.ncfiles('expt', 'ocean.nc', ['temp'])), 3)
+            self.assertNotEqual(catalog_schema.snapshot_stamp(catalog.snapshot_path),
+                                stamp)
+            netcdf_index.get_catalog().close()
+
+    def test_snapshot_dir_not_private(self):
+        netcdf_index.build_index()
+        snapshot_dir = os.path.join(self.root, 'snapshots')
+        os.mkdir(snapshot_dir)
+        os.chmod(snapshot_dir, 0o777)
+
+        # a snapshot others could have planted is not read
+        catalog = catalog_schema.Catalog(netcdf_index.database_url, snapshot_dir)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(catalog.variables('expt', 'ocean.nc'),
+                             ['temp', 'time', 'xt_ocean'])
+        self.assertIsNone(catalog.snapshot_path)
+        self.assertEqual(os.listdir(snapshot_dir), [])
+        catalog.close()
@@ -0,0 +1,70 @@
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from cosima_cookbook import memory as memory_module
+from cosima_cookbook.diagnostics import overturning
+
+
+def transport(seed):
+    rng = np.random.RandomState(seed)
+    return xr.DataArray(
+        rng.normal(size=(72, 6, 5, 3)) * 1e9,
+        dims=['time', 'potrho', 'grid_yu_ocean', 'grid_xt_ocean'],
+        coords={'time': pd.date_range('1900-01-01', periods=72, freq='MS'),
+                'potrho': [1030., 1034., 1035.5, 1036., 1036.5, 1037.],
+                'grid_yu_ocean': [-60., -55., -35., 0., 26.]}).chunk({'time': 12})
+
+
+class TestOverturning(TestCase):
+    def setUp(self):
+        cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cachedir)
+        self.addCleanup(memory_module.memory.configure,
+                        memory_module.memory.cachedir,
+                        memory_module.memory.max_bytes)
+        memory_module.memory.configure(cachedir=cachedir)
+
+        self.variables = {'ty_trans_rho': transport(0),
+                          'ty_trans_rho_gm': transport(1).sum('grid_xt_ocean')}
+        self.variables['ty_trans_rho_gm'] = \
+            self.variables['ty_trans_rho_gm'].expand_dims(grid_xt_ocean=1, axis=-1)
+        self.loaded = []
+
+        def get_nc_variable(expt, ncfile, variable, **kwargs):
+            self.loaded.append(variable)
+            return self.variables[variable]
+
+        for name, value in [('get_nc_variable', get_nc_variable),
+                            ('get_variables', lambda expt, ncfile: list(self.variables))]:
+            patcher = mock.patch.object(overturning, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(memory_module, 'experiment_fingerprint',
+                                    lambda expt, patterns: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_metrics(self):
+        psi = self.variables['ty_trans_rho'].sum('grid_xt_ocean') * 1e-9
+        gm = self.variables['ty_trans_rho_gm'].sum('grid_xt_ocean') * 1e-9
+        psi_sum = psi.cumsum('potrho') - psi.sum('potrho') + gm
+
+        aabw = overturning.calc_aabw('expt')
+        amoc = overturning.calc_amoc('expt')
+        amoc_south = overturning.calc_amoc_south('expt')
+
+        # the transports are loaded only once for all three metrics
+        self.assertEqual(self.loaded, ['ty_trans_rho', 'ty_trans_rho_gm'])
+
+        expected = psi_sum.sel(grid_yu_ocean=-55).sel(potrho=slice(1036, None))\
+                          .min('potrho').resample(time=overturning.three_yearly).mean()
+        np.testing.assert_allclose(aabw.values, expected.values)
+        expected = psi_sum.sel(grid_yu_ocean=26).sel(potrho=slice(1035.5, None))\
+                          .max('potrho').resample(time=overturning.three_yearly).mean()
+        np.testing.assert_allclose(amoc.values, expected.values)
+        self.assertEqual(len(amoc_south.time), len(expected.time))
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from cosima_cookbook import handles, netcdf_index, streaming
+
+
+def write_ncfile(path, values, start=0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ntime, nz, ny, nx = values['u'].shape
+    with netCDF4.Dataset(path, 'w') as ds:
+        ds.createDimension('time', None)
+        for dim, size in [('st_ocean', nz), ('yu_ocean', ny), ('xu_ocean', nx)]:
+            ds.createDimension(dim, size)
+            ds.createVariable(dim, 'f8', (dim,))[:] = np.arange(size)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 1900-01-01'
+        time[:] = start + np.arange(ntime)
+        for name, value in values.items():
+            var = ds.createVariable(name, 'f4', ('time', 'st_ocean', 'yu_ocean', 'xu_ocean'),
+                                    fill_value=-1e20)
+            var[:] = np.ma.masked_invalid(value)
+
+
+class TestRunningStats(TestCase):
+    def test_batches(self):
+        rng = np.random.default_rng(0)
+        u = 1000 + rng.normal(size=(30, 3))
+        v = u + rng.normal(size=(30, 3))
+        u[4, 1] = np.nan
+
+        stats = streaming.RunningStats(['u', 'v'], [('u', 'u'), ('u', 'v')], (3,))
+        other = streaming.RunningStats(['u', 'v'], [('u', 'u'), ('u', 'v')], (3,))
+        stats.update({'u': u[:7], 'v': v[:7]})
+        stats.update({'u': u[7:20], 'v': v[7:20]})
+        other.update({'u': u[20:], 'v': v[20:]})
+        stats.merge(other)
+
+        valid = np.isfinite(u)
+        v = np.where(valid, v, np.nan)
+        np.testing.assert_array_equal(stats.count, valid.sum(axis=0))
+        np.testing.assert_allclose(stats.mean['u'], np.nanmean(u, axis=0))
+        np.testing.assert_allclose(stats.variance('u'), np.nanvar(u, axis=0))
+        covariance = np.nanmean((u - np.nanmean(u, axis=0)) * (v - np.nanmean(v, axis=0)),
+                                axis=0)
+        np.testing.assert_allclose(stats.covariance('v', 'u'), covariance)
+
+
+class TestStreamingStats(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = (netcdf_index.directoriesToSearch,
+                      netcdf_index.database_url)
+        netcdf_index.directoriesToSearch = [os.path.join(self.root, 'data')]
+        netcdf_index.database_url = 'sqlite:///{}'.format(
+            os.path.join(self.root, 'index.db'))
+
+        rng = np.random.default_rng(1)
+        self.values = {name: rng.normal(size=(6, 3, 4, 5)).astype('f4')
+                       for name in ['u', 'v', 'temp']}
+        self.values['u'][2, 0, 0, 0] = np.nan
+        for i in range(3):
+            write_ncfile(os.path.join(self.root, 'data', 'config', 'expt',
+                                      'output00{}'.format(i), 'ocean', 'ocean_daily.nc'),
+                         {name: value[2*i:2*i+2] for name, value in self.values.items()},
+                         start=2 * i)
+        netcdf_index.build_index()
+
+    def tearDown(self):
+        netcdf_index.directoriesToSearch, netcdf_index.database_url = self.saved
+        handles.handle_cache.clear()
+        shutil.rmtree(self.root)
+
+    def test_eddy_statistics(self):
+        output = os.path.join(self.root, 'eddy.nc')
+        # slabs of a single level, accumulated by two threads
+        stats = streaming.eddy_statistics('expt', 'ocean_daily.nc', max_workers=2,
+                                          block_bytes=3 * 8 * 20, output=output)
+
+        u = self.values['u'].astype('f8')
+        v = self.values['v'].astype('f8')
+        temp = streaming.t_to_u_grid(self.values['temp'])
+        valid = np.isfinite(u) & np.isfinite(temp)
+        u, v, temp = (np.where(valid, x, np.nan) for x in (u, v, temp))
+        eke = 0.5 * (np.nanvar(u, axis=0) + np.nanvar(v, axis=0))
+        heat_flux = np.nanmean((v - np.nanmean(v, axis=0)) * (temp - np.nanmean(temp, axis=0)),
+                               axis=0)
+
+        self.assertEqual(stats['eke'].dims, ('st_ocean', 'yu_ocean', 'xu_ocean'))
+        np.testing.assert_allclose(stats['eke'].values, eke)
+        np.testing.assert_allclose(stats['v_temp_cov'].values, heat_flux)
+        np.testing.assert_array_equal(stats['count'].values, valid.sum(axis=0))
+        with xr.open_dataset(output) as saved:
+            xr.testing.assert_allclose(saved['eke'], stats['eke'])
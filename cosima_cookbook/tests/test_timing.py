@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from cosima_cookbook import handles, netcdf_index, timing
+from cosima_cookbook.tests.test_netcdf_index import write_ncfile
+
+
+class TestTiming(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for name, value in [('directoriesToSearch', [os.path.join(self.root, 'data')]),
+                            ('database_url', 'sqlite:///{}'.format(
+                                os.path.join(self.root, 'index.db')))]:
+            patcher = mock.patch.object(netcdf_index, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for i in range(2):
+            write_ncfile(os.path.join(self.root, 'data', 'config', 'expt',
+                                      'output00{}'.format(i), 'ocean', 'ocean.nc'),
+                         start=730 * i)
+        handles.handle_cache.clear()
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def test_disabled(self):
+        with mock.patch.object(timing, 'enabled', False):
+            netcdf_index.build_index()
+        self.assertEqual(timing.spans(), [])
+
+    def test_spans(self):
+        with mock.patch.object(timing, 'enabled', True):
+            netcdf_index.build_index()
+            netcdf_index.get_nc_variable('expt', 'ocean.nc', 'temp').load()
+
+        report = timing.report()
+        for name in ['build_index', 'build_index.discover', 'build_index.insert',
+                     'get_nc_variable', 'get_nc_variable.query',
+                     'get_nc_variable.decode', 'read_block']:
+            self.assertIn(name, report)
+        self.assertEqual(report['build_index.read_metadata']['calls'], 2)
+        self.assertEqual(report['build_index.read_metadata']['counts']['files'], 2)
+        self.assertEqual(report['get_nc_variable.query']['counts']['files'], 2)
+        self.assertEqual(report['open_file']['counts']['files'], 2)
+        self.assertEqual(report['read_block']['counts']['nbytes'], 4 * 4 * 4)
+
+        trace = os.path.join(self.root, 'trace.json')
+        timing.write_trace(trace)
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(len(events), len(timing.spans()))
+        self.assertEqual({event['ph'] for event in events}, {'X'})
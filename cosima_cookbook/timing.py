@@ -0,0 +1,183 @@
+"""
+Timed spans of the phases of indexing, loading and diagnostics.
+
+Switched on by setting timing.enabled = True, or the environment
+variable COSIMA_COOKBOOK_TIMING to 1 (or to the name of a file, to
+which the trace is then written when Python exits).  While it is off,
+each span costs a single check of timing.enabled.
+
+Each span records its name, start, duration and thread, and counts such
+as the files opened or bytes read.  The spans timed are
+
+    build_index, and its phases build_index.discover, .query, .stat,
+        .read_metadata (of each file) and .insert (of each batch)
+    get_nc_variable, and its phases get_nc_variable.query, .layout,
+        .open, .concat, .load, .decode, .cache_lookup and .cache_store
+    open_file and read_block, as files are opened and chunks read
+    diagnostic.<name> of each cached diagnostic, and its phases
+        diagnostic.load, .compute and .save
+  report() sums them by name, and
+write_trace() saves every span in the Chrome trace event format, which
+chrome://tracing and https://ui.perfetto.dev display as a timeline.
+
+    timing.enabled = True
+    get_nc_variable('01deg_jra55v13_iaf', 'ocean.nc', 'temp')
+    timing.print_report()
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+_setting = os.environ.get('COSIMA_COOKBOOK_TIMING', '')
+
+enabled = _setting not in ('', '0')
+
+# the most spans kept, the oldest being dropped beyond this
+max_spans = 1000000
+
+_spans = deque(maxlen=max_spans)
+_origin = time.perf_counter()
+
+
+class _NullSpan(object):
+    """
+    Stands in for a Span while timing is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, **counts):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span(object):
+    """
+    A timed phase, with counts added while it runs.
+    """
+
+    __slots__ = ('name', 'counts', 'start', 'duration', 'thread')
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.duration = time.perf_counter() - self.start
+        _spans.append(self)
+        return False
+
+    def add(self, **counts):
+        """
+        Adds to the counts (files, bytes, ...) of the span.
+        """
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+def span(name, **counts):
+    """
+    Returns a context manager timing the phase of the given name, with
+    initial counts, or one doing nothing while timing is off.
+    """
+    if not enabled:
+        return _null_span
+    return Span(name, counts)
+
+
+def timed(name):
+    """
+    Decorates a function so that each call is timed as a span of the
+    given name.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def reset():
+    """
+    Forgets the spans recorded so far.
+    """
+    _spans.clear()
+
+
+def spans():
+    """
+    Returns a list of the spans recorded, as dictionaries of their name,
+    start (in seconds since the module was loaded), duration, thread
+    and counts.
+    """
+    return [{'name': s.name, 'start': s.start - _origin, 'duration': s.duration,
+             'thread': s.thread, 'counts': dict(s.counts)} for s in list(_spans)]
+
+
+def report():
+    """
+    Returns a dictionary by span name of the number of calls, the total,
+    mean and maximum duration in seconds, and the sum of each count.
+    """
+    summary = {}
+    for s in list(_spans):
+        entry = summary.setdefault(s.name, {'calls': 0, 'total': 0.0, 'max': 0.0,
+                                            'counts': {}})
+        entry['calls'] += 1
+        entry['total'] += s.duration
+        entry['max'] = max(entry['max'], s.duration)
+        for key, value in s.counts.items():
+            entry['counts'][key] = entry['counts'].get(key, 0) + value
+    for entry in summary.values():
+        entry['mean'] = entry['total'] / entry['calls']
+    return summary
+
+
+def print_report():
+    """
+    Prints the report, slowest phases first.
+    """
+    summary = report()
+    print('{:40s} {:>7s} {:>10s} {:>10s}  counts'.format('span', 'calls', 'total s', 'max s'))
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        counts = ', '.join('{}={}'.format(key, value)
+                           for key, value in sorted(entry['counts'].items()))
+        print('{:40s} {:7d} {:10.4f} {:10.4f}  {}'.format(name, entry['calls'],
+                                                         entry['total'], entry['max'],
+                                                         counts))
+
+
+def write_trace(path):
+    """
+    Writes the spans recorded to path in the Chrome trace event format.
+    """
+    pid = os.getpid()
+    events = [{'name': s.name, 'ph': 'X', 'pid': pid, 'tid': s.thread,
+               'ts': (s.start - _origin) * 1e6, 'dur': s.duration * 1e6,
+               'args': dict(s.counts)} for s in list(_spans)]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+if enabled and _setting != '1':
+    atexit.register(write_trace, _setting)
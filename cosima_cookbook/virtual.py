@@ -0,0 +1,285 @@
+"""
+Lazy datasets laid out from the catalog rather than from the files.
+
+The catalog records the shape of each variable in each file, the
+values of each file's time axis and the dtype, attributes and static
+coordinates of each basename pattern.  From these a dask-backed
+xarray.Dataset can be assembled without opening any file: each file
+is opened only when one of its chunks is computed.  Chunks are planned
+by the chunking module, and along time may span several files.
+"""
+
+import itertools
+
+import numpy as np
+import dask.array as da
+import xarray as xr
+from dask.base import tokenize
+from dask.highlevelgraph import HighLevelGraph
+
+from . import chunking, handles, timing
+
+# attributes xarray moves to the encoding when decoding a variable
+_encoding_attributes = ('_FillValue', 'missing_value',
+                        'scale_factor', 'add_offset', 'coordinates')
+
+
+def _read(ncfile, variable, key, dtype):
+    """
+    Reads variable[key] from ncfile as stored, without masking or scaling.
+    """
+    # the file is kept open in the handle cache for later chunks
+    while True:
+        ds = handles.netcdf_dataset(ncfile)
+        with handles.hdf5_lock:
+            if ds.isopen():
+                var = ds.variables[variable]
+                var.set_auto_maskandscale(False)
+                return np.asarray(var[key], dtype=dtype)
+
+
+def decoded_dtype(dtype, attributes):
+    """
+    Returns the dtype xarray decodes a variable of the given dtype to,
+    given its attributes as read from the file: the scale_factor and
+    add_offset of packed data decide it by their own dtypes.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iuf':
+        return dtype
+    scale_factor = attributes.get('scale_factor')
+    add_offset = attributes.get('add_offset')
+
+    if scale_factor is not None or add_offset is not None:
+        packing = [np.asarray(value).dtype for value in (scale_factor, add_offset)
+                   if value is not None]
+        if (len(packing) == 2 and packing[0] == packing[1]
+                and packing[0] in (np.dtype('f4'), np.dtype('f8'))):
+            # float32 cannot hold every 32 bit integer
+            if dtype.kind in 'iu' and dtype.itemsize == 4:
+                return np.dtype('f8')
+            return packing[0]
+        if add_offset is not None or packing[0].kind != 'f':
+            return np.dtype('f8')
+        return packing[0]
+
+    if '_FillValue' not in attributes and 'missing_value' not in attributes:
+        return dtype
+    if dtype.kind == 'f' and dtype.itemsize <= 4:
+        return np.dtype('f4')
+    if dtype.kind in 'iu' and dtype.itemsize <= 2:
+        return np.dtype('f4')
+    return np.dtype('f8')
+
+
+class _Decoding(object):
+    """
+    Masks fill values and applies the scale and offset of a variable,
+    as xarray does when opening the file.
+    """
+
+    def __init__(self, fill_values, scale_factor, add_offset, dtype):
+        self.fill_values = fill_values
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+        self.dtype = dtype
+
+    def __call__(self, values):
+        decoded = values.astype(self.dtype)
+        if len(self.fill_values) > 0:
+            decoded[np.isin(values, self.fill_values)] = np.nan
+        if self.scale_factor is not None:
+            decoded *= self.scale_factor
+        if self.add_offset is not None:
+            decoded += self.add_offset
+        return decoded
+
+
+def _decoding(description):
+    """
+    Returns the _Decoding of a variable, or None if it needs none.
+    """
+    attributes = description['attributes']
+    fill_values = []
+    for name in ('_FillValue', 'missing_value'):
+        value = attributes.get(name)
+        if value is not None:
+            fill_values.extend(np.atleast_1d(value).tolist())
+    fill_values = [value for value in fill_values
+                   if isinstance(value, (int, float)) and not np.isnan(value)]
+
+    scale_factor = attributes.get('scale_factor')
+    add_offset = attributes.get('add_offset')
+
+    if len(fill_values) == 0 and scale_factor is None and add_offset is None:
+        return None
+    return _Decoding(fill_values, scale_factor, add_offset,
+                     description['decoded_dtype'])
+
+
+def _read_block(variable, dtype, axis, pieces, decoding):
+    """
+    Reads a block of variable from pieces, a list of (ncfile, key),
+    concatenated along axis, and decodes it.
+    """
+    with timing.span('read_block', files=len(pieces)) as span:
+        values = [_read(ncfile, variable, key, dtype) for ncfile, key in pieces]
+        block = values[0] if len(values) == 1 else np.concatenate(values, axis=axis)
+        span.add(nbytes=block.nbytes)
+    return block if decoding is None else decoding(block)
+
+
+def _slices(chunks):
+    stops = np.cumsum(chunks).tolist()
+    return [slice(stop - size, stop) for size, stop in zip(chunks, stops)]
+
+
+def _lazy_array(ncfiles, variable, dimensions, shapes, description, plan):
+    """
+    Returns a dask array reading variable from ncfiles, concatenated
+    along time (if it is a dimension), in the chunks of plan.
+
+    The graph is a single layer with one task per chunk, each reading
+    the parts of the files within it and decoding them, so that even
+    variables spread over thousands of files are quick to optimise and
+    schedule.
+    """
+    axis = dimensions.index('time') if 'time' in dimensions else 0
+    dtype = description['dtype']
+    decoding = _decoding(description)
+
+    lengths = [shape[axis] for shape in shapes]
+    offsets = np.cumsum([0] + lengths[:-1]).tolist()
+
+    # the (ncfile, slice along axis) read for each chunk along axis
+    axis_pieces = []
+    for chunk in _slices(plan.chunks[axis]):
+        pieces = [(ncfile, slice(max(chunk.start, offset) - offset,
+                                 min(chunk.stop, offset + length) - offset))
+                  for ncfile, offset, length in zip(ncfiles, offsets, lengths)
+                  if max(chunk.start, offset) < min(chunk.stop, offset + length)]
+        axis_pieces.append(pieces or [(ncfiles[0], slice(0, 0))])
+
+    name = 'netcdf-{}-{}'.format(variable, tokenize(ncfiles, variable, shapes,
+                                                    description, plan.chunks))
+    slices = [_slices(chunks) for chunks in plan.chunks]
+    dsk = {}
+    for index in itertools.product(*(range(len(chunks)) for chunks in plan.chunks)):
+        key = tuple(dim_slices[i] for dim_slices, i in zip(slices, index))
+        pieces = [(ncfile, key[:axis] + (local,) + key[axis+1:])
+                  for ncfile, local in axis_pieces[index[axis]]]
+        dsk[(name,) + index] = (_read_block, variable, dtype, axis, pieces, decoding)
+
+    out_dtype = dtype if decoding is None else decoding.dtype
+    graph = HighLevelGraph.from_collections(name, dsk, dependencies=())
+    return da.Array(graph, name, plan.chunks,
+                    meta=np.empty((0,) * len(dimensions), dtype=out_dtype))
+
+
+def _attributes(description):
+    return {name: value for name, value in description['attributes'].items()
+            if name not in _encoding_attributes}
+
+
+def open_virtual_dataset(catalog, expt, basename_pattern, ncfiles,
+                         variables, chunks=None, target_bytes=None, explain=False):
+    """
+    Returns a lazy xarray.Dataset of variables concatenated along time
+    from ncfiles of the given experiment and basename pattern, laid out
+    from the information in catalog.
+
+    The result matches that of opening each file with decode_times=False
+    and concatenating along time.  None is returned if the catalog does
+    not hold everything needed, for instance if the files were indexed
+    by an earlier version, or if any variable has no time dimension.
+
+    Variables are chunked by chunking.plan_chunks, aiming at chunks of
+    target_bytes, except along the dimensions given in the dictionary
+    chunks.  With explain=True the plan for each variable is printed.
+    """
+    described = catalog.pattern_variables(expt, basename_pattern)
+
+    for variable in variables:
+        description = described.get(variable)
+        if (description is None or 'time' not in description['dimensions']
+                or description['dtype'].kind not in 'iuf'):
+            return None
+
+    # non-dimension coordinates named by the variables
+    coordinates = []
+    for variable in variables:
+        for name in str(described[variable]['attributes'].get('coordinates', '')).split():
+            if (name in described and name not in variables
+                    and name not in coordinates
+                    and described[name]['dtype'].kind in 'iuf'):
+                coordinates.append(name)
+
+    layout = catalog.file_layout(ncfiles, list(variables) + coordinates)
+    for ncfile in ncfiles:
+        time_values, shapes, _ = layout.get(ncfile, (None, {}, {}))
+        if time_values is None or any(v not in shapes for v in variables):
+            return None
+
+    def lazy(variable, ncfiles):
+        description = described[variable]
+        dimensions = description['dimensions']
+        shapes = [layout[ncfile][1][variable] for ncfile in ncfiles]
+        if any(len(shape) != len(dimensions) for shape in shapes):
+            return None
+
+        if 'time' in dimensions:
+            axis = dimensions.index('time')
+            file_lengths = [shape[axis] for shape in shapes]
+            shape = list(shapes[0])
+            shape[axis] = sum(file_lengths)
+            # the other dimensions must match to concatenate the files
+            if any(s[:axis] + s[axis+1:] != shapes[0][:axis] + shapes[0][axis+1:]
+                   for s in shapes):
+                return None
+        else:
+            file_lengths = None
+            shape = shapes[0]
+
+        plan = chunking.plan_chunks(variable, dimensions, shape, description['dtype'],
+                                    layout[ncfiles[0]][2].get(variable),
+                                    chunks, file_lengths, target_bytes)
+        if explain:
+            print(plan)
+
+        array = _lazy_array(ncfiles, variable, dimensions, shapes, description, plan)
+        return xr.Variable(dimensions, array, _attributes(description))
+
+    data_vars = {variable: lazy(variable, ncfiles) for variable in variables}
+    if any(var is None for var in data_vars.values()):
+        return None
+
+    coords = {}
+    time = described.get('time', {'attributes': {}})
+    coords['time'] = xr.Variable(
+        'time', np.concatenate([layout[ncfile][0] for ncfile in ncfiles]),
+        _attributes(time))
+    if coords['time'].size != data_vars[variables[0]].sizes['time']:
+        return None
+
+    for variable in variables:
+        for dim, size in data_vars[variable].sizes.items():
+            if dim in coords or dim not in described:
+                continue
+            values = described[dim]['coordinate_values']
+            if values is None or len(values) != size:
+                return None
+            coords[dim] = xr.Variable(dim, values, _attributes(described[dim]))
+
+    for name in coordinates:
+        if name not in layout[ncfiles[0]][1]:
+            continue
+        if 'time' in described[name]['dimensions']:
+            if any(name not in layout[ncfile][1] for ncfile in ncfiles):
+                continue
+            coord = lazy(name, ncfiles)
+        else:
+            coord = lazy(name, ncfiles[:1])
+        if coord is not None:
+            coords[name] = coord
+
+    return xr.Dataset(data_vars, coords=coords)
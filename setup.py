@@ -14,7 +14,6 @@ setup(
         'dask',
         'xarray',
         'numpy',
-        'joblib',
         'matplotlib',
         'bokeh',
         'dataset',
@@ -22,6 +21,7 @@ setup(
         'distributed',
         'netcdf4',
         'f90nml',
+        'psutil',
         'tqdm'
         ],
     test_suite='nose.collector',